@@ -9,4 +9,6 @@ class MusicBusController(BusController):
         if request.session.uid:
             channels = list(channels)
             channels.append((request.db, "oomusic.remote", request.session.uid))
+            channels.append((request.db, "oomusic.folder.scan", request.session.uid))
+            channels.append((request.db, "oomusic.converter", request.session.uid))
         return super(MusicBusController, self)._poll(dbname, channels, last, options)
@@ -8,11 +8,39 @@ from werkzeug.wrappers import Response
 from werkzeug.wsgi import wrap_file
 
 from odoo import _, fields, http
+from odoo.addons.oomusic.models.oomusic_transcoder import TranscoderBusy
 from odoo.http import request
 
 _logger = logging.getLogger(__name__)
 
 
+def send_file_range(file_path, mimetype):
+    """
+    Send a file, supporting the HTTP range requests with `206 Partial Content` responses. It
+    allows a browser to seek in a file already transcoded, or a client to resume a download,
+    without transcoding again. The file name is used as entity tag, since the file names of the
+    transcoding cache are content-addressed.
+
+    :param str file_path: path of the file
+    :param str mimetype: mimetype of the file
+    :return: response, None if the file does not exist anymore, e.g. it was evicted from the
+        transcoding cache in the meantime
+    """
+    try:
+        f = open(file_path, "rb")
+    except FileNotFoundError:
+        return None
+    stat = os.fstat(f.fileno())
+    data = wrap_file(request.httprequest.environ, f)
+    rv = Response(data, mimetype=mimetype, direct_passthrough=True)
+    rv.content_length = stat.st_size
+    rv.last_modified = int(stat.st_mtime)
+    rv.set_etag(os.path.basename(file_path))
+    return rv.make_conditional(
+        request.httprequest, accept_ranges=True, complete_length=stat.st_size
+    )
+
+
 class MusicController(http.Controller):
     @http.route(["/oomusic/down"], auth="public", type="http")
     def down(self, **kwargs):
@@ -70,29 +98,28 @@ class MusicController(http.Controller):
         elif mode == "raw" and seek:
             Transcoder = request.env.ref("oomusic.oomusic_transcoder_99")
         else:
-            Transcoder = (
-                request.env["oomusic.transcoder"]
-                .search([("output_format.name", "=", output_format)])
-                .filtered(lambda r: fn_ext[1:] not in r.mapped("black_formats.name"))
+            Transcoder = request.env["oomusic.transcoder"]._get_transcoder(
+                output_format, fn_ext[1:]
             )
-        Transcoder = Transcoder[0] if Transcoder else False
 
-        if Transcoder:
-            generator = Transcoder.transcode(
-                track_id, seek=seek, norm=True if mode == "norm" else False
-            ).stdout
-            mimetype = Transcoder.output_format.mimetype
-        else:
+        if not Transcoder:
             _logger.warning("Could not find converter from '%s' to '%s'", fn_ext[1:], output_format)
             return http.send_file(Track.path)
 
-        # FIXME: see http://librelist.com/browser/flask/2011/10/5/response-to-a-range-request/#1e95dd715f412161d3db2fc8aaf8666f
+        norm = True if mode == "norm" else False
+        mimetype = Transcoder.output_format.mimetype
+        cached_file = Transcoder.get_cached_file(track_id, norm=norm) if not seek else False
+        res = send_file_range(cached_file, mimetype) if cached_file else None
+        if res:
+            return res
 
-        # Set a buffer size of 200 KB. The default value (8 KB) seems too small and leads to chunk
-        # download errors. Since the player is not fault-tolerant, a single download error leads to
-        # a complete stop of the music. Maybe consider this value as a user option for people with
-        # bad network.
-        data = wrap_file(
-            request.httprequest.environ, generator, buffer_size=Transcoder.buffer_size * 1024
-        )
+        # Range requests are only supported once the track is in the transcoding cache. The
+        # output of a running transcoding has an unknown length, and a seek restarts it.
+        # The output is sent by chunks of the buffer size (200 KB by default). The default value
+        # of werkzeug (8 KB) seems too small and leads to chunk download errors. Since the player
+        # is not fault-tolerant, a single download error leads to a complete stop of the music.
+        try:
+            data = Transcoder.transcode_stream(track_id, seek=seek, norm=norm)
+        except TranscoderBusy:
+            abort(503)
         return Response(data, mimetype=mimetype, direct_passthrough=True)
@@ -483,13 +483,12 @@ class SubsonicREST:
         return elem_artist
 
     def make_AlbumID3(self, album):
-        durations = [t["duration"] for t in album.track_ids.read(["duration"])]
         elem_album = etree.Element(
             "album",
             id=str(album.id),
             name=album.name,
-            songCount=str(len(album.track_ids)),
-            duration=str(sum(durations)),
+            songCount=str(album.track_count),
+            duration=str(album.duration),
             created=self._dt_to_string(album.create_date),
             userRating=album.rating or "0",
             averageRating=album.rating or "0",
@@ -8,12 +8,13 @@ from io import BytesIO
 
 from lxml import etree
 from werkzeug.wrappers import Response
-from werkzeug.wsgi import wrap_file
 
 from odoo import http
+from odoo.addons.oomusic.models.oomusic_transcoder import TranscoderBusy
 from odoo.exceptions import AccessError
 from odoo.http import request
 
+from ..main import send_file_range
 from .common import SubsonicREST
 
 _logger = logging.getLogger(__name__)
@@ -64,22 +65,21 @@ class MusicSubsonicMediaRetrieval(http.Controller):
         ):
             return http.send_file(track.path)
 
-        Transcoder = (
-            request.env["oomusic.transcoder"]
-            .search([("output_format.name", "=", output_format)])
-            .filtered(lambda r: fn_ext[1:] not in r.mapped("black_formats.name"))
-        )
-        Transcoder = Transcoder[0] if Transcoder else False
-        if Transcoder:
-            generator = Transcoder.transcode(int(trackId), bitrate=maxBitRate).stdout
-            mimetype = Transcoder.output_format.mimetype
-        else:
+        Transcoder = request.env["oomusic.transcoder"]._get_transcoder(output_format, fn_ext[1:])
+        if not Transcoder:
             _logger.warning("Could not find converter from '%s' to '%s'", fn_ext[1:], output_format)
             return http.send_file(track.path)
 
-        data = wrap_file(
-            request.httprequest.environ, generator, buffer_size=Transcoder.buffer_size * 1024
-        )
+        mimetype = Transcoder.output_format.mimetype
+        cached_file = Transcoder.get_cached_file(int(trackId), bitrate=maxBitRate)
+        res = send_file_range(cached_file, mimetype) if cached_file else None
+        if res:
+            return res
+
+        try:
+            data = Transcoder.transcode_stream(int(trackId), bitrate=maxBitRate)
+        except TranscoderBusy as e:
+            return rest.make_error(code="0", message=e.name)
         return Response(data, mimetype=mimetype, direct_passthrough=True)
 
     @http.route(
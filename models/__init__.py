@@ -9,7 +9,9 @@ from . import oomusic_bandsintown
 from . import oomusic_config_settings
 from . import oomusic_converter
 from . import oomusic_folder
+from . import oomusic_folder_quarantine
 from . import oomusic_folder_scan
+from . import oomusic_folder_scan_log
 from . import oomusic_format
 from . import oomusic_genre
 from . import oomusic_lastfm
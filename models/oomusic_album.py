@@ -2,7 +2,7 @@
 
 import json
 
-from odoo import _, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError
 
 
@@ -20,6 +20,9 @@ class MusicAlbum(models.Model):
     genre_id = fields.Many2one("oomusic.genre", "Genre", index=True)
     year = fields.Char("Year", index=True)
     folder_id = fields.Many2one("oomusic.folder", "Folder", index=True, required=True)
+    track_count = fields.Integer("Tracks", compute="_compute_track_stats", store=True)
+    duration = fields.Integer("Duration", compute="_compute_track_stats", store=True)
+    size = fields.Float("Size (MiB)", compute="_compute_track_stats", store=True)
     user_id = fields.Many2one(
         "res.users",
         string="User",
@@ -63,6 +66,93 @@ class MusicAlbum(models.Model):
     )
     has_image = fields.Boolean("Has Image", related="folder_id.has_image", related_sudo=False)
 
+    _sql_constraints = [
+        (
+            "oomusic_album_name_uniq",
+            "unique(name, folder_id, user_id)",
+            "Album name must be unique in a folder!",
+        )
+    ]
+
+    def _auto_init(self):
+        # The former scans could create the same album twice in a folder. They are merged before
+        # the unique constraint is added, otherwise it cannot be created and the scanner, which
+        # relies on it, would create more duplicates.
+        album_ids = []
+        if tools.table_exists(self._cr, self._table):
+            album_ids = self._merge_duplicates()
+        res = super(MusicAlbum, self)._auto_init()
+        if album_ids:
+            self.env["oomusic.folder.scan"]._update_album_stats(album_ids)
+        return res
+
+    def _merge_duplicates(self):
+        """
+        Merge the albums having the same name in the same folder: the tracks of the duplicates are
+        moved to the oldest album, as well as their preferences if the oldest album has none. The
+        duplicates are then removed.
+
+        :return list: IDs of the albums kept
+        """
+        cr = self._cr
+        cr.execute(
+            """
+            CREATE TEMPORARY TABLE oomusic_album_merge ON COMMIT DROP AS
+            SELECT a.id, d.keep_id
+            FROM oomusic_album AS a
+            JOIN (
+                SELECT name, folder_id, user_id, min(id) AS keep_id
+                FROM oomusic_album
+                GROUP BY name, folder_id, user_id
+                HAVING count(*) > 1
+            ) AS d ON d.name = a.name AND d.folder_id = a.folder_id AND d.user_id = a.user_id
+            WHERE a.id != d.keep_id;
+        """
+        )
+        if not cr.rowcount:
+            cr.execute("DROP TABLE oomusic_album_merge;")
+            return []
+        cr.execute(
+            """
+            UPDATE oomusic_track AS t SET album_id = m.keep_id
+            FROM oomusic_album_merge AS m WHERE t.album_id = m.id;
+
+            UPDATE oomusic_preference AS p SET res_id = m.keep_id
+            FROM oomusic_album_merge AS m
+            WHERE p.res_model = 'oomusic.album' AND p.res_id = m.id AND NOT EXISTS (
+                SELECT 1 FROM oomusic_preference AS k
+                WHERE k.res_model = p.res_model AND k.res_id = m.keep_id AND k.user_id = p.user_id
+            ) AND p.id = (
+                SELECT min(q.id) FROM oomusic_preference AS q
+                JOIN oomusic_album_merge AS n ON n.id = q.res_id
+                WHERE q.res_model = p.res_model AND n.keep_id = m.keep_id AND q.user_id = p.user_id
+            );
+
+            DELETE FROM oomusic_preference AS p USING oomusic_album_merge AS m
+            WHERE p.res_model = 'oomusic.album' AND p.res_id = m.id;
+
+            DELETE FROM oomusic_album AS a USING oomusic_album_merge AS m WHERE a.id = m.id;
+        """
+        )
+        cr.execute("SELECT DISTINCT keep_id FROM oomusic_album_merge;")
+        album_ids = [r[0] for r in cr.fetchall()]
+        cr.execute("DROP TABLE oomusic_album_merge;")
+        return album_ids
+
+    @api.depends("track_ids.duration", "track_ids.size")
+    def _compute_track_stats(self):
+        # The folder scanner updates these fields directly in the database, see
+        # `_update_album_stats`
+        res = self.env["oomusic.track"].read_group(
+            [("album_id", "in", self.ids)], ["album_id", "duration", "size"], ["album_id"]
+        )
+        stats = {r["album_id"][0]: r for r in res}
+        for album in self:
+            album_stats = stats.get(album.id, {})
+            album.track_count = album_stats.get("album_id_count", 0)
+            album.duration = album_stats.get("duration", 0)
+            album.size = album_stats.get("size", 0.0)
+
     def action_add_to_playlist(self):
         playlist = self.env["oomusic.playlist"].search([("current", "=", True)], limit=1)
         if not playlist:
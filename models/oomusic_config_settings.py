@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 
+from multiprocessing import cpu_count
+
 from odoo import api, fields, models
 from odoo.release import version
 
@@ -51,6 +53,66 @@ class MusicConfigSettings(models.TransientModel):
         help="Disable transcoding everywhere. This option bypasses any other transcoding setting. "
         "Change at your own risks!",
     )
+    trans_cache_size = fields.Integer(
+        "Transcoding Cache (MiB)",
+        config_parameter="oomusic.trans_cache_size",
+        default=1024,
+        help="Maximum size of the transcoded files kept on the disk, so a track played again is "
+        "not transcoded twice. The least recently played files are removed first. Set 0 to "
+        "deactivate the cache.",
+    )
+    trans_max_processes = fields.Integer(
+        "Concurrent Transcodings",
+        config_parameter="oomusic.trans_max_processes",
+        default=lambda s: cpu_count(),
+        help="Maximum number of transcoding processes running at the same time on the server. "
+        "Streams have priority over the converter and the prefetching. Set 0 for no limit.",
+    )
+    trans_queue_timeout = fields.Integer(
+        "Transcoding Queue Timeout (s)",
+        config_parameter="oomusic.trans_queue_timeout",
+        default=30,
+        help="Maximum time a stream waits for a transcoding slot before being refused.",
+    )
+    trans_background_timeout = fields.Integer(
+        "Background Transcoding Timeout (s)",
+        config_parameter="oomusic.trans_background_timeout",
+        default=600,
+        help="Maximum time a converter job or a prefetching waits for a transcoding slot. A "
+        "converter line which times out is converted later. Set 0 for no limit.",
+    )
+    trans_processes = fields.Integer(
+        "Running Transcodings",
+        readonly=True,
+        help="Number of transcoding processes currently running on the server.",
+    )
+    prefetch_count = fields.Integer(
+        "Prefetched Tracks",
+        config_parameter="oomusic.prefetch_count",
+        default=2,
+        help="Number of upcoming tracks of a playlist transcoded in advance in the transcoding "
+        "cache, avoiding gaps between the tracks. Set 0 to deactivate.",
+    )
+    prefetch_workers = fields.Integer(
+        "Prefetch Processes",
+        config_parameter="oomusic.prefetch_workers",
+        default=1,
+        help="Maximum number of transcodings run at the same time in advance, by server process.",
+    )
+    scan_concurrency = fields.Integer(
+        "Concurrent Scans",
+        config_parameter="oomusic.scan_concurrency",
+        default=1,
+        help="Number of root folders scanned at the same time by the scheduled action. Useful if "
+        "the folders are located on different disks.",
+    )
+    loudness_workers = fields.Integer(
+        "Loudness Analysis Processes",
+        config_parameter="oomusic.loudness_workers",
+        default=1,
+        help="Number of processes analyzing the loudness of the tracks in the background. The "
+        "analysis allows a fast volume normalization when playing.",
+    )
     version = fields.Char("Version", readonly=True)
 
     @api.model
@@ -77,6 +139,10 @@ class MusicConfigSettings(models.TransientModel):
         res["view"] = "tree" if all([v.split(",")[0] == "tree" for v in view]) else "kanban"
         res["folder_sharing"] = "inactive" if all([c for c in folder_sharing]) else "active"
         res["version"] = version
+        stats = self.env["oomusic.transcoder"].get_transcode_stats()
+        res["trans_processes"] = (
+            stats["processes"] if stats["running"] is None else stats["running"]
+        )
         return res
 
     def set_values(self):
@@ -84,6 +150,8 @@ class MusicConfigSettings(models.TransientModel):
         # Activate/deactive ir.cron
         (
             self.env.ref("oomusic.oomusic_scan_folder")
+            + self.env.ref("oomusic.oomusic_watch_folder")
+            + self.env.ref("oomusic.oomusic_analyze_loudness")
             + self.env.ref("oomusic.oomusic_build_artists_image_cache")
             + self.env.ref("oomusic.oomusic_build_image_cache")
             + self.env.ref("oomusic.oomusic_build_bandsintown_cache")
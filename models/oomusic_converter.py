@@ -1,14 +1,133 @@
 # -*- coding: utf-8 -*-
 
-import multiprocessing.dummy as mp
+import fcntl
+import json
+import logging
 import os
-import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from multiprocessing import cpu_count
 from shutil import copyfile, move
 from tempfile import gettempdir
-from time import sleep
 
-from odoo import api, fields, models
+from psycopg2.extensions import TransactionRollbackError
+
+from odoo import _, api, fields, models
+from odoo.exceptions import UserError
+
+from .oomusic_transcoder import TranscodeOutput, TranscoderBusy
+
+_logger = logging.getLogger(__name__)
+
+
+class ConversionManifest(object):
+    """
+    Manifest of the files converted in a destination folder, used by the incremental conversions.
+    It is a file of JSON lines, each conversion appending the path of its output, relative to the
+    folder, the converter and a signature of the source file and of the conversion parameters. The
+    last entry of a file wins. Several converters can share the folder: each one only skips and
+    cleans its own files.
+
+    The entries read are kept in memory by the process, so only the lines appended since the last
+    read are parsed.
+    """
+
+    NAME = ".oomusic_converter.jsonl"
+
+    # Entries read by manifest path: inode and size of the file read, and tuples (converter ID,
+    # signature) by file
+    _cache = {}
+    _lock = threading.Lock()
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, self.NAME)
+
+    def _read(self):
+        try:
+            with open(self.path, "rb") as f:
+                stat = os.fstat(f.fileno())
+                ino, offset, entries = self._cache.get(self.path, (None, 0, {}))
+                if stat.st_ino != ino or stat.st_size < offset:
+                    offset, entries = 0, {}
+                f.seek(offset)
+                data = f.read()
+        except FileNotFoundError:
+            self._cache.pop(self.path, None)
+            return {}
+        # The last line might still be written by another process
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue
+            entries[entry["file"]] = (entry["converter"], entry["signature"])
+        self._cache[self.path] = (stat.st_ino, offset + end, entries)
+        return entries
+
+    def get(self, file, converter_id):
+        """
+        :param str file: output file, relative to the folder
+        :param int converter_id: ID of the converter
+        :return list: signature of the file, None if it was not converted by the converter
+        """
+        with self._lock:
+            entry = self._read().get(file)
+        return entry[1] if entry and entry[0] == converter_id else None
+
+    def add(self, file, converter_id, signature):
+        """
+        Record the conversion of a file.
+
+        :param str file: output file, relative to the folder
+        :param int converter_id: ID of the converter
+        :param list signature: signature of the conversion
+        """
+        line = self._dump(file, converter_id, signature)
+        with self._locked(), open(self.path, "ab") as f:
+            f.write(line)
+
+    def _dump(self, file, converter_id, signature):
+        entry = {"file": file, "converter": converter_id, "signature": signature}
+        return json.dumps(entry).encode("utf-8") + b"\n"
+
+    @contextmanager
+    def _locked(self):
+        # The manifest is replaced when cleaned, so the lock is taken on a separate file
+        with open(self.path + ".lock", "ab") as f:
+            fcntl.lockf(f, fcntl.LOCK_EX)
+            yield
+
+    def clean(self, converter_id, files):
+        """
+        Remove the files of a converter which are not expected anymore, i.e. whose source left the
+        converter, and rewrite the manifest without their entries. Only the files listed in the
+        manifest as converted by the converter are removed.
+
+        :param int converter_id: ID of the converter
+        :param set files: expected output files, relative to the folder
+        """
+        if not os.path.isdir(self.folder):
+            return
+        with self._locked():
+            with self._lock:
+                entries = dict(self._read())
+            for file in [f for f, e in entries.items() if e[0] == converter_id and f not in files]:
+                path = os.path.join(self.folder, file)
+                try:
+                    os.remove(path)
+                    os.removedirs(os.path.dirname(path))
+                except OSError:
+                    pass
+                del entries[file]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                for file, entry in sorted(entries.items()):
+                    f.write(self._dump(file, *entry))
+            os.replace(tmp_path, self.path)
 
 
 class MusicConverter(models.Model):
@@ -16,6 +135,10 @@ class MusicConverter(models.Model):
     _description = "Music Converter"
     _order = "name, id"
 
+    # Maximum duration (s) of a conversion run. The lines left are converted by the next run of the
+    # scheduled action.
+    CONVERT_TIME = 600
+
     def _default_transcoder_id(self):
         transcoder = self.env.ref("oomusic.oomusic_transcoder_0", raise_if_not_found=False)
         if transcoder:
@@ -77,6 +200,16 @@ class MusicConverter(models.Model):
         "FFmpeg >=3.2.1 which includes by default the appropriate library (libebur128).\n"
         "Transcoding will be significantly slower when activated.",
     )
+    incremental = fields.Boolean(
+        "Incremental",
+        default=False,
+        readonly=True,
+        states={"draft": [("readonly", False)]},
+        help="Only convert the tracks which were modified, or whose conversion parameters changed, "
+        "since the previous run in the destination folder. The converted files of the tracks "
+        "removed from the converter are deleted. The conversions are recorded in a manifest "
+        "stored in the destination folder.",
+    )
     converter_line_ids = fields.One2many(
         "oomusic.converter.line",
         "converter_id",
@@ -108,14 +241,37 @@ class MusicConverter(models.Model):
 
     @api.depends("converter_line_ids.state")
     def _compute_progress(self):
+        counts = self._get_line_counts()
         for cv in self:
             if cv.state == "draft":
                 cv.progress = 0.0
             elif cv.state == "done":
                 cv.progress = 100.0
             else:
-                lines_done = cv.converter_line_ids.filtered(lambda r: r.state == "done")
-                cv.progress = float(len(lines_done)) / float(len(cv.converter_line_ids)) * 100.0
+                count = counts.get(cv.id, {})
+                total = sum(count.values())
+                cv.progress = float(count.get("done", 0)) / float(total) * 100.0 if total else 0.0
+
+    def _get_line_counts(self):
+        """
+        :return dict: number of lines of the converters by state, e.g. {converter_id: {"done": 1}}
+        """
+        counts = {}
+        if not self.ids:
+            return counts
+        self.env["oomusic.converter.line"].flush(["converter_id", "state"])
+        self.env.cr.execute(
+            """
+            SELECT converter_id, state, count(*)
+            FROM oomusic_converter_line
+            WHERE converter_id IN %s
+            GROUP BY converter_id, state
+        """,
+            (tuple(self.ids),),
+        )
+        for converter_id, state, count in self.env.cr.fetchall():
+            counts.setdefault(converter_id, {})[state] = count
+        return counts
 
     @api.depends("progress", "state")
     def _compute_show_waiting(self):
@@ -189,28 +345,171 @@ class MusicConverter(models.Model):
         if cron and not cron.active:
             cron.try_write({"active": True})
 
+    def _get_unlocked_lines(self, states):
+        # The lines being converted are locked by the conversion workers: they are skipped rather
+        # than waiting until their conversion is over.
+        self.env["oomusic.converter.line"].flush(["converter_id", "state"])
+        self.env.cr.execute(
+            """
+            SELECT id
+            FROM oomusic_converter_line
+            WHERE converter_id IN %s AND state IN %s
+            FOR UPDATE SKIP LOCKED
+        """,
+            (tuple(self.ids), tuple(states)),
+        )
+        return self.env["oomusic.converter.line"].browse([r[0] for r in self.env.cr.fetchall()])
+
     def action_draft(self):
         self.write({"state": "draft"})
-        self.env["oomusic.converter.line"].search([("converter_id", "in", self.ids)]).write(
-            {"state": "draft"}
-        )
+        self._get_unlocked_lines(["waiting", "done", "error", "cancel"]).write({"state": "draft"})
 
     def action_cancel(self):
         self.write({"state": "cancel"})
-        self.env["oomusic.converter.line"].search(
-            [("converter_id", "in", self.ids), ("state", "=", "waiting")]
-        ).write({"state": "cancel"})
+        self._get_unlocked_lines(["waiting"]).write({"state": "cancel"})
 
     def action_convert(self):
+        """
+        Convert the waiting lines of the converters. The lines are converted in parallel by
+        `max_threads` workers, each one driving a transcoding process. See `_convert_next` for the
+        claim of the lines. A run stops after `CONVERT_TIME` seconds; it is resumed by the next run
+        of the scheduled action, as well as the lines of an interrupted run.
+        """
+        time_limit = time.time() + self.CONVERT_TIME
         for cv in self:
-            cv_pool = mp.Pool(processes=max(cv.max_threads or 1, 1))
-            cv_lines = cv.converter_line_ids.filtered(lambda r: r.state == "waiting")
-            for i in range(len(cv_lines)):
-                cv_pool.apply_async(cv_lines[i].convert)
+            # The workers cannot share the cursor of the tests
+            workers = 1 if self.env.context.get("test_mode") else max(cv.max_threads or 1, 1)
+            if workers == 1:
+                cv._convert_worker(time_limit)
+                continue
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(cv._convert_worker, time_limit) for i in range(workers)]
+                for future in futures:
+                    future.result()
+        self.invalidate_cache()
+
+    def _convert_worker(self, time_limit):
+        """
+        Convert the lines of the converter one by one, each line in its own transaction, until
+        there is none left or the time limit is reached.
+
+        :param float time_limit: timestamp after which no line is started
+        """
+        self.ensure_one()
+        while time.time() < time_limit:
+            if self.env.context.get("test_mode"):
+                if not self._convert_next():
+                    break
+                continue
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                if not self.with_env(self.env(cr=cr))._convert_next():
+                    break
+
+    def _convert_next(self):
+        """
+        Claim the next waiting line of the converter and convert it. The line is locked until the
+        transaction is committed: the other workers, possibly in another server process, skip it,
+        and the line is still waiting if the conversion is interrupted. The progress is notified on
+        the bus, and the converter is done once no line is waiting.
+
+        If no transcoding slot is available in time, the line is left waiting and the worker stops.
+        The line is converted by the next run of the scheduled action.
+
+        :return bool: False if there is no line left to convert, or no transcoding slot
+        """
+        self.env.cr.execute(
+            """
+            SELECT l.id
+            FROM oomusic_converter_line AS l
+            JOIN oomusic_converter AS c ON c.id = l.converter_id
+            WHERE l.converter_id = %s AND l.state = 'waiting' AND c.state = 'running'
+            ORDER BY l.sequence, l.id
+            LIMIT 1
+            FOR UPDATE OF l SKIP LOCKED
+        """,
+            (self.id,),
+        )
+        row = self.env.cr.fetchone()
+        busy = False
+        if row:
+            line = self.env["oomusic.converter.line"].browse(row[0])
+            try:
+                line.convert()
+                line.write({"state": "done"})
+            except TranscoderBusy:
+                _logger.warning(
+                    'No transcoding slot to convert "%s", retrying later', line.track_id.path
+                )
+                busy = True
+            except Exception:
+                _logger.exception('Error while converting "%s"', line.track_id.path)
+                line.write({"state": "error"})
+        else:
+            self._convert_done()
+        self.invalidate_cache(["state", "progress"], self.ids)
+        self.env["bus.bus"].sendone(
+            (self.env.cr.dbname, "oomusic.converter", self.user_id.id),
+            {"converter_id": self.id, "state": self.state, "progress": self.progress},
+        )
+        if not self.env.context.get("test_mode"):
+            self.env.cr.commit()
+        return bool(row) and not busy
+
+    def _convert_done(self):
+        """
+        Set the converter as done if no line is waiting anymore. Several workers might finish at
+        the same time: the converter is locked, so only one of them cleans the destination folder
+        and writes the state.
+
+        The lock is waited for rather than skipped. The last worker to commit a line might be
+        blocked by another one which still saw this line as waiting; it must then check again.
+        """
+        if not self.env.context.get("test_mode"):
+            # Start a new snapshot, which sees the lines committed by the other workers. Nothing
+            # was written in this transaction.
+            self.env.cr.rollback()
+            self.invalidate_cache()
+        try:
+            with self.env.cr.savepoint():
+                self.env.cr.execute(
+                    """
+                    SELECT id
+                    FROM oomusic_converter
+                    WHERE id = %s AND state = 'running'
+                    FOR UPDATE
+                """,
+                    (self.id,),
+                )
+                if not self.env.cr.fetchone():
+                    return
+        except TransactionRollbackError:
+            # The converter was set as done by another worker in the meantime
+            return
+        self.env.cr.execute(
+            """
+            SELECT 1
+            FROM oomusic_converter_line
+            WHERE converter_id = %s AND state = 'waiting'
+            LIMIT 1
+        """,
+            (self.id,),
+        )
+        if self.env.cr.fetchone():
+            return
+        if self.incremental:
+            self._clean_dest_folder()
+        self.write({"state": "done"})
 
-            cv_pool.close()
-            cv_pool.join()
-            cv.write({"state": "done"})
+    def _clean_dest_folder(self):
+        """
+        Remove the files converted by a previous incremental run whose track left the converter.
+        """
+        self.ensure_one()
+        files = {
+            os.path.relpath(line._get_dest_path()[0], self.dest_folder)
+            for line in self.converter_line_ids
+        }
+        ConversionManifest(self.dest_folder).clean(self.id, files)
 
     def cron_convert(self):
         self.search([("state", "=", "running")]).action_convert()
@@ -235,7 +534,13 @@ class MusicConverterLine(models.Model):
         "oomusic.converter", "Converter", required=True, index=True, ondelete="cascade"
     )
     state = fields.Selection(
-        [("draft", "Draft"), ("waiting", "Waiting"), ("done", "Done"), ("cancel", "Cancelled")],
+        [
+            ("draft", "Draft"),
+            ("waiting", "Waiting"),
+            ("done", "Done"),
+            ("error", "Failed"),
+            ("cancel", "Cancelled"),
+        ],
         string="State",
         required=True,
         copy=False,
@@ -258,51 +563,94 @@ class MusicConverterLine(models.Model):
         "res.users", related="converter_id.user_id", store=True, index=True, related_sudo=False
     )
 
+    def _get_dest_path(self):
+        """
+        :return tuple: path of the converted file, and True if the track is copied as is
+        """
+        transcoder = self.converter_id.transcoder_id
+        fn = self.track_id.path.replace(
+            self.track_id.root_folder_id.path, self.converter_id.dest_folder
+        )
+        fn_base, fn_ext = os.path.splitext(fn)
+
+        # Avoid upsampling, except for VBR and normalization
+        if (
+            fn_ext[1:] == transcoder.output_format.name
+            and not self.converter_id.norm
+            and "-q:a" not in transcoder.command
+            and (
+                not self.converter_id.bitrate or self.converter_id.bitrate >= self.track_id.bitrate
+            )
+        ):
+            return fn, True
+        return fn_base + "." + transcoder.output_format.name, False
+
+    def _get_signature(self):
+        """
+        Signature of the conversion of the line, recorded in the manifest of the incremental
+        conversions. It changes if the track file or the conversion parameters are modified.
+
+        :return list: signature, JSON serializable
+        """
+        stat = os.stat(self.track_id.path)
+        transcoder = self.converter_id.transcoder_id
+        return [
+            self.track_id.path,
+            stat.st_mtime,
+            stat.st_size,
+            transcoder.id,
+            transcoder.command,
+            self.converter_id.bitrate,
+            self.converter_id.norm,
+        ]
+
     def convert(self):
-        with api.Environment.manage(), self.pool.cursor() as cr:
-            if not self.env.context.get("test_mode"):
-                new_self = self.with_env(self.env(cr))
-            else:
-                new_self = self
-                sleep(random.random())
-            # In case we manually canceled the job between line selection and conversion
-            if new_self.state != "waiting":
+        """
+        Convert the track of the line in the destination folder of the converter. In incremental
+        mode, a track already converted with the same signature is skipped. The state of the line
+        is not modified, see `MusicConverter._convert_next`.
+        """
+        self.ensure_one()
+        transcoder = self.converter_id.transcoder_id
+        fn_out, copy = self._get_dest_path()
+
+        if self.converter_id.incremental:
+            manifest = ConversionManifest(self.converter_id.dest_folder)
+            file = os.path.relpath(fn_out, self.converter_id.dest_folder)
+            signature = self._get_signature()
+            if os.path.exists(fn_out) and manifest.get(file, self.converter_id.id) == signature:
                 return
-            transcoder = new_self.converter_id.transcoder_id
 
-            # Prepare folder and file
-            fn = new_self.track_id.path.replace(
-                new_self.track_id.root_folder_id.path, new_self.converter_id.dest_folder
+        # Prepare folder
+        try:
+            os.makedirs(os.path.dirname(fn_out))
+        except OSError:
+            pass
+
+        # The output is written aside, so an interrupted conversion does not leave a truncated file
+        tmp_path = fn_out + ".tmp"
+        if copy:
+            copyfile(self.track_id.path, tmp_path)
+        else:
+            proc = transcoder.transcode(
+                self.track_id.id,
+                bitrate=self.converter_id.bitrate,
+                norm=self.converter_id.norm,
+                background=True,
             )
-            fn_base, fn_ext = os.path.splitext(fn)
+            output = TranscodeOutput(proc, transcoder.buffer_size * 1024)
             try:
-                os.makedirs(os.path.dirname(fn))
-            except OSError:
-                pass
-
-            # Avoid upsampling, except for VBR and normalization
-            if (
-                fn_ext[1:] == transcoder.output_format.name
-                and not new_self.converter_id.norm
-                and "-q:a" not in transcoder.command
-                and (
-                    not new_self.converter_id.bitrate
-                    or new_self.converter_id.bitrate >= new_self.track_id.bitrate
-                )
-            ):
-                copyfile(new_self.track_id.path, fn)
-            else:
-                outdata = transcoder.transcode(
-                    new_self.track_id.id,
-                    bitrate=new_self.converter_id.bitrate,
-                    norm=new_self.converter_id.norm,
-                ).stdout
-                fn_out = fn_base + "." + transcoder.output_format.name
-                with open(fn_out + ".tmp", "wb") as outfile:
-                    for d in outdata:
+                with open(tmp_path, "wb") as outfile:
+                    for d in output:
                         outfile.write(d)
-                move(fn_out + ".tmp", fn_out)
-            # In 'test_mode', the instanciation of a new registry fails on 'threading.RLock()'. We
-            # skip the state update.
-            if not self.env.context.get("test_mode"):
-                new_self.write({"state": "done"})
+            finally:
+                output.close()
+            if not output.complete:
+                os.remove(tmp_path)
+                raise UserError(_('Transcoding of "%s" failed.') % self.track_id.path)
+        move(tmp_path, fn_out)
+
+        # The conversion is recorded once its output is in place. Otherwise, the next incremental
+        # runs would skip a broken file.
+        if self.converter_id.incremental:
+            manifest.add(file, self.converter_id.id, signature)
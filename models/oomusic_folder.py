@@ -5,7 +5,9 @@ import imghdr
 import json
 import logging
 import os
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime as dt
+from multiprocessing import cpu_count
 from random import sample
 
 from dateutil.relativedelta import relativedelta
@@ -16,6 +18,8 @@ from psycopg2 import OperationalError
 from odoo import _, api, fields, models, tools
 from odoo.exceptions import UserError
 
+from .oomusic_folder_watch import start_watcher
+
 _logger = logging.getLogger(__name__)
 
 
@@ -33,9 +37,32 @@ class MusicFolder(models.Model):
         help="Exclude this folder from the automatized scheduled scan. Useful if the folder is not "
         "always accessible, e.g. linked to an external drive.",
     )
+    watch = fields.Boolean(
+        "Watch Changes",
+        default=False,
+        help="Detect the changes in the folder as they happen, so new music appears within "
+        "seconds. The folder is then excluded from the automatized scheduled scan, unless watching "
+        "is not possible. Requires the Python library inotify_simple, and might require increasing "
+        "the system limit fs.inotify.max_user_watches for large libraries.",
+    )
+    last_watch = fields.Datetime("Last Watched", readonly=True)
     last_scan = fields.Datetime("Last Scanned")
     last_scan_duration = fields.Integer("Scan Duration (s)")
+    last_scan_walk = fields.Integer(
+        "Last Walk",
+        readonly=True,
+        help="Time at which the last complete scan listed the directories. The directories not "
+        "modified since then are not listed again by the next scans.",
+    )
     last_commit = fields.Datetime("Last Commit")
+    scan_checkpoint = fields.Char(
+        "Scan Checkpoint",
+        readonly=True,
+        help="Last directory completely scanned by an interrupted scan. The next scan resumes after "
+        "this directory.",
+    )
+    scan_checkpoint_tracks = fields.Integer("Scanned Tracks At Checkpoint", readonly=True)
+    scan_checkpoint_duration = fields.Integer("Scan Duration At Checkpoint (s)", readonly=True)
     parent_id = fields.Many2one(
         "oomusic.folder", string="Parent Folder", index=True, ondelete="cascade"
     )
@@ -57,11 +84,26 @@ class MusicFolder(models.Model):
     )
     use_tags = fields.Boolean("Use ID3 Tags", default=True)
     tag_analysis = fields.Selection(
-        [("taglib", "Taglib"), ("mutagen", "Mutagen")],
+        [("taglib", "Taglib"), ("mutagen", "Mutagen"), ("fast", "Fast (headers only)")],
         "File Analysis",
         default="taglib",
         required=True,
-        help="Choose Mutagen for better compatibility with remote mounting points, such as rclone.",
+        help="Choose Mutagen for better compatibility with remote mounting points, such as rclone. "
+        "The fast analysis only reads the tag headers of MP3, FLAC, Ogg and MP4 files, without "
+        "decoding the pictures, and uses Mutagen for the other formats.",
+    )
+    scan_mode = fields.Selection(
+        [("serial", "Serial"), ("parallel", "Parallel")],
+        "Scan Mode",
+        default="serial",
+        required=True,
+        help="In parallel mode, the files are read by several processes. This speeds up the scan "
+        "of large libraries, especially the first one.",
+    )
+    scan_workers = fields.Integer(
+        "Scan Workers",
+        default=lambda self: cpu_count(),
+        help="Number of processes reading the files in parallel mode.",
     )
 
     path_name = fields.Char("Folder Name", compute="_compute_path_name")
@@ -78,6 +120,14 @@ class MusicFolder(models.Model):
     root_total_tracks = fields.Integer("Total Tracks", compute="_compute_root_total")
     root_total_duration = fields.Integer("Total Duration", compute="_compute_root_total")
     root_total_size = fields.Integer("Total Size", compute="_compute_root_total")
+    scan_log_ids = fields.One2many("oomusic.folder.scan.log", "folder_id", "Scan Logs")
+    scan_progress = fields.Float("Scan Progress", compute="_compute_scan_progress")
+    quarantine_ids = fields.One2many(
+        "oomusic.folder.quarantine",
+        "folder_id",
+        "Unreadable Files",
+        help="Files which could not be read. They are not read again until they are modified.",
+    )
 
     image_folder = fields.Binary(
         "Folder Image",
@@ -123,6 +173,12 @@ class MusicFolder(models.Model):
         ("oomusic_folder_path_uniq", "unique(path, user_id)", "Folder path must be unique!")
     ]
 
+    def init(self):
+        # Used by the scanner to select the sub-folders of a path with a prefix condition
+        tools.create_index(
+            self._cr, "oomusic_folder_path_prefix_index", self._table, ["path varchar_pattern_ops"]
+        )
+
     @api.depends("path")
     def _compute_path_name(self):
         for folder in self:
@@ -133,7 +189,7 @@ class MusicFolder(models.Model):
 
     @api.depends("path")
     def _compute_root_preview(self):
-        ALLOWED_FILE_EXTENSIONS = self.env["oomusic.folder.scan"].ALLOWED_FILE_EXTENSIONS
+        FolderScan = self.env["oomusic.folder.scan"]
         time_start = dt.now()
         for folder in self:
             if not folder.root or not folder.path:
@@ -141,14 +197,9 @@ class MusicFolder(models.Model):
                 continue
             i = 0
             fn_paths = ""
-            for rootdir, dirnames, filenames in os.walk(folder.path):
+            for rootdir, mtime, files in FolderScan._walk(folder.path):
                 ii = 0
-                for fn in filenames:
-                    # Check file extension
-                    fn_ext = fn.split(".")[-1]
-                    if fn_ext and fn_ext.lower() not in ALLOWED_FILE_EXTENSIONS:
-                        continue
-
+                for fn, fn_mtime, fn_size in files:
                     fn_paths += "{}\n".format(os.path.join(rootdir.replace(folder.path, ""), fn))
                     i += 1
                     ii += 1
@@ -161,6 +212,13 @@ class MusicFolder(models.Model):
                 fn_paths = _("No track found")
             folder.root_preview = fn_paths
 
+    def _compute_scan_progress(self):
+        for folder in self:
+            log = self.env["oomusic.folder.scan.log"].search(
+                [("folder_id", "=", folder.id), ("state", "=", "running")], limit=1
+            )
+            folder.scan_progress = log.progress
+
     def _compute_root_total(self):
         folder_sharing = (
             "inactive" if self.env.ref("oomusic.oomusic_track").sudo().perm_read else "active"
@@ -425,6 +483,14 @@ class MusicFolder(models.Model):
             # Set the last modification date to zero so we force scanning all folders and files
             folders = self.env["oomusic.folder"].search([("id", "child_of", folder_id)]) | self
             folders.sudo().write({"last_modification": 0})
+            self.sudo().write(
+                {
+                    "last_scan_walk": 0,
+                    "scan_checkpoint": False,
+                    "scan_checkpoint_tracks": 0,
+                    "scan_checkpoint_duration": 0,
+                }
+            )
             tracks = self.env["oomusic.track"].search([("root_folder_id", "=", folder_id)])
             tracks.sudo().write({"last_modification": 0})
             self.env.cr.commit()
@@ -435,16 +501,48 @@ class MusicFolder(models.Model):
 
     @api.model
     def cron_scan_folder(self):
-        for folder in self.search([("root", "=", True), ("exclude_autoscan", "=", False)]):
-            try:
-                self.env["oomusic.folder.scan"]._scan_folder(folder.id)
-            except:
-                _logger.exception(
-                    'Error while scanning folder "%s" (id: %s)',
-                    folder.path,
-                    folder.id,
-                    exc_info=True,
-                )
+        # Folders actively watched do not need to be walked. The watcher records the watched folders
+        # every minute.
+        watch_limit = dt.now() - relativedelta(seconds=300)
+        folders = self.search([("root", "=", True), ("exclude_autoscan", "=", False)]).filtered(
+            lambda f: not (f.watch and f.last_watch and f.last_watch > watch_limit)
+        )
+
+        # Several folders can be scanned concurrently, which is mostly useful if they are located
+        # on different disks. Each scan uses its own cursor.
+        concurrency = int(
+            self.env["ir.config_parameter"].sudo().get_param("oomusic.scan_concurrency", 1)
+        )
+        if concurrency <= 1 or len(folders) <= 1:
+            for folder in folders:
+                self._cron_scan_folder(folder.id, folder.path)
+            return
+        folder_data = [(folder.id, folder.path) for folder in folders]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for folder_id, path in folder_data:
+                executor.submit(self._cron_scan_folder, folder_id, path)
+
+    def _cron_scan_folder(self, folder_id, path):
+        try:
+            self.env["oomusic.folder.scan"]._scan_folder(folder_id)
+        except:
+            _logger.exception(
+                'Error while scanning folder "%s" (id: %s)',
+                path,
+                folder_id,
+                exc_info=True,
+            )
+
+    @api.model
+    def cron_watch_folder(self):
+        # Make sure the watcher is running if some folders need to be watched
+        if not self.search([("root", "=", True), ("watch", "=", True)], limit=1):
+            return
+        if not start_watcher(self.env.cr.dbname):
+            _logger.warning(
+                "Cannot watch folders since the Python library inotify_simple is not installed. "
+                "Falling back to scheduled scan."
+            )
 
     @api.model
     def cron_build_image_cache(self):
@@ -464,6 +562,8 @@ class MusicFolder(models.Model):
 
     @api.model
     def cron_unlock_folder(self):
+        self.env["oomusic.folder.scan.log"]._clean_logs()
+
         domain = [
             ("root", "=", True),
             ("locked", "=", True),
@@ -475,6 +575,22 @@ class MusicFolder(models.Model):
                 "The following folders seem locked for no reason: %s. Unlocking.", folders.ids
             )
             folders.action_unlock()
+            self.env["oomusic.folder.scan.log"].search(
+                [("folder_id", "in", folders.ids), ("state", "=", "running")]
+            ).write({"state": "failed", "date_end": fields.Datetime.now()})
+            self.env.cr.commit()
+
+            # Resume the interrupted scans
+            for folder in folders.filtered(lambda f: f.scan_checkpoint and not f.exclude_autoscan):
+                try:
+                    self.env["oomusic.folder.scan"]._scan_folder(folder.id)
+                except:
+                    _logger.exception(
+                        'Error while resuming scan of folder "%s" (id: %s)',
+                        folder.path,
+                        folder.id,
+                        exc_info=True,
+                    )
 
     def action_add_to_playlist(self):
         playlist = self.env["oomusic.playlist"].search([("current", "=", True)], limit=1)
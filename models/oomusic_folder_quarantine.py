@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import os
+
+from odoo import fields, models
+
+
+class MusicFolderQuarantine(models.Model):
+    _name = "oomusic.folder.quarantine"
+    _description = "Music Folder Unreadable File"
+    _order = "path"
+
+    folder_id = fields.Many2one(
+        "oomusic.folder", "Folder", required=True, index=True, ondelete="cascade"
+    )
+    user_id = fields.Many2one(
+        "res.users", related="folder_id.user_id", store=True, index=True, related_sudo=False
+    )
+    path = fields.Char("Path", required=True, readonly=True, index=True)
+    last_modification = fields.Integer("Last Modification", readonly=True)
+    # Float, since the size of a file might not fit in an integer column
+    size = fields.Float("Size (bytes)", readonly=True)
+    error = fields.Char("Error", readonly=True)
+    date = fields.Datetime("Last Failure", readonly=True)
+    failure_count = fields.Integer("Failures", readonly=True, default=1)
+
+    _sql_constraints = [
+        (
+            "oomusic_folder_quarantine_path_uniq",
+            "unique(folder_id, path)",
+            "File path must be unique!",
+        )
+    ]
+
+    def action_retry(self):
+        """
+        Remove the files from the quarantine. Their directories are marked as modified, so the files
+        are read again at the next scan.
+        """
+        folder_paths = {os.path.dirname(q.path) for q in self}
+        folders = self.env["oomusic.folder"].search(
+            [("path", "in", list(folder_paths)), ("user_id", "in", self.mapped("user_id").ids)]
+        )
+        folders.sudo().write({"last_modification": 0})
+        self.sudo().unlink()
@@ -4,13 +4,20 @@ import locale
 import logging
 import os
 import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime as dt
+from hashlib import sha1
 
 import mutagen
 from mutagen.easyid3 import EasyID3
 
 from odoo import api, fields, models
 
+from .oomusic_tag_reader import read_tags
+
 # Pytaglib and Mutagen are supported for tag reading. Pytaglib is preferred as it seems less likely
 # to send an exception in case of incorrect file.
 try:
@@ -21,6 +28,130 @@ except ImportError:
 
 _logger = logging.getLogger(__name__)
 
+# Number of bytes read at the beginning and at the end of a file to compute its fingerprint
+FINGERPRINT_SIZE = 16384
+
+
+def _get_fingerprint(file_path):
+    """
+    Compute a cheap fingerprint of a file, based on its size and its first and last bytes. It
+    allows recognizing a file which has been moved or renamed, without reading it entirely.
+
+    :param str file_path: path of the file
+    :return str: fingerprint of the file, or False in case of error
+    """
+    try:
+        with open(file_path, "rb") as f:
+            return _fingerprint_file(f)
+    except OSError:
+        _logger.warning('Error while computing fingerprint of "%s"', file_path, exc_info=True)
+        return False
+
+
+def _fingerprint_file(f):
+    """
+    Compute the fingerprint of a file already open, see `_get_fingerprint`.
+
+    :param f: file opened in binary mode
+    :return str: fingerprint of the file
+    """
+    size = os.fstat(f.fileno()).st_size
+    fingerprint = sha1(str(size).encode("utf-8"))
+    f.seek(0)
+    fingerprint.update(f.read(FINGERPRINT_SIZE))
+    if size > 2 * FINGERPRINT_SIZE:
+        f.seek(-FINGERPRINT_SIZE, os.SEEK_END)
+    fingerprint.update(f.read(FINGERPRINT_SIZE))
+    return fingerprint.hexdigest()
+
+
+def _walk_key(path):
+    """
+    Key to compare paths in the order of `_walk`: a directory comes before its sub-directories,
+    which come before its next sibling.
+
+    :param str path: path of a directory
+    :return list: key of the path
+    """
+    return path.split(os.sep)
+
+
+def _like_prefix(path):
+    """
+    Pattern matching the paths located in a directory with a LIKE condition. The special
+    characters of the path are escaped.
+
+    :param str path: path of a directory
+    :return str: pattern of the sub-paths
+    """
+    return path.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + os.sep + "%"
+
+
+def _read_file(file_path, tag_name, keys):
+    """
+    Read the tags and the audio properties of a file. This function might be executed in a
+    separate process when the scan is parallelized. Therefore, it only relies on its arguments and
+    returns picklable data.
+
+    :param str file_path: path of the file to read
+    :param str tag_name: library used to read the file, "taglib", "mutagen" or "fast". The fast
+        reader falls back to Mutagen for the formats it does not support.
+    :param set keys: tags to return, others are dropped
+    :return dict: tags, duration, bitrate and fingerprint of the file. In case of error, only the
+        error message is returned, in the key "error".
+    """
+    _logger.debug('Scanning file "%s"', file_path)
+    if tag_name == "fast":
+        # The file is opened once, for both the tags and the fingerprint
+        try:
+            with open(file_path, "rb") as f:
+                res = read_tags(f)
+                if res:
+                    res += (_fingerprint_file(f),)
+        except Exception:
+            _logger.debug('Fast tag reading failed for "%s"', file_path, exc_info=True)
+            res = None
+        if res:
+            song_tags, duration, bitrate, fingerprint = res
+            return {
+                "tags": {k: v for k, v in song_tags.items() if k in keys},
+                "duration": duration,
+                "bitrate": bitrate,
+                "fingerprint": fingerprint,
+            }
+
+    tag = taglib if tag_name == "taglib" and taglib else mutagen
+    try:
+        song = tag.File(file_path)
+        if not song:
+            raise ValueError("Unsupported file format")
+    except Exception as e:
+        _logger.warning('Error while opening file "%s"', file_path, exc_info=True)
+        return {"error": str(e) or e.__class__.__name__}
+    if tag.__name__ == "taglib":
+        song_tags = song.tags
+        duration = song.length
+        bitrate = song.bitrate
+    else:
+        try:
+            song_tags = EasyID3(file_path) or {}
+        except:
+            song_tags = song.tags or {}
+
+        song_tags = {k.upper(): v for k, v in song_tags.items()}
+        duration = int(song.info.length)
+        # 'bitrate' is not available for all file types
+        if hasattr(song.info, "bitrate"):
+            bitrate = round((song.info.bitrate or 0) / 1000.0)
+        else:
+            bitrate = 0
+    return {
+        "tags": {k: v for k, v in song_tags.items() if k in keys},
+        "duration": duration,
+        "bitrate": bitrate,
+        "fingerprint": _get_fingerprint(file_path),
+    }
+
 
 class MusicFolderScan(models.TransientModel):
     _name = "oomusic.folder.scan"
@@ -78,6 +209,140 @@ class MusicFolderScan(models.TransientModel):
         "TRACKTOTAL": "track_total",
     }
 
+    # Number of files queued per worker when the scan is parallelized. It keeps the workers busy
+    # while the main process writes in the database, without reading the whole tree in advance.
+    SCAN_QUEUE_SIZE = 8
+
+    # Number of tracks written at once in the database
+    TRACK_BATCH_SIZE = 500
+
+    # Maximum number of tracks without fingerprint fingerprinted by a complete scan
+    FINGERPRINT_BACKFILL_SIZE = 5000
+
+    # Minimal delay (s) between two notifications of the scan progress
+    SCAN_PROGRESS_DELAY = 2
+
+    # Margin (s) before the last walk of a folder, during which a directory must not have been
+    # modified to be skipped by the next walks
+    WALK_PRUNE_MARGIN = 60
+
+    @contextmanager
+    def _lock_user_keys(self, user_id, keys):
+        """
+        Lock keys of a user with PostgreSQL advisory locks, so that concurrent scans of different
+        root folders do not conflict. The current transaction is committed before, and the locked
+        section starts a new transaction, which sees the data committed by the scans which held
+        the locks previously. This transaction is committed before the locks are released.
+
+        In test mode, there is no concurrent scan and nothing is done.
+
+        :param int user_id: ID of the user to whom belongs the folder
+        :param list keys: strings to lock, e.g. names of artists
+        """
+        if self.env.context.get("test_mode"):
+            yield
+            return
+
+        cr = self.env.cr
+        self.flush()
+        cr.commit()
+        # The locks are taken in a consistent order, which prevents deadlocks between scans
+        cr.execute(
+            """
+            SELECT pg_advisory_lock(%s, k)
+            FROM (SELECT DISTINCT hashtext(n) AS k FROM unnest(%s::varchar[]) AS n ORDER BY k) AS l;
+            """,
+            (user_id, list(keys)),
+        )
+        # The snapshot of the transaction was taken before the locks were acquired
+        cr.commit()
+        self.invalidate_cache()
+        try:
+            yield
+            self.flush()
+            cr.commit()
+        except Exception:
+            cr.rollback()
+            raise
+        finally:
+            cr.execute(
+                "SELECT pg_advisory_unlock(%s, hashtext(n)) FROM unnest(%s::varchar[]) AS n;",
+                (user_id, list(set(keys))),
+            )
+            cr.commit()
+
+    @contextmanager
+    def _timer(self, stats, key):
+        """
+        Add the time spent in the block to a statistic of the scan.
+
+        :param dict stats: statistics of the scan
+        :param str key: statistic to increase
+        """
+        time_start = time.time()
+        try:
+            yield
+        finally:
+            stats[key] += time.time() - time_start
+
+    def _timed(self, iterable, stats, key):
+        """
+        Yield the items of an iterable, adding the time spent waiting for them to a statistic of
+        the scan.
+
+        :param iterable: iterable to go through
+        :param dict stats: statistics of the scan
+        :param str key: statistic to increase
+        """
+        it = iter(iterable)
+        while True:
+            with self._timer(stats, key):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            yield item
+
+    def _create_scan_log(self, Folder, partial=False):
+        """
+        Create the log of a scan. Outside of the tests, the log is written in a separate
+        transaction, so the progress of the scan is visible while it is ongoing.
+
+        :param Folder: root folder to scan
+        :param bool partial: only some directories of the folder are scanned
+        :return int: ID of the log
+        """
+        vals = {"folder_id": Folder.id, "date_start": fields.Datetime.now(), "partial": partial}
+        if self.env.context.get("test_mode"):
+            return self.env["oomusic.folder.scan.log"].sudo().create(vals).id
+        with self.pool.cursor() as cr:
+            return self.env(cr=cr)["oomusic.folder.scan.log"].sudo().create(vals).id
+
+    def _write_scan_log(self, log_id, vals):
+        """
+        Write the statistics of a scan in its log, and notify the progress on the bus. Same
+        remarks as `_create_scan_log` regarding the transaction.
+
+        :param int log_id: ID of the log
+        :param dict vals: values to write
+        """
+
+        def _write(env):
+            log = env["oomusic.folder.scan.log"].sudo().browse(log_id).exists()
+            if not log:
+                return
+            log.write(vals)
+            env["bus.bus"].sendone(
+                (env.cr.dbname, "oomusic.folder.scan", log.user_id.id),
+                {"folder_id": log.folder_id.id, "state": log.state, "progress": log.progress},
+            )
+
+        if self.env.context.get("test_mode"):
+            _write(self.env)
+            return
+        with self.pool.cursor() as cr:
+            _write(self.env(cr=cr))
+
     def _lock_folder(self, folder_id):
         """
         Check if a folder is locked. If it is not locked, lock it. If it is locked, log an error.
@@ -86,14 +351,15 @@ class MusicFolderScan(models.TransientModel):
         :return bool: False if the folder was already locked, True if it was not
         """
         Folder = self.env["oomusic.folder"].browse([folder_id])
-        if Folder.locked:
-            _logger.error('"%s" is locked! It probably means that a scan is ongoing.', Folder.path)
-            res = False
-        else:
-            Folder.write({"last_commit": dt.now(), "locked": True})
-            res = True
-
-        self.env.cr.commit()
+        with self._lock_user_keys(Folder.user_id.id, [self._name]):
+            if Folder.locked:
+                _logger.error(
+                    '"%s" is locked! It probably means that a scan is ongoing.', Folder.path
+                )
+                res = False
+            else:
+                Folder.write({"last_commit": dt.now(), "locked": True})
+                res = True
         return res
 
     def _commit_or_flush(self):
@@ -110,7 +376,240 @@ class MusicFolderScan(models.TransientModel):
             ]:
                 self.env[model].flush()
 
-    def _clean_directory(self, path, user_id):
+    def _walk(self, top, after=None, known=None, failed=None, recursive=True):
+        """
+        Walk in all sub-directories of a folder, top-down and in alphabetical order. It is similar
+        to `os.walk`, but relies on `os.scandir` so the modification date and size of every entry
+        are obtained with a single stat. This matters on network mounting points, where each stat
+        is a round trip. As `os.walk`, symbolic links to directories are not followed and errors
+        are ignored.
+
+        If `after` is given, the sub-directories located entirely before this directory in the
+        walking order are not listed. It allows resuming an interrupted scan.
+
+        If `known` is given, the directories whose modification date did not change are not listed:
+        their files and sub-directories are taken from there, so only the sub-directories are
+        stat'ed.
+
+        A directory which cannot be listed, or whose entries cannot all be stat'ed, is added to
+        `failed`. Its content is partially or not at all in the tree, so it must not be cleaned. A
+        directory or a file which does not exist anymore, such as a dangling symbolic link, is
+        simply skipped.
+
+        If `recursive` is False, only the files of the folder are listed. Its sub-directories are
+        added to `failed` as well, since their content is not in the tree either.
+
+        :param str top: path of the folder to walk
+        :param str after: path of a directory
+        :param dict known: result of `_get_walk_known` on the folder
+        :param set failed: filled with the directories which could not be listed entirely
+        :param bool recursive: walk in the sub-directories
+        :return: generator of tuples (rootdir, mtime, files), where files is a list of tuples
+            (fn, mtime, size) restricted to the allowed file extensions
+        """
+        if failed is None:
+            failed = set()
+        try:
+            stack = [(top, int(os.stat(top).st_mtime))]
+        except FileNotFoundError:
+            return
+        except OSError:
+            _logger.warning('Cannot access folder "%s"', top, exc_info=True)
+            failed.add(top)
+            return
+        after_key = _walk_key(after) if after else None
+        while stack:
+            rootdir, mtime = stack.pop()
+            dirs = []
+            files = []
+            if known and rootdir in known and known[rootdir][0] >= mtime:
+                for path in known[rootdir][1]:
+                    if after_key and self._is_walked_before(path, after, after_key):
+                        continue
+                    try:
+                        dirs.append((path, int(os.stat(path).st_mtime)))
+                    except FileNotFoundError:
+                        continue
+                    except OSError:
+                        _logger.warning('Cannot access folder "%s"', path, exc_info=True)
+                        failed.add(path)
+                yield rootdir, mtime, known[rootdir][2]
+                if not recursive:
+                    failed.update(d[0] for d in dirs)
+                    return
+                stack += sorted(dirs, reverse=True)
+                continue
+            try:
+                with os.scandir(rootdir) as it:
+                    for entry in it:
+                        try:
+                            self._walk_entry(entry, after, after_key, dirs, files)
+                        except FileNotFoundError:
+                            continue
+                        except OSError:
+                            _logger.warning('Cannot access "%s"', entry.path, exc_info=True)
+                            failed.add(rootdir)
+            except FileNotFoundError:
+                continue
+            except OSError:
+                _logger.warning('Cannot access folder "%s"', rootdir, exc_info=True)
+                failed.add(rootdir)
+                continue
+            files.sort()
+            yield rootdir, mtime, files
+            if not recursive:
+                failed.update(d[0] for d in dirs)
+                return
+            stack += sorted(dirs, reverse=True)
+
+    def _walk_entry(self, entry, after, after_key, dirs, files):
+        # Add an entry of a directory listed by `_walk` to its sub-directories or its files
+        if entry.is_dir():
+            if after_key and self._is_walked_before(entry.path, after, after_key):
+                return
+            if not entry.is_symlink():
+                dirs.append((entry.path, int(entry.stat().st_mtime)))
+            return
+        fn_ext = entry.name.split(".")[-1]
+        if fn_ext and fn_ext.lower() in self.ALLOWED_FILE_EXTENSIONS:
+            stat = entry.stat()
+            files.append((entry.name, int(stat.st_mtime), stat.st_size))
+
+    def _get_walk_known(self, path, user_id, walk_date):
+        """
+        Get the directories of a folder which can be skipped by `_walk`, with their content as
+        recorded in the database. A directory is skipped if its modification date did not change.
+        Since the modification dates are rounded to the second, only the directories modified some
+        time before the last walk are trusted. The margin also covers small clock differences with
+        network file systems.
+
+        :param str path: path of the folder
+        :param int user_id: ID of the user to whom belongs the folder
+        :param int walk_date: timestamp of the last complete walk of the folder
+        :return dict: tuples (mtime, dirs, files) by path of directory, where dirs are the paths of
+            the sub-directories and files is in the format of `_walk`
+        """
+        prefix = _like_prefix(path)
+        query = """
+            SELECT path, last_modification FROM oomusic_folder
+            WHERE user_id = %s AND (path = %s OR path LIKE %s);
+        """
+        self.env.cr.execute(query, (user_id, path, prefix))
+        folders = self.env.cr.fetchall()
+        known = {
+            r[0]: (r[1], [], [])
+            for r in folders
+            if r[1] and r[1] < walk_date - self.WALK_PRUNE_MARGIN
+        }
+        if not known:
+            return known
+        for folder_path, mtime in folders:
+            parent = os.path.dirname(folder_path)
+            if folder_path != path and parent in known:
+                known[parent][1].append(folder_path)
+
+        # The size of the tracks is recorded in MiB, the one of the quarantined files in bytes. The
+        # latter come last, since a track might be quarantined after a modification.
+        files = {}
+        query = """
+            SELECT path, last_modification, round(size * 1048576)
+            FROM oomusic_track WHERE user_id = %s AND path LIKE %s;
+        """
+        self.env.cr.execute(query, (user_id, prefix))
+        files.update({r[0]: r[1:] for r in self.env.cr.fetchall()})
+        query = """
+            SELECT path, last_modification, size
+            FROM oomusic_folder_quarantine WHERE user_id = %s AND path LIKE %s;
+        """
+        self.env.cr.execute(query, (user_id, prefix))
+        files.update({r[0]: r[1:] for r in self.env.cr.fetchall()})
+        for fn_path, (mtime, size) in files.items():
+            rootdir, fn = os.path.split(fn_path)
+            if rootdir in known:
+                known[rootdir][2].append((fn, mtime or 0, int(size or 0)))
+        for mtime, dirs, dir_files in known.values():
+            dir_files.sort()
+        return known
+
+    def _is_walked_before(self, path, after, after_key=None):
+        """
+        Check if a directory and all its sub-directories are walked before another directory.
+
+        :param str path: path of the directory
+        :param str after: path of the other directory
+        :param list after_key: result of `_walk_key` on `after`, if already available
+        :return bool: True if the whole directory is walked before
+        """
+        return _walk_key(path) < (after_key or _walk_key(after)) and not after.startswith(
+            path + os.sep
+        )
+
+    def _find_missing_paths(self, path, user_id, tree=None, after=None, failed=None):
+        """
+        Find the folders, tracks and unreadable files located in a directory which are not on the
+        disk anymore. The paths found on the disk are anti-joined with the ones of the database,
+        restricted to the directory with a prefix condition.
+
+        :param str path: path of the directory
+        :param int user_id: ID of the user to whom belongs the folder
+        :param list tree: result of `_walk` on the path, if already available
+        :param str after: path of a directory. The records located before it in the walking order
+            are ignored, since they might not be part of the tree.
+        :param set failed: directories which could not be listed by `_walk`. The records located
+            in them or in their sub-directories are ignored.
+        :return list: tuples (model, ids) of the records to remove
+        """
+        # List existing directories and files
+        folderlist = []
+        filelist = []
+        if tree is None:
+            failed = set()
+            tree = self._walk(path, failed=failed)
+        for rootdir, mtime, files in tree:
+            folderlist.append(rootdir)
+            filelist += [os.path.join(rootdir, fn) for fn, fn_mtime, fn_size in files]
+
+        prefix = _like_prefix(path)
+
+        res = []
+        for table, paths in [
+            ("oomusic_folder", folderlist),
+            ("oomusic_track", filelist),
+            ("oomusic_folder_quarantine", filelist),
+        ]:
+            query = """
+                SELECT r.id, r.path
+                FROM {} AS r
+                LEFT JOIN unnest(%s::varchar[]) AS d(path) ON d.path = r.path
+                WHERE r.user_id = %s AND (r.path = %s OR r.path LIKE %s) AND d.path IS NULL;
+            """.format(
+                table
+            )
+            self.env.cr.execute(query, (paths, user_id, path, prefix))
+            to_clean = self.env.cr.fetchall()
+            if after:
+                after_key = _walk_key(after)
+                to_clean = [
+                    r
+                    for r in to_clean
+                    if _walk_key(r[1] if table == "oomusic_folder" else os.path.dirname(r[1]))
+                    > after_key
+                ]
+            if failed:
+                prefixes = tuple(f + os.sep for f in failed)
+                to_clean = [
+                    r
+                    for r in to_clean
+                    if not (
+                        r[1] in failed
+                        or r[1].startswith(prefixes)
+                        or (table != "oomusic_folder" and os.path.dirname(r[1]) in failed)
+                    )
+                ]
+            res.append((table.replace("_", "."), [r[0] for r in to_clean]))
+        return res
+
+    def _clean_directory(self, path, user_id, tree=None, after=None, failed=None):
         """
         Clean a directory. It removes folders and tracks which are not on the disk anymore. This
         can potentially deletes the folder linked to the given path if the path doesn't exist
@@ -118,87 +617,308 @@ class MusicFolderScan(models.TransientModel):
 
         :param str path: path of the folder to clean
         :param int user_id: ID of the user to whom belongs the folder
+        :param list tree: result of `_walk` on the path, if already available
+        :param str after: path of a directory. The records located before it in the walking order
+            are not cleaned.
+        :param set failed: directories which could not be listed by `_walk`. Their content is not
+            cleaned.
         """
         _logger.debug('Cleaning folder "%s"...', path)
 
-        # List existing directories and files
-        filelist = set(" ")
-        folderlist = set(" ")
-        for rootdir, dirnames, filenames in os.walk(path):
-            folderlist.add(rootdir)
-            for fn in filenames:
-                fn_ext = fn.split(".")[-1]
-                if fn_ext and fn_ext.lower() in self.ALLOWED_FILE_EXTENSIONS:
-                    filelist.add(os.path.join(rootdir, fn))
+        # The folders are removed first, which also removes their tracks. The records are unlinked
+        # with the ORM to keep the side effects of `unlink`.
+        for model, ids in self._find_missing_paths(
+            path, user_id, tree=tree, after=after, failed=failed
+        ):
+            to_clean = self.env[model].browse(ids).exists()
+            if to_clean:
+                to_clean.sudo().unlink()
 
-        track_data = [
-            (("id", "path"), "oomusic_folder", folderlist),
-            (("id", "path"), "oomusic_track", filelist),
-        ]
+    def _detect_moves(self, paths, tree, cache, after=None, tag_name=False, failed=None):
+        """
+        Detect the tracks which have been moved or renamed. A track which is not on the disk
+        anymore is matched with a new file having the same fingerprint. Only the new files having
+        the same size as a missing track are fingerprinted.
+
+        The tracks scanned before the fingerprints were introduced might not have one yet, see
+        `_backfill_fingerprints`. If a tag library is given, such a track is matched with a new
+        file having the same size, duration and tags. Only the new files having the same size are
+        read.
+
+        A file cannot be added to or removed from a directory without changing its modification
+        date. Therefore, only the tracks of the modified or removed directories are loaded.
+
+        The existing track is then updated instead of being deleted and created again, which keeps
+        its preferences and playlist lines. Its data is reused, so the file is not read.
+
+        :param list paths: directories being scanned
+        :param list tree: result of `_walk` on the paths
+        :param dict cache: reading cache, before the directories are scanned
+        :param str after: path of a directory. The directories located before it in the walking
+            order are ignored, since they might not be part of the tree. The next ones are
+            considered as modified, since their modification date might have been recorded before
+            their files.
+        :param str tag_name: library used to read the tags of the files, see `_read_file`. False
+            to only match the tracks by fingerprint.
+        :param set failed: directories which could not be listed by `_walk`. The tracks located
+            in them or in their sub-directories are not considered as missing.
+        :return dict: tuples (track_id, vals) of the moved tracks, by new path. `vals` is in the
+            same format as the data read from the file tags.
+        """
+        after_key = _walk_key(after) if after else None
+        files = {}
+        folder_ids = []
+        walked = set()
+        for rootdir, mtime, fn_list in tree:
+            walked.add(rootdir)
+            folder = cache["folder"].get(rootdir)
+            if folder and folder[1] >= mtime and not (after_key and _walk_key(rootdir) > after_key):
+                continue
+            if folder:
+                folder_ids.append(folder[0])
+            files.update({os.path.join(rootdir, fn): size for fn, fn_mtime, size in fn_list})
+        prefixes = tuple(p + os.sep for p in paths)
+        failed = failed or set()
+        failed_prefixes = tuple(f + os.sep for f in failed)
+        for path, folder in cache["folder"].items():
+            if (
+                path not in walked
+                and (path in paths or path.startswith(prefixes))
+                and (not after_key or _walk_key(path) > after_key)
+                and not (path in failed or path.startswith(failed_prefixes))
+            ):
+                folder_ids.append(folder[0])
+        if not files or not folder_ids:
+            return {}
 
-        # Cleaning part:
-        # - select existing paths in table
-        # - compare with paths actually used
-        # - deletes the ones which are not used anymore
-        for td in track_data:
-            field_list = ",".join([x for x in td[0]])
-            query = "SELECT " + field_list + " FROM " + td[1] + " WHERE user_id = " + str(user_id)
-            self.env.cr.execute(query)
-            res = self.env.cr.fetchall()
-            to_clean = {r[1] for r in res if path in r[1]} - td[2]
+        query = "SELECT id, path, size, fingerprint FROM oomusic_track WHERE folder_id IN %s;"
+        self.env.cr.execute(query, (tuple(folder_ids),))
+        known = set()
+        candidates = {}
+        unprinted = {}
+        for track_id, path, size, fingerprint in self.env.cr.fetchall():
+            known.add(path)
+            if path in files:
+                continue
+            size = round((size or 0.0) * 1024.0 * 1024.0)
+            if fingerprint:
+                candidates.setdefault(size, {})[fingerprint] = track_id
+            elif tag_name:
+                unprinted.setdefault(size, []).append(track_id)
+
+        moves = {}
+        unprinted_files = []
+        for fn_path, size in files.items():
+            if fn_path in known:
+                continue
+            if candidates.get(size):
+                track_id = candidates[size].pop(_get_fingerprint(fn_path), False)
+                if track_id:
+                    moves[track_id] = fn_path
+                    continue
+            if unprinted.get(size):
+                unprinted_files.append((fn_path, size))
+
+        res = {}
+        if unprinted_files:
+            res.update(self._detect_moves_by_tags(unprinted, unprinted_files, tag_name))
+        if moves:
+            for track_id, vals in self._get_moved_tracks_vals(list(moves.keys())).items():
+                res[moves[track_id]] = (track_id, vals)
+        _logger.debug("%s moved tracks detected", len(res))
+        return res
 
-            if to_clean:
-                to_clean = {r[1]: r[0] for r in res if r[1] in to_clean}.values()
-                self.env[td[1].replace("_", ".")].browse(to_clean).sudo().unlink()
+    def _detect_moves_by_tags(self, candidates, files, tag_name):
+        """
+        Match the missing tracks without fingerprint with new files, on their size, duration and
+        tags. See `_detect_moves`.
 
-    def _clean_tags(self, user_id):
+        :param dict candidates: IDs of the missing tracks, by size in bytes
+        :param list files: tuples (path, size) of the new files having the size of a candidate
+        :param str tag_name: library used to read the tags of the files
+        :return dict: tuples (track_id, vals) of the moved tracks, by new path
         """
-        Clean tags. It remove artists, albums, genres and playlist lines not listed in tracks
-        anymore.
+        vals_by_id = self._get_moved_tracks_vals([i for ids in candidates.values() for i in ids])
+        keys = set(self.MAP_ID3_FIELD.keys())
+        res = {}
+        for fn_path, size in files:
+            data = _read_file(fn_path, tag_name, keys)
+            if "error" in data:
+                continue
+            tags = {self.MAP_ID3_FIELD[k]: v[0] for k, v in data["tags"].items() if v and k in keys}
+            # Without title tag, the name of the track is the file name, which might have changed
+            fnames = ["artist_id", "album_id", "track_number"] + (
+                ["name"] if tags.get("name") else []
+            )
+            for track_id in candidates[size]:
+                vals = vals_by_id.get(track_id)
+                if (
+                    vals
+                    and vals["duration"] == data["duration"]
+                    and all((vals[f] or "") == (tags.get(f) or "") for f in fnames)
+                ):
+                    candidates[size].remove(track_id)
+                    vals["fingerprint"] = data["fingerprint"]
+                    res[fn_path] = (track_id, vals)
+                    break
+        return res
 
-        :param int user_id: ID of the user to whom belongs the folder
+    def _get_moved_tracks_vals(self, track_ids):
         """
-        _logger.debug('Cleaning tags for user_id "%s"...', user_id)
+        Fetch the data of moved tracks, with the names of the related records.
+
+        :param list track_ids: IDs of the tracks
+        :return dict: data in the same format as the data read from the file tags, by track ID
+        """
+        related = {
+            "album_id": "oomusic_album",
+            "album_artist_id": "oomusic_artist",
+            "artist_id": "oomusic_artist",
+            "genre_id": "oomusic_genre",
+            "performer_id": "oomusic_artist",
+        }
+        fnames = sorted(self.FIELDS_TO_CLEAN - set(related.keys())) + [
+            "duration",
+            "bitrate",
+            "fingerprint",
+        ]
+        query = "SELECT t.id, {}, {} FROM oomusic_track AS t {} WHERE t.id IN %s;".format(
+            ", ".join(["{}.name".format(f) for f in related.keys()]),
+            ", ".join(["t.{}".format(f) for f in fnames]),
+            " ".join(
+                ["LEFT JOIN {1} AS {0} ON {0}.id = t.{0}".format(f, t) for f, t in related.items()]
+            ),
+        )
+        self.env.cr.execute(query, (tuple(track_ids),))
+        res = {}
+        for r in self.env.cr.fetchall():
+            vals = {f: r[1 + i] or False for i, f in enumerate(related.keys())}
+            vals.update({f: r[1 + len(related) + i] for i, f in enumerate(fnames)})
+            vals.update({f: vals[f] or "" for f in self.FIELDS_TO_CLEAN - set(related.keys())})
+            res[r[0]] = vals
+        return res
 
-        # Select relevant data from oomusic tracks
-        params = (user_id,)
+    def _backfill_fingerprints(self, folder_id, limit):
+        """
+        Compute the fingerprint of the tracks which do not have one, because they were scanned
+        before the fingerprints were introduced. Their files are not modified, so the scan does not
+        read them. At most `limit` tracks are fingerprinted by scan, so the first scans after an
+        upgrade do not read the whole library. A file which cannot be read gets an empty
+        fingerprint, so it is not tried again.
+
+        :param int folder_id: ID of the root folder
+        :param int limit: maximum number of tracks to fingerprint
+        :return int: number of tracks fingerprinted
+        """
         query = """
-        SELECT artist_id, album_artist_id, performer_id, album_id, genre_id, id
-            FROM oomusic_track
-            WHERE user_id = %s;
+            SELECT id, path FROM oomusic_track
+            WHERE root_folder_id = %s AND fingerprint IS NULL
+            ORDER BY id LIMIT %s;
         """
+        self.env.cr.execute(query, (folder_id, limit))
+        params = []
+        for track_id, path in self.env.cr.fetchall():
+            params += [track_id, _get_fingerprint(path) or ""]
+        if not params:
+            return 0
+        query = """
+            UPDATE oomusic_track AS t SET fingerprint = v.fingerprint
+            FROM (VALUES {}) AS v(id, fingerprint)
+            WHERE t.id = v.id;
+        """.format(
+            ", ".join(["(%s::integer, %s::varchar)"] * (len(params) // 2))
+        )
         self.env.cr.execute(query, params)
-        res = self.env.cr.fetchall()
-        artist_track = {r[0] for r in res} | {r[1] for r in res} | {r[2] for r in res}
-        album_track = {r[3] for r in res}
-        genre_track = {r[4] for r in res}
-        track_id_track = {r[5] for r in res}
+        return len(params) // 2
+
+    def _find_orphan_tags(self, user_id):
+        """
+        Find the artists, albums, genres and playlist lines not listed in tracks anymore. Each
+        table is anti-joined with the tracks of the user.
 
+        :param int user_id: ID of the user to whom belongs the folder
+        :return list: tuples (model, ids) of the records to remove
+        """
         track_data = [
-            ("id", "oomusic_artist", artist_track),
-            ("id", "oomusic_album", album_track),
-            ("id", "oomusic_genre", genre_track),
-            ("track_id", "oomusic_playlist_line", track_id_track),
+            ("oomusic_artist", "id", ("artist_id", "album_artist_id", "performer_id")),
+            ("oomusic_album", "id", ("album_id",)),
+            ("oomusic_genre", "id", ("genre_id",)),
+            ("oomusic_playlist_line", "track_id", ("id",)),
         ]
 
-        # Cleaning part:
-        # - select existing ids in table
-        # - compare with ids actually used in tracks
-        # - deletes the ones which are not used anymore
-        for td in track_data:
-            query = "SELECT " + td[0] + " FROM " + td[1] + " WHERE user_id = " + str(user_id)
-            self.env.cr.execute(query)
-            res = self.env.cr.fetchall()
-            to_clean = {r[0] for r in res} - td[2]
+        res = []
+        for table, column, track_columns in track_data:
+            query = "SELECT r.id FROM {} AS r WHERE r.user_id = %s {};".format(
+                table,
+                " ".join(
+                    [
+                        "AND NOT EXISTS (SELECT 1 FROM oomusic_track AS t "
+                        "WHERE t.user_id = r.user_id AND t.{} = r.{})".format(c, column)
+                        for c in track_columns
+                    ]
+                ),
+            )
+            self.env.cr.execute(query, (user_id,))
+            res.append((table.replace("_", "."), [r[0] for r in self.env.cr.fetchall()]))
+        return res
 
-            if to_clean:
-                self.env[td[1].replace("_", ".")].browse(to_clean).sudo().unlink()
+    def _is_user_scanning(self, Folder):
+        """
+        Check if another root folder of the user is being scanned.
+
+        :param Folder: root folder being scanned
+        :return bool: True if another root folder is locked
+        """
+        return bool(
+            self.env["oomusic.folder"].search_count(
+                [
+                    ("root", "=", True),
+                    ("locked", "=", True),
+                    ("user_id", "=", Folder.user_id.id),
+                    ("id", "!=", Folder.id),
+                ]
+            )
+        )
+
+    def _unlock_folder(self, Folder, vals):
+        """
+        Unlock a root folder at the end of its scan. The other scans of the user might still rely
+        on the tags to clean, so the last one to finish does the cleaning, even if it is the first
+        scan of its folder. The folder is unlocked in the same locked section as the check of the
+        other scans: among scans finishing at the same time, the last one to enter the section sees
+        the other folders unlocked.
+
+        :param Folder: root folder being scanned
+        :param dict vals: values to write on the folder, including the lock
+        """
+        self._commit_or_flush()
+        with self._lock_user_keys(Folder.user_id.id, [self._name]):
+            Folder.write(vals)
+            if not self._is_user_scanning(Folder):
+                self._clean_tags(Folder.user_id.id)
+
+    def _clean_tags(self, user_id):
+        """
+        Clean tags. It remove artists, albums, genres and playlist lines not listed in tracks
+        anymore.
+
+        :param int user_id: ID of the user to whom belongs the folder
+        """
+        _logger.debug('Cleaning tags for user_id "%s"...', user_id)
+
+        for model, ids in self._find_orphan_tags(user_id):
+            if ids:
+                self.env[model].browse(ids).sudo().unlink()
 
     def _build_cache_global(self, folder_id, user_id):
         """
         Builds the cache for a given root folder. This avoids using the ORM cache which does not
         show the required performances for a large number of files. It caches information about
-        albums, artists, folders and genres. Only the necessary data is set in cache.
+        the folders located in the root folder. Only the necessary data is set in cache.
+
+        The albums, artists and genres are not loaded upfront, since a library can hold millions of
+        them while a scan usually needs a few. They are fetched on demand when the tracks are
+        written, and kept until the next commit.
 
         :param int folder_id: ID of the folder to scan
         :param int user_id: ID of the user to whom belongs the folder
@@ -208,27 +928,27 @@ class MusicFolderScan(models.TransientModel):
         cache = {}
         cache["track"] = {}
         cache["user_id"] = user_id
-        params = (user_id,)
-
-        query = "SELECT name, folder_id, id FROM oomusic_album WHERE user_id = %s;"
-        self.env.cr.execute(query, params)
-        res = self.env.cr.fetchall()
-        cache["album"] = {(r[0], r[1]): r[2] for r in res}
-
-        query = "SELECT name, id FROM oomusic_artist WHERE user_id = %s;"
-        self.env.cr.execute(query, params)
-        res = self.env.cr.fetchall()
-        cache["artist"] = {r[0]: r[1] for r in res}
+        cache["album"] = {}
+        cache["artist"] = {}
+        cache["genre"] = {}
 
-        query = "SELECT path, id, last_modification FROM oomusic_folder WHERE user_id = %s;"
-        self.env.cr.execute(query, params)
+        self.env.cr.execute("SELECT path FROM oomusic_folder WHERE id = %s;", (folder_id,))
+        path = self.env.cr.fetchone()[0]
+        query = """
+            SELECT path, id, last_modification FROM oomusic_folder
+            WHERE user_id = %s AND (path = %s OR path LIKE %s);
+        """
+        self.env.cr.execute(query, (user_id, path, _like_prefix(path)))
         res = self.env.cr.fetchall()
         cache["folder"] = {r[0]: (r[1], r[2] or 0) for r in res}
 
-        query = "SELECT name, id FROM oomusic_genre WHERE user_id = %s;"
-        self.env.cr.execute(query, params)
+        query = """
+            SELECT path, id, last_modification, size FROM oomusic_folder_quarantine
+            WHERE folder_id = %s;
+        """
+        self.env.cr.execute(query, (folder_id,))
         res = self.env.cr.fetchall()
-        cache["genre"] = {r[0]: r[1] for r in res}
+        cache["quarantine"] = {r[0]: (r[1], r[2], r[3]) for r in res}
 
         return cache
 
@@ -261,14 +981,24 @@ class MusicFolderScan(models.TransientModel):
         field needs to be stored. This implies that, for every track added on an album, the field
         is recomputed, leading to a shitload of database queries, slowing down the whole process.
 
+        The tracks themselves are also written in batch: `track_create` holds the values of the new
+        tracks, `track_write` the values of the existing tracks, by ID. `album_stats` holds the IDs
+        of the albums whose aggregates (track count, duration, size) must be updated, including the
+        former albums of the updated tracks. `track_deferred` is set when the tracks need new
+        artists or genres, which are only created at the next commit, see `_write_tracks`.
+
         :return dict: content of the cache, mostly empty
         """
         cache_write = {}
         cache_write["album"] = {}
+        cache_write["track_create"] = []
+        cache_write["track_write"] = {}
+        cache_write["track_deferred"] = False
+        cache_write["album_stats"] = set()
 
         return cache_write
 
-    def _manage_dir(self, rootdir, cache):
+    def _manage_dir(self, rootdir, mtime, cache):
         """
         For a given directory, checks that it is already in the cache.
         - If not in the cache, create the associated folder
@@ -276,15 +1006,15 @@ class MusicFolderScan(models.TransientModel):
         If the last modification date is older than the one recorded, the folder is skipped
 
         :param str rootdir: folder to check
+        :param int mtime: last modification date of the folder
         :param dict cache: reading cache
         :return bool: indicates if the folder scanning can be skipped
         """
         skip = False
         folder = cache["folder"].get(rootdir)
-        mtime = int(os.path.getmtime(rootdir))
 
         if not folder:
-            self._create_folder(rootdir, cache)
+            self._create_folder(rootdir, mtime, cache)
         elif folder[1] >= mtime:
             skip = True
         else:
@@ -294,17 +1024,17 @@ class MusicFolderScan(models.TransientModel):
             Folder.write({"last_modification": mtime, "parent_id": parent_dir[0]})
         return skip
 
-    def _create_folder(self, rootdir, cache):
+    def _create_folder(self, rootdir, mtime, cache):
         """
         Create the directory rootdir, and updates the cache.
 
         :param str rootdir: path of the folder to create
+        :param int mtime: last modification date of the folder
         :param dict cache: reading cache
         """
         parent_dir = os.sep.join(rootdir.split(os.sep)[:-1])
         parent_dir = cache["folder"].get(parent_dir)
         if parent_dir:
-            mtime = int(os.path.getmtime(rootdir))
             vals = {
                 "root": False,
                 "path": rootdir,
@@ -315,79 +1045,245 @@ class MusicFolderScan(models.TransientModel):
             Folder = self.env["oomusic.folder"].create(vals)
             cache["folder"][rootdir] = (Folder.id, mtime)
 
-    def _get_tags(self, file_path, tag=taglib):
-        tag = tag or mutagen
-        _logger.debug('Scanning file "%s"', file_path)
-        try:
-            song = tag.File(file_path)
-            if not song:
-                raise
-        except:
-            _logger.warning('Error while opening file "%s"', file_path, exc_info=True)
-            return False, {}
-        if tag.__name__ == "taglib":
-            return song, song.tags
+    def _quarantine_file(self, Folder, fn_path, mtime, size, error, cache):
+        """
+        Record a file which could not be read. It is not read again by the next scans as long as
+        its modification date and size do not change.
+
+        :param Folder: root folder being scanned
+        :param str fn_path: path of the file
+        :param int mtime: last modification date of the file
+        :param int size: size of the file, in bytes
+        :param str error: error raised while reading the file
+        :param dict cache: reading cache
+        """
+        vals = {
+            "last_modification": mtime,
+            "size": size,
+            "error": error,
+            "date": fields.Datetime.now(),
+        }
+        quarantine = cache["quarantine"].get(fn_path)
+        if quarantine:
+            Quarantine = self.env["oomusic.folder.quarantine"].browse(quarantine[0]).sudo()
+            vals["failure_count"] = Quarantine.failure_count + 1
+            Quarantine.write(vals)
         else:
-            try:
-                song_tags = EasyID3(file_path) or {}
-            except:
-                song_tags = song.tags or {}
-
-            song_tags = {k.upper(): v for k, v in song_tags.items()}
-            return song, song_tags
+            vals.update({"folder_id": Folder.id, "path": fn_path})
+            Quarantine = self.env["oomusic.folder.quarantine"].sudo().create(vals)
+        cache["quarantine"][fn_path] = (Quarantine.id, mtime, size)
 
-    def _create_related(self, vals, cache, rootdir):
+    def _scan_tasks(self, Folder, cache, tree, force=(), after=None):
         """
-        Create the related objects of the track: album, artist and genre. Updates the cache
-        accordingly.
+        Go through all sub-directories of the folder and yield the files which need to be scanned.
+        The directories are managed on the fly, and the track data is fetched for the directories
+        which are not skipped.
 
-        :param dict vals: data of the track
+        :param Folder: root folder to scan
         :param dict cache: reading cache
-        :param str rootdir: path of the folder being scanned
+        :param tree: result of `_walk` on the folder path
+        :param force: directories to scan even if their modification date did not change
+        :param str after: path of the last directory completely scanned by an interrupted scan. The
+            directories up to this one are skipped, and the next ones are scanned even if their
+            modification date did not change, since it might have been recorded before their files.
+        :return: generator of tuples (rootdir, fn, fn_path, mtime, size, track_id). `track_id` is
+            False if the track does not exist yet.
         """
-        MusicAlbum = self.env["oomusic.album"]
-        MusicArtist = self.env["oomusic.artist"]
-        MusicGenre = self.env["oomusic.genre"]
+        after_key = _walk_key(after) if after else None
+        for rootdir, mtime_dir, files in tree:
+            if after_key and _walk_key(rootdir) <= after_key:
+                continue
+            _logger.debug('Scanning folder "%s"...', rootdir)
+
+            # If the folder is in cache, it means we'll have to fetch the track data. We check
+            # now since _manage_dir will add a missing folder in the cache.
+            build_cache_folder = False
+            if rootdir in cache["folder"]:
+                build_cache_folder = True
+
+            skip = self._manage_dir(rootdir, mtime_dir, cache)
+            if skip and not after and rootdir not in force:
+                continue
+
+            # Complete the cache with track data
+            if build_cache_folder:
+                self._build_cache_folder(cache["folder"][rootdir][0], Folder.user_id.id, cache)
+
+            for fn, mtime, size in files:
+                # Skip file if already in DB
+                fn_path = os.path.join(rootdir, fn)
+                track = cache["track"].get(fn_path)
+                if track and track[1] >= mtime:
+                    continue
 
-        if (
-            vals.get("album_id")
-            and (vals["album_id"], cache["folder"][rootdir][0]) not in cache["album"].keys()
-        ):
-            cache["album"][(vals["album_id"], cache["folder"][rootdir][0])] = MusicAlbum.create(
-                {
-                    "name": vals["album_id"],
-                    "user_id": cache["user_id"],
-                    "folder_id": cache["folder"][rootdir][0],
-                }
-            ).id
-        if vals.get("artist_id") and vals["artist_id"] not in cache["artist"].keys():
-            cache["artist"][vals["artist_id"]] = MusicArtist.create(
-                {"name": vals["artist_id"], "user_id": cache["user_id"]}
-            ).id
-        if vals.get("album_artist_id") and vals["album_artist_id"] not in cache["artist"].keys():
-            cache["artist"][vals["album_artist_id"]] = MusicArtist.create(
-                {"name": vals["album_artist_id"], "user_id": cache["user_id"]}
-            ).id
-        if vals.get("performer_id") and vals["performer_id"] not in cache["artist"].keys():
-            cache["artist"][vals["performer_id"]] = MusicArtist.create(
-                {"name": vals["performer_id"], "user_id": cache["user_id"]}
-            ).id
-        if vals.get("genre_id") and vals["genre_id"] not in cache["genre"].keys():
-            cache["genre"][vals["genre_id"]] = MusicGenre.create(
-                {"name": vals["genre_id"], "user_id": cache["user_id"]}
-            ).id
-
-    def _replace_related_by_id(self, vals, cache, rootdir):
+                # Skip file if it could not be read and did not change since then
+                quarantine = cache["quarantine"].get(fn_path)
+                if quarantine and quarantine[1:] == (mtime, size):
+                    continue
+
+                # A moved track is updated instead of being created
+                if not track and fn_path in cache["move"]:
+                    track = cache["move"][fn_path]
+
+                yield rootdir, fn, fn_path, mtime, size, track[0] if track else False
+
+    def _read_files(self, tasks, tag_name, workers=1, skip=()):
+        """
+        Read the files given by the tasks. If several workers are requested, the files are read in
+        a pool of processes. In any case, the results are yielded in the same order as the tasks,
+        so they can be written in the database by the calling process.
+
+        :param tasks: iterable of tuples, the path of the file being at index 2
+        :param str tag_name: library used to read the files, "taglib", "mutagen" or "fast"
+        :param int workers: number of processes used to read the files
+        :param skip: paths of the files not to read. Their data is None.
+        :return: generator of tuples (task, data), where data is the result of `_read_file`
+        """
+        keys = set(self.MAP_ID3_FIELD.keys())
+        if workers <= 1:
+            for task in tasks:
+                yield task, _read_file(task[2], tag_name, keys) if task[2] not in skip else None
+            return
+
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for task in tasks:
+                if task[2] in skip:
+                    future = None
+                else:
+                    future = executor.submit(_read_file, task[2], tag_name, keys)
+                pending.append((task, future))
+                if len(pending) >= workers * self.SCAN_QUEUE_SIZE:
+                    task, future = pending.popleft()
+                    yield task, future.result() if future else None
+            while pending:
+                task, future = pending.popleft()
+                yield task, future.result() if future else None
+
+    def _insert_related(self, table, columns, keys, user_id):
+        """
+        Create records of a related model with a single multi-rows INSERT, bypassing the ORM. The
+        keys already existing in the database, for example created by a concurrent scan, are
+        ignored and fetched afterwards.
+
+        :param str table: table of the model, e.g. "oomusic_artist"
+        :param list columns: columns identifying a record, e.g. ["name"]
+        :param set keys: tuples of values matching the columns
+        :param int user_id: ID of the user to whom belong the records
+        :return dict: ID of the records, by key
+        """
+        keys = list(keys)
+        row = "({}, %s, %s, (now() at time zone 'UTC'), %s, (now() at time zone 'UTC'))".format(
+            ", ".join(["%s"] * len(columns))
+        )
+        query = """
+            INSERT INTO {0} ({1}, user_id, create_uid, create_date, write_uid, write_date)
+            VALUES {2}
+            ON CONFLICT DO NOTHING
+            RETURNING {1}, id;
+        """.format(
+            table, ", ".join(columns), ", ".join([row] * len(keys))
+        )
+        params = []
+        for key in keys:
+            params += list(key) + [user_id, self.env.uid, self.env.uid]
+        self.env.cr.execute(query, params)
+        res = {tuple(r[:-1]): r[-1] for r in self.env.cr.fetchall()}
+
+        missing = [k for k in keys if k not in res]
+        if missing:
+            res.update(self._search_related(table, columns, missing, user_id))
+        return res
+
+    def _search_related(self, table, columns, keys, user_id):
+        """
+        Fetch the existing records of a related model.
+
+        :param str table: table of the model, e.g. "oomusic_artist"
+        :param list columns: columns identifying a record, e.g. ["name"]
+        :param keys: tuples of values matching the columns
+        :param int user_id: ID of the user to whom belong the records
+        :return dict: ID of the records found, by key
+        """
+        query = "SELECT {0}, id FROM {1} WHERE user_id = %s AND ({0}) IN %s;".format(
+            ", ".join(columns), table
+        )
+        self.env.cr.execute(query, (user_id, tuple(keys)))
+        return {tuple(r[:-1]): r[-1] for r in self.env.cr.fetchall()}
+
+    def _create_related(self, vals_list, cache, lock=True):
+        """
+        Create the related objects of the tracks: album, artist and genre. The names which are not
+        in the cache yet are searched, the missing ones are created at once, and the cache is
+        updated accordingly.
+
+        Artists and genres are shared by all the root folders of a user, which can be scanned
+        concurrently. The new names are therefore locked while they are created, which commits
+        the transaction.
+
+        :param list vals_list: data of the tracks
+        :param dict cache: reading cache
+        :param bool lock: if False, the missing artists and genres are not created, so the
+            transaction is not committed
+        :return bool: False if some artists or genres are missing
+        """
+        albums = {
+            (vals["album_id"], vals["folder_id"]) for vals in vals_list if vals.get("album_id")
+        }
+        artists = {
+            vals[f]
+            for vals in vals_list
+            for f in ["artist_id", "album_artist_id", "performer_id"]
+            if vals.get(f)
+        }
+        genres = {vals["genre_id"] for vals in vals_list if vals.get("genre_id")}
+
+        albums = albums - cache["album"].keys()
+        if albums:
+            cache["album"].update(
+                self._search_related(
+                    "oomusic_album", ["name", "folder_id"], albums, cache["user_id"]
+                )
+            )
+            albums = albums - cache["album"].keys()
+        if albums:
+            res = self._insert_related(
+                "oomusic_album", ["name", "folder_id"], albums, cache["user_id"]
+            )
+            cache["album"].update(res)
+        for key, names in [("artist", artists), ("genre", genres)]:
+            names = {(n,) for n in names - cache[key].keys()}
+            if names:
+                res = self._search_related("oomusic_" + key, ["name"], names, cache["user_id"])
+                cache[key].update({k[0]: v for k, v in res.items()})
+        artists = {(a,) for a in artists - cache["artist"].keys()}
+        genres = {(g,) for g in genres - cache["genre"].keys()}
+        if not artists and not genres:
+            return True
+        if not lock and not self.env.context.get("test_mode"):
+            return False
+
+        keys = ["oomusic.artist,{}".format(a[0]) for a in artists]
+        keys += ["oomusic.genre,{}".format(g[0]) for g in genres]
+        with self._lock_user_keys(cache["user_id"], keys):
+            if artists:
+                res = self._insert_related("oomusic_artist", ["name"], artists, cache["user_id"])
+                cache["artist"].update({k[0]: v for k, v in res.items()})
+            if genres:
+                res = self._insert_related("oomusic_genre", ["name"], genres, cache["user_id"])
+                cache["genre"].update({k[0]: v for k, v in res.items()})
+        return True
+
+    def _replace_related_by_id(self, vals, cache):
         """
         Replace the data of the track with the ID of the related object. In other words, convert the
         name of the album, artist or genre into athe corresponding ID.
 
         :param dict vals: data of the track
         :param dict cache: reading cache
-        :param str rootdir: path of the folder being scanned
         """
         if vals.get("album_id"):
-            vals["album_id"] = cache["album"][(vals["album_id"], cache["folder"][rootdir][0])]
+            vals["album_id"] = cache["album"][(vals["album_id"], vals["folder_id"])]
         if vals.get("artist_id"):
             vals["artist_id"] = cache["artist"][vals["artist_id"]]
         if vals.get("album_artist_id"):
@@ -412,17 +1308,180 @@ class MusicFolderScan(models.TransientModel):
                 "genre_id": vals.get("genre_id"),
             }
 
-    def _write_cache_write(self, cache_write):
+    def _get_track_columns(self, vals):
         """
-        Performs the write oopration of the write_cache
+        Get the columns to write for tracks, and the function converting a value to its database
+        representation.
+
+        :param dict vals: data of a track
+        :return list: list of tuples (field name, SQL type, conversion function)
+        """
+        MusicTrack = self.env["oomusic.track"]
+        columns = []
+        for fname in sorted(vals.keys()):
+            field = MusicTrack._fields[fname]
+            columns.append(
+                (fname, field.column_type[1], lambda v, f=field: f.convert_to_column(v, MusicTrack))
+            )
+        return columns
+
+    def _insert_tracks(self, vals_list):
+        """
+        Create tracks with a single multi-rows INSERT. Similarly to `_build_cache_global`, this
+        bypasses the ORM which does not show the required performances for a large number of
+        files. All values must have the same keys.
+
+        :param list vals_list: list of track data
+        :return list: IDs of the created tracks
+        """
+        columns = self._get_track_columns(vals_list[0])
+        row = "({}, %s, (now() at time zone 'UTC'), %s, (now() at time zone 'UTC'))".format(
+            ", ".join(["%s"] * len(columns))
+        )
+        query = """
+            INSERT INTO oomusic_track ({}, create_uid, create_date, write_uid, write_date)
+            VALUES {}
+            RETURNING id;
+        """.format(
+            ", ".join(['"{}"'.format(c[0]) for c in columns]), ", ".join([row] * len(vals_list))
+        )
+        params = []
+        for vals in vals_list:
+            params += [c[2](vals[c[0]]) for c in columns] + [self.env.uid, self.env.uid]
+        self.env.cr.execute(query, params)
+        return [r[0] for r in self.env.cr.fetchall()]
+
+    def _update_tracks(self, vals_by_id):
+        """
+        Update tracks with a single UPDATE ... FROM (VALUES ...). Same remarks as `_insert_tracks`.
+
+        :param dict vals_by_id: track data, by track ID
+        """
+        columns = self._get_track_columns(next(iter(vals_by_id.values())))
+        row = "(%s::integer, {})".format(", ".join(["%s::{}".format(c[1]) for c in columns]))
+        query = """
+            UPDATE oomusic_track AS t
+            SET {}, write_uid = %s, write_date = (now() at time zone 'UTC')
+            FROM (VALUES {}) AS v(id, {})
+            WHERE t.id = v.id;
+        """.format(
+            ", ".join(['"{0}" = v."{0}"'.format(c[0]) for c in columns]),
+            ", ".join([row] * len(vals_by_id)),
+            ", ".join(['"{}"'.format(c[0]) for c in columns]),
+        )
+        params = [self.env.uid]
+        for track_id, vals in vals_by_id.items():
+            params += [track_id] + [c[2](vals[c[0]]) for c in columns]
+        self.env.cr.execute(query, params)
+
+    def _write_tracks(self, cache_write, cache, lock=True):
+        """
+        Write the tracks of the write cache in the database, and empty the corresponding part of
+        the cache. The related albums, artists and genres are created beforehand.
+
+        Creating artists and genres commits the transaction, see `_create_related`. Between two
+        commits of the scan, the tracks needing new ones are therefore kept in the cache, and
+        written with the next commit.
 
         :param dict cache_write: writing cache
+        :param dict cache: reading cache
+        :param bool lock: allow committing the transaction to create artists and genres
+        """
+        MusicTrack = self.env["oomusic.track"]
+        MusicTrack.flush()
+        vals_list = cache_write["track_create"] + list(cache_write["track_write"].values())
+
+        # Create new album, artist or genre, and update the cache
+        if not self._create_related(vals_list, cache, lock=lock):
+            cache_write["track_deferred"] = True
+            return
+
+        for vals in vals_list:
+            # Replace album, artist or genre by ID
+            self._replace_related_by_id(vals, cache)
+
+            # Update writing cache
+            self._update_cache_write(vals, cache_write)
+
+        cache_write["album_stats"].update(v["album_id"] for v in vals_list if v.get("album_id"))
+        if cache_write["track_create"]:
+            self._insert_tracks(cache_write["track_create"])
+        if cache_write["track_write"]:
+            query = """
+                SELECT DISTINCT album_id FROM oomusic_track
+                WHERE id IN %s AND album_id IS NOT NULL;
+            """
+            self.env.cr.execute(query, (tuple(cache_write["track_write"].keys()),))
+            cache_write["album_stats"].update(r[0] for r in self.env.cr.fetchall())
+            self._update_tracks(cache_write["track_write"])
+        cache_write["track_create"] = []
+        cache_write["track_write"] = {}
+        self.invalidate_cache()
+
+    def _update_albums(self, vals_by_id):
+        """
+        Update the year, artist and genre of albums with a single UPDATE ... FROM (VALUES ...).
+        Same remarks as `_update_tracks`.
+
+        :param dict vals_by_id: album data, by album ID
+        """
+        row = "(%s::integer, %s::varchar, %s::integer, %s::integer)"
+        query = """
+            UPDATE oomusic_album AS a
+            SET year = v.year, artist_id = v.artist_id, genre_id = v.genre_id,
+                write_uid = %s, write_date = (now() at time zone 'UTC')
+            FROM (VALUES {}) AS v(id, year, artist_id, genre_id)
+            WHERE a.id = v.id;
+        """.format(
+            ", ".join([row] * len(vals_by_id))
+        )
+        params = [self.env.uid]
+        for album_id, vals in vals_by_id.items():
+            params += [album_id] + [vals[f] or None for f in ["year", "artist_id", "genre_id"]]
+        self.env.cr.execute(query, params)
+
+    def _update_album_stats(self, album_ids):
+        """
+        Update the aggregates of albums, computed from their tracks, with a single UPDATE.
+
+        :param album_ids: IDs of the albums
+        """
+        query = """
+            UPDATE oomusic_album AS a
+            SET track_count = s.track_count, duration = s.duration, size = s.size
+            FROM (
+                SELECT al.id, count(t.id), coalesce(sum(t.duration), 0), coalesce(sum(t.size), 0)
+                FROM oomusic_album AS al
+                LEFT JOIN oomusic_track AS t ON t.album_id = al.id
+                WHERE al.id IN %s
+                GROUP BY al.id
+            ) AS s(id, track_count, duration, size)
+            WHERE a.id = s.id;
         """
-        MusicFolder = self.env["oomusic.album"]
-        for album_id in cache_write["album"].keys():
-            MusicFolder.browse([album_id]).write(cache_write["album"][album_id])
+        self.env.cr.execute(query, (tuple(album_ids),))
 
-    def _scan_folder(self, folder_id):
+    def _write_cache_write(self, cache_write, cache):
+        """
+        Performs the write oopration of the write_cache
+
+        :param dict cache_write: writing cache
+        :param dict cache: reading cache
+        """
+        self._write_tracks(cache_write, cache)
+        self.env["oomusic.album"].flush()
+        if cache_write["album"]:
+            self._update_albums(cache_write["album"])
+        if cache_write["album_stats"]:
+            self._update_album_stats(cache_write["album_stats"])
+        self.env["oomusic.album"].invalidate_cache()
+
+        # The related records are only kept until the next commit, which bounds the size of the
+        # cache. They are fetched again if needed.
+        cache["album"] = {}
+        cache["artist"] = {}
+        cache["genre"] = {}
+
+    def _scan_folder(self, folder_id, paths=None, shallow_paths=None):
         """
         The folder scanning method. It walks in all sub-directories of the folder. If the
         modification date is more recent than the recorded date, the directory is scanned.
@@ -430,13 +1489,34 @@ class MusicFolderScan(models.TransientModel):
         A file is scanned if these conditions are met:
         - the extension matches the allowed file extensions;
         - the last modification date is more recent than the recorded date, in order to update data
-          of an existing record.
+          of an existing record;
+        - the file is not in quarantine, i.e. it could be read by a previous scan or it changed
+          since then.
         During the scan, any new album or artists will be created as well.
 
         There is an arbitrary commit every 1000 tracks or 2 minutes, which should allow a regular
-        update of the database.
+        update of the database. At each commit, the last directory completely scanned is recorded
+        as a checkpoint on the folder. If the scan is interrupted, e.g. by a restart of the server,
+        the next scan resumes after this directory instead of starting over.
+
+        In parallel mode, the files are read by a pool of processes while the database operations
+        are kept in the current thread, in the walking order.
+
+        If paths are given, only these directories of the folder are walked and cleaned, e.g. the
+        ones modified according to the folder watcher. Their files are checked even if the
+        modification date of the directory did not change. The shallow paths are scanned the same
+        way, without their sub-directories, e.g. the directories in which the watcher only saw
+        files being modified. They must not contain any of the other paths.
+
+        The tracks moved or renamed are detected before the scan, and the folders and tracks which
+        are not on the disk anymore are removed after it.
+
+        The timings of the different phases and the number of files read are recorded in a scan
+        log. Its progress is notified on the bus during the scan.
 
         :param int folder_id: ID of the folder to scan
+        :param list paths: directories to scan, the whole folder if not set
+        :param list shallow_paths: directories to scan without their sub-directories
         """
         if locale.getlocale() == (None, None):
             _logger.warning(
@@ -456,150 +1536,232 @@ class MusicFolderScan(models.TransientModel):
                     return {}
 
             MusicFolder = self.env["oomusic.folder"]
-            MusicTrack = self.env["oomusic.track"]
 
             Folder = MusicFolder.browse([folder_id])
             if Folder.tag_analysis == "taglib" and taglib:
-                tag = taglib
+                tag_name = "taglib"
+            elif Folder.tag_analysis == "fast":
+                tag_name = "fast"
             else:
-                tag = mutagen
-
-            # Clean-up the DB before actual scan
-            self._clean_directory(Folder.path, Folder.user_id.id)
-            if not Folder.exists():
-                if not self.env.context.get("test_mode"):
-                    self.env.cr.commit()
-                return {}
+                tag_name = "mutagen"
+            workers = Folder.scan_workers if Folder.scan_mode == "parallel" else 1
+
+            # Resume an interrupted scan. Only full scans are resumed.
+            partial = bool(paths or shallow_paths)
+            resume = Folder.scan_checkpoint if not partial else False
+            if resume:
+                _logger.info('Resuming scan of "%s" after "%s"', Folder.path, resume)
+
+            log_id = self._create_scan_log(Folder, partial=partial)
+            stats = dict.fromkeys(
+                [
+                    "time_walk",
+                    "time_build_cache",
+                    "time_read",
+                    "time_write",
+                    "time_clean_directory",
+                    "time_clean_tags",
+                ],
+                0.0,
+            )
+            stats.update({"files_read": 0, "files_failed": 0, "bytes_read": 0.0})
+
+            # List the directories and files once. They are used for scanning, detecting moved tracks
+            # and cleaning-up the DB after the scan. During a complete scan, the directories which
+            # did not change since the last walk are not listed again.
+            walk_date = int(time.time())
+            with self._timer(stats, "time_walk"):
+                known = None
+                if not partial and not resume and Folder.last_scan_walk:
+                    known = self._get_walk_known(
+                        Folder.path, Folder.user_id.id, Folder.last_scan_walk
+                    )
+                failed = set()
+                trees = [
+                    (path, list(self._walk(path, after=resume, known=known, failed=failed)))
+                    for path in paths or ([] if partial else [Folder.path])
+                ]
+                trees += [
+                    (path, list(self._walk(path, failed=failed, recursive=False)))
+                    for path in shallow_paths or []
+                ]
+            tree = [d for path, path_tree in trees for d in path_tree]
+            tree_index = {d[0]: idx for idx, d in enumerate(tree)}
+
+            # Number of files located before each directory, to compute the progress
+            files_before = {}
+            files_total = 0
+            for rootdir, mtime, files in tree:
+                files_before[rootdir] = files_total
+                files_total += len(files)
+            stats["files_total"] = files_total
 
             # Build the cache
             # - cache is used for read/search, i.e. avoid reading/searching same info several times
             # - cache_write is used for writing tracks info on other models and avoid stored
-            #   related/computed fields
-            cache = self._build_cache_global(Folder.id, Folder.user_id.id)
+            #   related/computed fields. It also holds the tracks to write in batch.
+            with self._timer(stats, "time_build_cache"):
+                cache = self._build_cache_global(Folder.id, Folder.user_id.id)
+                cache["move"] = self._detect_moves(
+                    [path for path, path_tree in trees],
+                    tree,
+                    cache,
+                    after=resume,
+                    tag_name=tag_name if Folder.use_tags else False,
+                    failed=failed,
+                )
             cache_write = self._build_cache_write()
-            i = 0
+            checkpoint = resume
+            i = Folder.scan_checkpoint_tracks if resume else 0
+            duration = Folder.scan_checkpoint_duration if resume else 0
 
             # Start scanning
             time_commit = time_start
-            for rootdir, dirnames, filenames in os.walk(Folder.path):
-                _logger.debug('Scanning folder "%s"...', rootdir)
-
-                # If the folder is in cache, it means we'll have to fetch the track data. We check
-                # now since _manage_dir will add a missing folder in the cache.
-                build_cache_folder = False
-                if rootdir in cache["folder"]:
-                    build_cache_folder = True
-
-                skip = self._manage_dir(rootdir, cache)
-                if skip:
+            time_progress = time.time()
+            tasks = self._scan_tasks(
+                Folder, cache, tree, force=set((paths or []) + (shallow_paths or [])), after=resume
+            )
+            files = self._read_files(tasks, tag_name, workers=workers, skip=cache["move"])
+            for task, data in self._timed(files, stats, "time_read"):
+                rootdir, fn, fn_path, mtime, size, track_id = task
+
+                # Notify the progress from time to time
+                if time.time() - time_progress > self.SCAN_PROGRESS_DELAY:
+                    time_progress = time.time()
+                    stats["progress"] = 100.0 * files_before[rootdir] / (files_total or 1)
+                    self._write_scan_log(log_id, stats)
+
+                # Skip files which could not be read, and quarantine them until they change
+                if data and "error" in data:
+                    self._quarantine_file(Folder, fn_path, mtime, size, data["error"], cache)
+                    stats["files_failed"] += 1
                     continue
-
-                # Complete the cache with track data
-                if build_cache_folder:
-                    self._build_cache_folder(cache["folder"][rootdir][0], Folder.user_id.id, cache)
-
-                for fn in filenames:
-                    # Check file extension
-                    fn_ext = fn.split(".")[-1]
-                    if fn_ext and fn_ext.lower() not in self.ALLOWED_FILE_EXTENSIONS:
-                        continue
-
-                    # Skip file if already in DB
-                    fn_path = os.path.join(rootdir, fn)
-                    mtime = int(os.path.getmtime(fn_path))
-                    if fn_path in cache["track"].keys() and cache["track"][fn_path][1] >= mtime:
-                        continue
-
-                    # Get tags
-                    song, song_tags = self._get_tags(os.path.join(rootdir, fn), tag=tag)
-                    if song is False:
-                        continue
+                if fn_path in cache["quarantine"]:
+                    self.env["oomusic.folder.quarantine"].browse(
+                        cache["quarantine"].pop(fn_path)[0]
+                    ).sudo().unlink()
+                if data is None:
+                    # The track has been moved, its data is already known
+                    vals = dict(cache["move"][fn_path][1])
+                else:
                     vals = {f: False if "_id" in f else "" for f in self.FIELDS_TO_CLEAN}
                     if Folder.use_tags:
                         vals.update(
                             {
                                 self.MAP_ID3_FIELD[k]: v[0]
-                                for k, v in song_tags.items()
+                                for k, v in data["tags"].items()
                                 if v and k in self.MAP_ID3_FIELD.keys()
                             }
                         )
-
-                    # Create new album, artist or genre, and update the cache
-                    self._create_related(vals, cache, rootdir)
-
-                    # Replace album, artist or genre by ID
-                    self._replace_related_by_id(vals, cache, rootdir)
-
-                    # Add missing fields
-                    if tag.__name__ == "taglib":
-                        vals["duration"] = song.length
-                        vals["bitrate"] = song.bitrate
-                    else:
-                        vals["duration"] = int(song.info.length)
-                        # 'bitrate' is not available for all file types
-                        if hasattr(song.info, "bitrate"):
-                            vals["bitrate"] = round((song.info.bitrate or 0) / 1000.0)
-                        else:
-                            vals["bitrate"] = 0
-                    vals["duration_min"] = float(vals["duration"]) / 60
-                    vals["size"] = (os.path.getsize(fn_path) or 0.0) / (1024.0 * 1024.0)
-                    vals["path"] = fn_path
-                    vals["last_modification"] = mtime
-                    vals["root_folder_id"] = folder_id
-                    vals["folder_id"] = cache["folder"][rootdir][0]
-                    vals["user_id"] = cache["user_id"]
-                    if not vals["name"]:
-                        vals["name"] = fn
-                    try:
-                        vals["track_number_int"] = (
-                            int(vals["track_number"].split("/")[0]) if vals["track_number"] else 0
+                    vals["duration"] = data["duration"]
+                    vals["bitrate"] = data["bitrate"]
+                    vals["fingerprint"] = data["fingerprint"]
+                    stats["files_read"] += 1
+                    stats["bytes_read"] += (size or 0.0) / (1024.0 * 1024.0)
+
+                # Add missing fields
+                vals["duration_min"] = float(vals["duration"]) / 60
+                vals["size"] = (size or 0.0) / (1024.0 * 1024.0)
+                vals["path"] = fn_path
+                vals["last_modification"] = mtime
+                vals["root_folder_id"] = folder_id
+                vals["folder_id"] = cache["folder"][rootdir][0]
+                vals["user_id"] = cache["user_id"]
+                if not vals["name"]:
+                    vals["name"] = fn
+                try:
+                    vals["track_number_int"] = (
+                        int(vals["track_number"].split("/")[0]) if vals["track_number"] else 0
+                    )
+                except ValueError:
+                    _logger.warning(
+                        "Could not convert track number '%s' to integer", vals["track_number"]
+                    )
+                    vals["track_number_int"] = 0
+
+                # Create the track. No need to insert a new track in the cache, since we won't
+                # scan it during the process. The related album, artist and genre are created when
+                # the tracks are written.
+                if track_id:
+                    cache_write["track_write"][track_id] = vals
+                else:
+                    cache_write["track_create"].append(vals)
+                if (
+                    len(cache_write["track_create"]) + len(cache_write["track_write"])
+                    >= self.TRACK_BATCH_SIZE
+                    and not cache_write["track_deferred"]
+                ):
+                    with self._timer(stats, "time_write"):
+                        self._write_tracks(cache_write, cache, lock=False)
+
+                # Commit every 1000 tracks or 2 minutes
+                i = i + 1
+                if i % 1000 == 0 or (dt.now() - time_commit).total_seconds() > 120:
+                    # Empty cache_write, so user already sees the album-related additional info
+                    with self._timer(stats, "time_write"):
+                        self._write_cache_write(cache_write, cache)
+                    cache_write = self._build_cache_write()
+                    time_commit = dt.now()
+                    folder_vals = {"last_commit": time_commit, "locked": True}
+                    if not partial:
+                        # The directories before the current one are completely scanned
+                        idx = tree_index[rootdir]
+                        if idx and (
+                            not checkpoint or _walk_key(tree[idx - 1][0]) > _walk_key(checkpoint)
+                        ):
+                            checkpoint = tree[idx - 1][0]
+                        folder_vals["scan_checkpoint"] = checkpoint
+                        folder_vals["scan_checkpoint_tracks"] = i
+                        folder_vals["scan_checkpoint_duration"] = duration + round(
+                            (time_commit - time_start).total_seconds()
                         )
-                    except ValueError:
-                        _logger.warning(
-                            "Could not convert track number '%s' to integer", vals["track_number"]
-                        )
-                        vals["track_number_int"] = 0
-
-                    # Create the track. No need to insert a new track in the cache, since we won't
-                    # scan it during the process.
-                    if fn_path in cache["track"].keys():
-                        Track = MusicTrack.browse(cache["track"][fn_path][0])
-                        Track.write(vals)
-                        if self.env.context.get("test_mode"):
-                            Track.flush()
-                    else:
-                        Track = MusicTrack.create(vals)
-
-                    # Update writing cache
-                    self._update_cache_write(vals, cache_write)
-
-                    # Commit every 1000 tracks or 2 minutes
-                    i = i + 1
-                    if i % 1000 == 0 or (dt.now() - time_commit).total_seconds() > 120:
-                        # Empty cache_write, so user already sees the album-related additional info
-                        self._write_cache_write(cache_write)
-                        cache_write = self._build_cache_write()
-                        time_commit = dt.now()
-                        Folder.write({"last_commit": time_commit, "locked": True})
-
-                        # Commit and close the transaction
+                    Folder.write(folder_vals)
+
+                    # Commit and close the transaction
+                    with self._timer(stats, "time_write"):
                         self._commit_or_flush()
 
-            # Final stuff to write and tags cleaning
-            self._write_cache_write(cache_write)
+            # Final stuff to write, directories and tags cleaning. This can potentially delete the
+            # root folder if its path doesn't exist anymore.
+            with self._timer(stats, "time_write"):
+                self._write_cache_write(cache_write, cache)
+            with self._timer(stats, "time_clean_directory"):
+                for path, path_tree in trees:
+                    self._clean_directory(
+                        path, Folder.user_id.id, tree=path_tree, after=resume, failed=failed
+                    )
+            if Folder.exists() and not partial:
+                with self._timer(stats, "time_write"):
+                    self._backfill_fingerprints(folder_id, self.FINGERPRINT_BACKFILL_SIZE)
             if Folder.exists():
-                if Folder.last_scan:
-                    self._commit_or_flush()
-                    self._clean_tags(Folder.user_id.id)
-                Folder.write(
-                    {
-                        "last_scan": fields.Datetime.now(),
-                        "last_scan_duration": round((dt.now() - time_start).total_seconds()),
-                        "last_commit": dt.now(),
-                        "locked": False,
-                    }
-                )
+                vals = {"last_commit": dt.now(), "locked": False}
+                if not partial:
+                    vals["last_scan"] = fields.Datetime.now()
+                    vals["last_scan_duration"] = duration + round(
+                        (dt.now() - time_start).total_seconds()
+                    )
+                    # The directories walked before the interruption might have been listed
+                    # before the modifications of the first part of the scan.
+                    vals["last_scan_walk"] = walk_date if not resume else 0
+                    vals["scan_checkpoint"] = False
+                    vals["scan_checkpoint_tracks"] = 0
+                    vals["scan_checkpoint_duration"] = 0
+                with self._timer(stats, "time_clean_tags"):
+                    self._unlock_folder(Folder, vals)
             self._commit_or_flush()
+
+            # The log is written once the transaction is committed, since the folder might have
+            # been removed
+            stats.update(
+                {
+                    "state": "done",
+                    "date_end": fields.Datetime.now(),
+                    "progress": 100.0,
+                    "files_skipped": files_total - stats["files_read"] - stats["files_failed"],
+                    "duration": (dt.now() - time_start).total_seconds(),
+                }
+            )
+            self._write_scan_log(log_id, stats)
             if self.env.context.get("test_mode"):
                 self.invalidate_cache()
             _logger.debug('Scan of folder_id "%s" completed!', folder_id)
@@ -607,8 +1769,9 @@ class MusicFolderScan(models.TransientModel):
 
     def scan_folder_th(self, folder_id):
         """
-        This is the method used to scan a oomusic folder with a new thread. Only one folder should be
-        scanned at a time, since different folders can share album, artist and genre data.
+        This is the method used to scan a oomusic folder with a new thread. Several folders can be
+        scanned at the same time: the creation of the shared artist and genre data is protected by
+        advisory locks.
 
         To improve scanning speed, two parameters are set in the context:
         - `recompute`: prevents calculating non-stored calculated fields
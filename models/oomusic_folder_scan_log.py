@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+from odoo import api, fields, models
+
+
+class MusicFolderScanLog(models.Model):
+    _name = "oomusic.folder.scan.log"
+    _description = "Music Folder Scan Log"
+    _order = "date_start desc, id desc"
+
+    # Number of logs kept by folder, see `_clean_logs`
+    _logs_per_folder = 100
+
+    folder_id = fields.Many2one(
+        "oomusic.folder", "Folder", required=True, index=True, ondelete="cascade"
+    )
+    user_id = fields.Many2one(
+        "res.users", related="folder_id.user_id", store=True, index=True, related_sudo=False
+    )
+    date_start = fields.Datetime("Start", readonly=True)
+    date_end = fields.Datetime("End", readonly=True)
+    state = fields.Selection(
+        [("running", "Running"), ("done", "Done"), ("failed", "Failed")],
+        string="State",
+        required=True,
+        default="running",
+        readonly=True,
+    )
+    partial = fields.Boolean(
+        "Partial Scan",
+        readonly=True,
+        help="Only some directories of the folder were scanned, e.g. the ones modified according "
+        "to the folder watcher.",
+    )
+    progress = fields.Float("Progress (%)", readonly=True)
+
+    # Counters
+    files_total = fields.Integer(
+        "Files", readonly=True, help="Number of files found in the scanned directories."
+    )
+    files_read = fields.Integer("Files Read", readonly=True)
+    files_skipped = fields.Integer(
+        "Files Skipped",
+        readonly=True,
+        help="Number of files not read, since they were not modified or they were moved.",
+    )
+    files_failed = fields.Integer(
+        "Files Failed", readonly=True, help="Number of files which could not be read."
+    )
+    bytes_read = fields.Float("Data Read (MiB)", readonly=True)
+    files_per_second = fields.Float("Files Read Per Second", compute="_compute_files_per_second")
+
+    # Timings
+    duration = fields.Float("Duration (s)", readonly=True)
+    time_walk = fields.Float(
+        "Walk (s)", readonly=True, help="Time spent listing the directories and files."
+    )
+    time_build_cache = fields.Float(
+        "Build Cache (s)",
+        readonly=True,
+        help="Time spent loading the existing data and detecting the moved tracks.",
+    )
+    time_read = fields.Float(
+        "Tag Read (s)",
+        readonly=True,
+        help="Time spent waiting for the files to be read, including the checks of the "
+        "directories.",
+    )
+    time_write = fields.Float(
+        "DB Write (s)", readonly=True, help="Time spent writing the data in the database."
+    )
+    time_clean_directory = fields.Float(
+        "Clean Directories (s)",
+        readonly=True,
+        help="Time spent removing the folders and tracks which are not on the disk anymore.",
+    )
+    time_clean_tags = fields.Float(
+        "Clean Tags (s)",
+        readonly=True,
+        help="Time spent removing the artists, albums and genres not used anymore.",
+    )
+
+    @api.depends("files_read", "time_read")
+    def _compute_files_per_second(self):
+        for log in self:
+            log.files_per_second = log.files_read / log.time_read if log.time_read else 0.0
+
+    def _clean_logs(self):
+        """
+        Remove the oldest logs, since the folder watcher adds one for every partial scan. Only the
+        `_logs_per_folder` most recent logs of each folder are kept. The running scans are never
+        removed.
+        """
+        query = """
+            DELETE FROM oomusic_folder_scan_log
+            WHERE id IN (
+                SELECT id FROM (
+                    SELECT id, state, row_number() OVER (
+                        PARTITION BY folder_id ORDER BY date_start DESC, id DESC
+                    ) AS rank
+                    FROM oomusic_folder_scan_log
+                ) AS l
+                WHERE l.rank > %s AND l.state != 'running'
+            );
+        """
+        self.env.cr.execute(query, (self._logs_per_folder,))
+        self.invalidate_cache()
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import os
+import threading
+import time
+
+import odoo
+from odoo import SUPERUSER_ID, api, fields
+
+# inotify_simple is an optional dependency. Without it, the folders are only scanned by the
+# scheduled action.
+try:
+    from inotify_simple import INotify, flags
+except ImportError:
+    INotify = None
+    flags = None
+
+_logger = logging.getLogger(__name__)
+
+# Watchers running in this process, by database name
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+# Arbitrary key of the PostgreSQL advisory lock, which ensures that a single watcher runs for a
+# database, even with several Odoo processes
+WATCH_LOCK_KEY = 0x6F6F6D75
+
+# Delay (s) without any new event before the modified directories are scanned
+WATCH_DELAY = 5
+
+# Delay (s) between two refreshes of the list of watched folders
+WATCH_REFRESH = 60
+
+
+def start_watcher(dbname):
+    """
+    Start the watcher of a database, if it is not already running in this process.
+
+    :param str dbname: name of the database
+    :return bool: False if inotify is not available
+    """
+    if not INotify:
+        return False
+    with _watchers_lock:
+        watcher = _watchers.get(dbname)
+        if not watcher or not watcher.is_alive():
+            watcher = FolderWatcher(dbname)
+            _watchers[dbname] = watcher
+            watcher.start()
+    return True
+
+
+class FolderWatcher(threading.Thread):
+    """
+    Thread watching the root folders of a database with inotify. The directories touched by a
+    filesystem event are collected, and scanned once no event has been received for
+    `WATCH_DELAY` seconds. Only these directories go through the scanner, instead of walking the
+    whole folder. A directory in which only files were modified is scanned without its
+    sub-directories.
+
+    If a directory cannot be watched, the folder is not watched anymore, and is left to the
+    scheduled scan until the watch can be set up again.
+    """
+
+    MASK = (
+        flags.CREATE | flags.DELETE | flags.MOVED_FROM | flags.MOVED_TO | flags.CLOSE_WRITE
+        if flags
+        else 0
+    )
+
+    def __init__(self, dbname):
+        super(FolderWatcher, self).__init__(name="oomusic.watcher.{}".format(dbname), daemon=True)
+        self.dbname = dbname
+        self.inotify = None
+        self.roots = {}  # folder_id: path
+        self.wds = {}  # watch descriptor: (folder_id, path)
+        self.pending = {}  # folder_id: {path to scan: recursive}
+        self.time_event = 0.0
+        self.time_refresh = 0.0
+
+    def run(self):
+        registry = odoo.registry(self.dbname)
+        # The advisory lock is held by the session as long as the cursor is open
+        with registry.cursor() as lock_cr:
+            lock_cr.execute("SELECT pg_try_advisory_lock(%s)", (WATCH_LOCK_KEY,))
+            if not lock_cr.fetchone()[0]:
+                _logger.debug('A folder watcher is already running for "%s"', self.dbname)
+                return
+            lock_cr.commit()
+
+            _logger.info('Starting folder watcher for "%s"', self.dbname)
+            self.inotify = INotify()
+            try:
+                while True:
+                    if time.time() - self.time_refresh > WATCH_REFRESH:
+                        if not self._refresh(registry):
+                            break
+                    for event in self.inotify.read(timeout=WATCH_DELAY * 1000):
+                        self._handle_event(event)
+                    if self.pending and time.time() - self.time_event > WATCH_DELAY:
+                        self._scan_pending(registry)
+            except Exception:
+                _logger.exception('Folder watcher of "%s" stopped', self.dbname)
+            finally:
+                self.inotify.close()
+
+    def _refresh(self, registry):
+        """
+        Synchronize the watched folders with the root folders flagged for watching, and record
+        that they are watched. The folders which cannot be watched are left to the scheduled scan.
+
+        :return bool: False if there is nothing to watch anymore
+        """
+        self.time_refresh = time.time()
+        with api.Environment.manage(), registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            folders = env["oomusic.folder"].search([("root", "=", True), ("watch", "=", True)])
+            roots = {f.id: f.path for f in folders}
+
+            for folder_id in set(self.roots) - set(roots):
+                self._remove_watch(folder_id, self.roots.pop(folder_id))
+            for folder_id, path in roots.items():
+                if self.roots.get(folder_id) == path:
+                    continue
+                if folder_id in self.roots:
+                    self._remove_watch(folder_id, self.roots.pop(folder_id))
+                if self._add_watch(folder_id, path):
+                    self.roots[folder_id] = path
+                    # Changes might have been missed while the folder was not watched
+                    self._add_pending(folder_id, path)
+                else:
+                    self._remove_watch(folder_id, path)
+
+            folders.filtered(lambda f: f.id in self.roots).write(
+                {"last_watch": fields.Datetime.now()}
+            )
+            # The scheduled scan must not wait for the folders which cannot be watched anymore
+            folders.filtered(lambda f: f.id not in self.roots and f.last_watch).write(
+                {"last_watch": False}
+            )
+        return bool(roots)
+
+    def _add_watch(self, folder_id, path):
+        """
+        Watch a directory and all its sub-directories.
+
+        :return bool: False if the directory cannot be watched, e.g. because of the inotify limits
+        """
+        for rootdir, dirnames, filenames in os.walk(path):
+            try:
+                wd = self.inotify.add_watch(rootdir, self.MASK)
+            except OSError:
+                _logger.warning(
+                    'Cannot watch "%s". It might be necessary to increase the value of '
+                    '"fs.inotify.max_user_watches". Falling back to scheduled scan.',
+                    rootdir,
+                    exc_info=True,
+                )
+                return False
+            self.wds[wd] = (folder_id, rootdir)
+        return True
+
+    def _remove_watch(self, folder_id, path):
+        """
+        Stop watching a directory and all its sub-directories.
+        """
+        for wd, (wd_folder_id, wd_path) in list(self.wds.items()):
+            if wd_folder_id == folder_id and (wd_path == path or wd_path.startswith(path + os.sep)):
+                del self.wds[wd]
+                try:
+                    self.inotify.rm_watch(wd)
+                except OSError:
+                    pass
+
+    def _unwatch_folder(self, folder_id):
+        """
+        Stop watching a folder which is not watched entirely anymore. The folder is refreshed
+        right away, so it is either watched again or left to the scheduled scan.
+        """
+        path = self.roots.pop(folder_id, None)
+        if path:
+            self._remove_watch(folder_id, path)
+        self.pending.pop(folder_id, None)
+        self.time_refresh = 0.0
+
+    def _add_pending(self, folder_id, path, recursive=True):
+        """
+        Register a directory to scan, with its sub-directories if `recursive` is set.
+        """
+        pending = self.pending.setdefault(folder_id, {})
+        pending[path] = pending.get(path, False) or recursive
+
+    def _handle_event(self, event):
+        """
+        Register the directory impacted by an event.
+        """
+        if event.mask & flags.IGNORED:
+            self.wds.pop(event.wd, None)
+            return
+        if event.mask & flags.Q_OVERFLOW:
+            # Some events were lost, rescan everything
+            for folder_id, path in self.roots.items():
+                self._add_pending(folder_id, path)
+            return
+        if event.wd not in self.wds:
+            return
+
+        self.time_event = time.time()
+        folder_id, rootdir = self.wds[event.wd]
+        path = os.path.join(rootdir, event.name)
+        if event.mask & flags.ISDIR:
+            if event.mask & (flags.CREATE | flags.MOVED_TO):
+                if not self._add_watch(folder_id, path):
+                    self._unwatch_folder(folder_id)
+                    return
+            elif event.mask & flags.MOVED_FROM:
+                self._remove_watch(folder_id, path)
+            self._add_pending(folder_id, path)
+        else:
+            self._add_pending(folder_id, rootdir, recursive=False)
+
+    def _scan_pending(self, registry):
+        """
+        Scan the directories which have been modified. A folder being scanned is kept for later.
+        """
+        with api.Environment.manage(), registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            FolderScan = env["oomusic.folder.scan"].with_context(
+                recompute=False, prefetch_fields=False
+            )
+            for folder_id in list(self.pending):
+                folder = env["oomusic.folder"].browse(folder_id).exists()
+                if not folder:
+                    del self.pending[folder_id]
+                    continue
+                if folder.locked:
+                    continue
+
+                paths, shallow_paths = self._get_scan_paths(self.pending.pop(folder_id))
+                _logger.debug('Scanning modified directories "%s"', paths + shallow_paths)
+                try:
+                    FolderScan._scan_folder(folder_id, paths=paths, shallow_paths=shallow_paths)
+                except Exception:
+                    _logger.exception(
+                        'Error while scanning "%s" (id: %s)', paths + shallow_paths, folder_id
+                    )
+
+    def _get_scan_paths(self, pending):
+        """
+        Split the pending directories of a folder into the ones to scan recursively and the ones
+        to scan without their sub-directories. The directories included in a directory scanned
+        recursively are removed. A directory containing a directory scanned recursively is scanned
+        recursively as well, since the shallow paths cannot contain other paths.
+
+        :param dict pending: directories to scan, with their recursive flag
+        :return tuple: lists (paths, shallow_paths)
+        """
+        recursive = [p for p, r in pending.items() if r]
+        for path in [p for p, r in pending.items() if not r]:
+            if any(r.startswith(path + os.sep) for r in recursive):
+                recursive.append(path)
+        paths = []
+        for path in sorted(recursive):
+            if not paths or not path.startswith(paths[-1] + os.sep):
+                paths.append(path)
+        prefixes = tuple(p + os.sep for p in paths)
+        shallow_paths = sorted(p for p in pending if p not in paths and not p.startswith(prefixes))
+        return paths, shallow_paths
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 
-from odoo import fields, models
+from odoo import api, fields, models
 
 
 class MusicFormat(models.Model):
@@ -12,3 +12,20 @@ class MusicFormat(models.Model):
     mimetype = fields.Char("Mimetype", required=True)
 
     _sql_constraints = [("oomusic_format_name_uniq", "unique(name)", "Format name must be unique!")]
+
+    # The transcoders cache the formats by name
+    @api.model
+    def create(self, vals):
+        res = super(MusicFormat, self).create(vals)
+        self.clear_caches()
+        return res
+
+    def write(self, vals):
+        res = super(MusicFormat, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(MusicFormat, self).unlink()
+        self.clear_caches()
+        return res
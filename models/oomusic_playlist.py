@@ -345,7 +345,9 @@ class MusicPlaylistLine(models.Model):
         "oomusic.playlist", "Playlist", required=True, index=True, ondelete="cascade"
     )
     playing = fields.Boolean("Playing", default=False)
-    track_id = fields.Many2one("oomusic.track", "Track", required=True, ondelete="cascade")
+    track_id = fields.Many2one(
+        "oomusic.track", "Track", required=True, index=True, ondelete="cascade"
+    )
     track_number = fields.Char(
         "Track #", related="track_id.track_number", readonly=True, related_sudo=False
     )
@@ -370,7 +372,7 @@ class MusicPlaylistLine(models.Model):
     )
     last_play = fields.Datetime("Last Played", readonly=True)
 
-    def oomusic_set_current(self):
+    def oomusic_set_current(self, shuffle=False, output_format=False):
         now = fields.Datetime.now()
         res = {}
         if not self.id:
@@ -387,8 +389,38 @@ class MusicPlaylistLine(models.Model):
 
         # Specific case of a dynamic playlist
         self.playlist_id._update_dynamic()
+
+        # The next line is drawn at random when shuffling, so it cannot be prepared
+        if not shuffle:
+            self._prefetch_next(output_format=output_format)
         return json.dumps(res)
 
+    def _prefetch_next(self, output_format=False):
+        """
+        Transcode the next lines of the playlist in the background, so they are ready in the
+        transcoding cache when played.
+
+        :param str output_format: format played by the client. If it is not given or not
+            supported, the first output format supported by the browsers is used.
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        count = int(ConfigParam.get_param("oomusic.prefetch_count", 2))
+        audio_mode = self.playlist_id.audio_mode
+        if count <= 0 or audio_mode == "raw" or ConfigParam.get_param("oomusic.trans_disabled"):
+            return
+        Transcoder = self.env["oomusic.transcoder"]
+        output_formats = Transcoder._get_browser_output_formats()
+        lines = self.playlist_id.playlist_line_ids
+        if not output_formats or self.id not in lines._ids:
+            return
+        if output_format not in output_formats:
+            output_format = list(output_formats)[0]
+        idx = lines._ids.index(self.id)
+        next_lines = (lines[idx + 1 :] + lines[:idx])[:count]
+        Transcoder.prefetch(
+            next_lines.mapped("track_id").ids, output_format, norm=audio_mode == "norm"
+        )
+
     def oomusic_play_skip(self, play=False):
         now = fields.Datetime.now()
         # Do not update the Play/Skip ratio more than once every 5 minutes for a given track
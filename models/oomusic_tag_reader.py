@@ -0,0 +1,582 @@
+# -*- coding: utf-8 -*-
+
+"""
+Fast tag reader, used by the folder scanner when the "Fast" file analysis is selected.
+
+Only the headers of the files are parsed: the text tags, the duration and the bitrate. The file is
+opened once, the reads are bounded and the blocks which are not needed, such as the embedded
+pictures, are skipped with a seek. MP3, FLAC, Ogg Vorbis, Opus and MP4 files are supported.
+
+All functions only rely on their arguments and return picklable data, since they might be executed
+in a separate process.
+"""
+
+import os
+import struct
+from io import BytesIO
+
+from mutagen.id3 import TCON
+
+# Maximum size (bytes) of a block read entirely, e.g. a tag frame or a comment packet. Larger
+# blocks are skipped, since they are pictures or other binary data.
+MAX_BLOCK_SIZE = 1 << 20
+
+# Number of bytes searched for the first MPEG frame, after the ID3v2 tag
+MPEG_SYNC_SIZE = 1 << 16
+
+# Number of bytes read at the end of an Ogg file to find the last page
+OGG_END_SIZE = 1 << 16
+
+ID3_FRAMES = {
+    "TALB": "ALBUM",
+    "TCOM": "COMPOSER",
+    "TCON": "GENRE",
+    "TCOP": "COPYRIGHT",
+    "TDRC": "DATE",
+    "TENC": "ENCODED-BY",
+    "TIT2": "TITLE",
+    "TPE1": "ARTIST",
+    "TPE2": "ALBUMARTIST",
+    "TPOS": "DISCNUMBER",
+    "TRCK": "TRACKNUMBER",
+    "TYER": "DATE",
+}
+
+# Frame IDs of ID3v2.2
+ID3_FRAMES_V22 = {
+    "TAL": "TALB",
+    "TCM": "TCOM",
+    "TCO": "TCON",
+    "TCR": "TCOP",
+    "TEN": "TENC",
+    "TP1": "TPE1",
+    "TP2": "TPE2",
+    "TPA": "TPOS",
+    "TRK": "TRCK",
+    "TT2": "TIT2",
+    "TXX": "TXXX",
+    "TYE": "TYER",
+}
+
+ID3_ENCODINGS = {0: ("latin-1", b"\x00"), 1: ("utf-16", b"\x00\x00"), 2: ("utf-16-be", b"\x00\x00")}
+ID3_ENCODINGS[3] = ("utf-8", b"\x00")
+
+MP4_ATOMS = {
+    b"\xa9ART": "ARTIST",
+    b"\xa9alb": "ALBUM",
+    b"\xa9day": "DATE",
+    b"\xa9gen": "GENRE",
+    b"\xa9nam": "TITLE",
+    b"\xa9too": "ENCODED-BY",
+    b"\xa9wrt": "COMPOSER",
+    b"aART": "ALBUMARTIST",
+    b"cprt": "COPYRIGHT",
+    b"desc": "DESCRIPTION",
+}
+
+# Bitrates (kbps) by MPEG version, layer and index
+MPEG_BITRATES = {
+    (1, 1): [0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448],
+    (1, 2): [0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384],
+    (1, 3): [0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320],
+    (2, 1): [0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256],
+    (2, 2): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+    (2, 3): [0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160],
+}
+
+# Sample rates (Hz) by MPEG version, 2.5 being written 3
+MPEG_SAMPLE_RATES = {1: [44100, 48000, 32000], 2: [22050, 24000, 16000], 3: [11025, 12000, 8000]}
+
+
+def read_tags(f):
+    """
+    Read the tags and the audio properties of a file, parsing its headers only. The file is not
+    closed, so that the caller can read it further, e.g. to compute its fingerprint.
+
+    :param f: file opened in binary mode
+    :return tuple: (tags, duration, bitrate), where tags are lists of values by upper case name,
+        the duration is in seconds and the bitrate in kbps. None if the format is not supported.
+    """
+    size = os.fstat(f.fileno()).st_size
+    f.seek(0)
+    header = f.read(12)
+    f.seek(0)
+    if header[:4] == b"fLaC":
+        return _read_flac(f, size)
+    if header[:4] == b"OggS":
+        return _read_ogg(f, size)
+    if header[4:8] == b"ftyp":
+        return _read_mp4(f, size)
+    if header[:3] == b"ID3" or (header[:1] == b"\xff" and header[1:2] >= b"\xe0"):
+        return _read_mp3(f, size)
+    return None
+
+
+def _add_tag(tags, key, values):
+    for value in values:
+        value = value.strip("\x00").strip()
+        if value:
+            tags.setdefault(key, []).append(value)
+
+
+def _bitrate(size, duration):
+    return int(round(size * 8 / duration / 1000.0)) if duration else 0
+
+
+# ---------------------------------------------------------------------------------------------------
+# MP3
+# ---------------------------------------------------------------------------------------------------
+
+
+def _syncsafe(data):
+    return (data[0] << 21) | (data[1] << 14) | (data[2] << 7) | data[3]
+
+
+def _unsync(data):
+    return data.replace(b"\xff\x00", b"\xff")
+
+
+def _decode_id3_text(data):
+    """
+    Decode the content of an ID3 text frame, which might hold several values.
+    """
+    if not data:
+        return []
+    encoding, sep = ID3_ENCODINGS.get(data[0], ID3_ENCODINGS[0])
+    data = data[1:]
+    if len(sep) == 2:
+        # Split on aligned double null bytes only
+        values = []
+        start = 0
+        for i in range(0, len(data) - 1, 2):
+            if data[i : i + 2] == sep:
+                values.append(data[start:i])
+                start = i + 2
+        values.append(data[start:])
+    else:
+        values = data.split(sep)
+    res = []
+    for value in values:
+        if encoding == "utf-16" and value and value[:2] not in (b"\xff\xfe", b"\xfe\xff"):
+            # Values following the first one might not repeat the BOM
+            value = b"\xff\xfe" + value
+        res.append(value.decode(encoding, "replace"))
+    return res
+
+
+def _convert_id3_genre(value):
+    """
+    Convert the references to ID3v1 genres, e.g. "(17)" or "17", to their name.
+    """
+    ref = value[1:].split(")")[0] if value.startswith("(") else value
+    if ref.isdigit() and int(ref) < len(TCON.GENRES):
+        return TCON.GENRES[int(ref)]
+    return value
+
+
+def _read_id3v2(f):
+    """
+    Read the text frames of an ID3v2 tag located at the current position. The other frames are
+    skipped.
+
+    :return tuple: (tags, size of the tag)
+    """
+    header = f.read(10)
+    version, flags = header[3], header[5]
+    tag_size = _syncsafe(header[6:10]) + 10
+    if flags & 0x10:
+        tag_size += 10  # footer
+    tags = {}
+    if version not in (2, 3, 4):
+        return tags, tag_size
+
+    def read_frames(stream, end):
+        id_size, header_size = (3, 6) if version == 2 else (4, 10)
+        while stream.tell() + header_size <= end:
+            frame_header = stream.read(header_size)
+            frame_id = frame_header[:id_size]
+            if not frame_id.strip(b"\x00"):
+                break  # padding
+            if version == 2:
+                frame_size = int.from_bytes(frame_header[3:6], "big")
+                frame_flags = 0
+            elif version == 3:
+                frame_size = int.from_bytes(frame_header[4:8], "big")
+                frame_flags = int.from_bytes(frame_header[8:10], "big")
+            else:
+                frame_size = _syncsafe(frame_header[4:8])
+                frame_flags = int.from_bytes(frame_header[8:10], "big")
+            frame_id = frame_id.decode("latin-1")
+            if version == 2:
+                frame_id = ID3_FRAMES_V22.get(frame_id, frame_id)
+            if (
+                (frame_id not in ID3_FRAMES and frame_id != "TXXX")
+                or frame_size > MAX_BLOCK_SIZE
+                or stream.tell() + frame_size > end
+            ):
+                stream.seek(frame_size, os.SEEK_CUR)
+                continue
+            data = stream.read(frame_size)
+
+            # Compressed and encrypted frames are ignored
+            if version == 3:
+                if frame_flags & 0x00C0:
+                    continue
+                if frame_flags & 0x0020:
+                    data = data[1:]
+            elif version == 4:
+                if frame_flags & 0x000C:
+                    continue
+                if frame_flags & 0x0040:
+                    data = data[1:]
+                if frame_flags & 0x0001:
+                    data = data[4:]
+                if frame_flags & 0x0002:
+                    data = _unsync(data)
+
+            values = _decode_id3_text(data)
+            if frame_id == "TXXX":
+                if len(values) > 1:
+                    _add_tag(tags, values[0].upper(), values[1:])
+                continue
+            key = ID3_FRAMES[frame_id]
+            if key == "GENRE":
+                values = [_convert_id3_genre(v) for v in values]
+            if key not in tags:
+                _add_tag(tags, key, values)
+
+    start = f.tell() - 10
+    if flags & 0x40 and version >= 3:
+        ext_size = int.from_bytes(f.read(4), "big") if version == 3 else _syncsafe(f.read(4))
+        f.seek(ext_size - (0 if version == 3 else 4), os.SEEK_CUR)
+    if flags & 0x80 and version < 4:
+        # The whole tag is unsynchronised, which is rare enough to read it entirely
+        data = _unsync(f.read(start + tag_size - f.tell()))
+        read_frames(BytesIO(data), len(data))
+    else:
+        read_frames(f, start + tag_size)
+    return tags, tag_size
+
+
+def _read_id3v1(f, size):
+    """
+    Read the ID3v1 tag at the end of a file, if any.
+
+    :return dict: tags, or None if there is no ID3v1 tag
+    """
+    if size < 128:
+        return None
+    f.seek(size - 128)
+    data = f.read(128)
+    if data[:3] != b"TAG":
+        return None
+    tags = {}
+    for key, start, end in [("TITLE", 3, 33), ("ARTIST", 33, 63), ("ALBUM", 63, 93)]:
+        _add_tag(tags, key, [data[start:end].split(b"\x00")[0].decode("latin-1")])
+    _add_tag(tags, "DATE", [data[93:97].split(b"\x00")[0].decode("latin-1")])
+    if data[125] == 0 and data[126]:
+        tags["TRACKNUMBER"] = [str(data[126])]
+    if data[127] < len(TCON.GENRES):
+        tags["GENRE"] = [TCON.GENRES[data[127]]]
+    return tags
+
+
+def _parse_mpeg_header(data):
+    """
+    Parse the header of an MPEG audio frame.
+
+    :return tuple: (version, layer, bitrate, sample rate, padding, mono), or None if invalid
+    """
+    if data[0] != 0xFF or data[1] & 0xE0 != 0xE0:
+        return None
+    version = {0: 3, 2: 2, 3: 1}.get((data[1] >> 3) & 0x03)
+    layer = 4 - ((data[1] >> 1) & 0x03)
+    bitrate_index = data[2] >> 4
+    rate_index = (data[2] >> 2) & 0x03
+    if not version or layer == 4 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    bitrate = MPEG_BITRATES[(min(version, 2), layer)][bitrate_index]
+    sample_rate = MPEG_SAMPLE_RATES[version][rate_index]
+    return version, layer, bitrate, sample_rate, (data[2] >> 1) & 0x01, data[3] >> 6 == 3
+
+
+def _mpeg_frame_size(version, layer, bitrate, sample_rate, padding):
+    if layer == 1:
+        return (12 * bitrate * 1000 // sample_rate + padding) * 4
+    if layer == 3 and version > 1:
+        return 72 * bitrate * 1000 // sample_rate + padding
+    return 144 * bitrate * 1000 // sample_rate + padding
+
+
+def _read_mp3(f, size):
+    tags = {}
+    audio_start = 0
+    if f.read(3) == b"ID3":
+        f.seek(0)
+        tags, audio_start = _read_id3v2(f)
+    id3v1 = _read_id3v1(f, size)
+    for key, values in (id3v1 or {}).items():
+        tags.setdefault(key, values)
+    audio_end = size - 128 if id3v1 is not None else size
+
+    # Find the first valid frame, checking that the next one follows
+    f.seek(audio_start)
+    data = f.read(MPEG_SYNC_SIZE)
+    info = None
+    pos = data.find(b"\xff")
+    while 0 <= pos < len(data) - 4:
+        info = _parse_mpeg_header(data[pos : pos + 4])
+        if info:
+            frame_size = _mpeg_frame_size(*info[:5])
+            next_pos = pos + frame_size
+            if frame_size and (
+                next_pos + 4 > len(data) or _parse_mpeg_header(data[next_pos : next_pos + 4])
+            ):
+                break
+        info = None
+        pos = data.find(b"\xff", pos + 1)
+    if not info:
+        # Not an MPEG stream, e.g. a FLAC file with an ID3v2 tag
+        return None
+    version, layer, bitrate, sample_rate, padding, mono = info
+    samples = 384 if layer == 1 else (576 if layer == 3 and version > 1 else 1152)
+    audio_size = audio_end - audio_start - pos
+
+    # A Xing/Info or VBRI header gives the number of frames, and possibly the size of the stream.
+    # "Info" is written in the constant bitrate files.
+    frames = None
+    if version == 1:
+        xing = pos + 4 + (17 if mono else 32)
+    else:
+        xing = pos + 4 + (9 if mono else 17)
+    if data[xing : xing + 4] in (b"Xing", b"Info"):
+        xing_flags = int.from_bytes(data[xing + 4 : xing + 8], "big")
+        offset = xing + 8
+        if xing_flags & 0x01:
+            frames = int.from_bytes(data[offset : offset + 4], "big")
+            offset += 4
+        if xing_flags & 0x02:
+            audio_size = int.from_bytes(data[offset : offset + 4], "big") or audio_size
+        if data[xing : xing + 4] == b"Info":
+            audio_size = None
+    elif data[pos + 36 : pos + 40] == b"VBRI":
+        audio_size = int.from_bytes(data[pos + 46 : pos + 50], "big") or audio_size
+        frames = int.from_bytes(data[pos + 50 : pos + 54], "big")
+    if frames:
+        duration = frames * samples / float(sample_rate)
+        return tags, int(duration), _bitrate(audio_size, duration) if audio_size else bitrate
+    return tags, int((audio_size or 0) * 8 / (bitrate * 1000.0)), bitrate
+
+
+# ---------------------------------------------------------------------------------------------------
+# Vorbis comments: FLAC and Ogg
+# ---------------------------------------------------------------------------------------------------
+
+
+def _read_vorbis_comment(data, tags):
+    """
+    Read a Vorbis comment block. A truncated block is read up to the last complete comment.
+    """
+    if len(data) < 8:
+        return
+    pos = 4 + struct.unpack("<I", data[:4])[0]
+    if pos + 4 > len(data):
+        return
+    count = struct.unpack("<I", data[pos : pos + 4])[0]
+    pos += 4
+    for i in range(count):
+        if pos + 4 > len(data):
+            break
+        length = struct.unpack("<I", data[pos : pos + 4])[0]
+        pos += 4
+        if pos + length > len(data):
+            break
+        comment = data[pos : pos + length].decode("utf-8", "replace")
+        pos += length
+        if "=" in comment:
+            key, value = comment.split("=", 1)
+            _add_tag(tags, key.upper(), [value])
+
+
+def _read_flac(f, size):
+    tags = {}
+    duration = 0.0
+    f.seek(4)
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            break
+        block_type = header[0] & 0x7F
+        length = int.from_bytes(header[1:4], "big")
+        if block_type == 0:
+            data = f.read(length)
+            sample_rate = int.from_bytes(data[10:13], "big") >> 4
+            total_samples = int.from_bytes(data[13:18], "big") & 0x0FFFFFFFFF
+            if sample_rate:
+                duration = total_samples / float(sample_rate)
+        elif block_type == 4 and length <= MAX_BLOCK_SIZE:
+            _read_vorbis_comment(f.read(length), tags)
+        else:
+            f.seek(length, os.SEEK_CUR)
+        if header[0] & 0x80:
+            break
+    return tags, int(duration), _bitrate(size - f.tell(), duration)
+
+
+def _read_ogg_page(f):
+    """
+    Read the header of the Ogg page at the current position.
+
+    :return tuple: (granule position, serial number, segment sizes), or None at the end
+    """
+    header = f.read(27)
+    if len(header) < 27 or header[:4] != b"OggS":
+        return None
+    granule, serial = struct.unpack("<qI", header[6:18])
+    return granule, serial, list(f.read(header[26]))
+
+
+def _read_ogg_packets(f, count):
+    """
+    Read the first packets of the first logical stream. The packets larger than `MAX_BLOCK_SIZE`
+    are truncated.
+
+    :return tuple: (packets, serial number)
+    """
+    packets = []
+    packet = b""
+    first_serial = None
+    while len(packets) < count:
+        page = _read_ogg_page(f)
+        if not page:
+            break
+        granule, serial, segments = page
+        if first_serial is None:
+            first_serial = serial
+        if serial != first_serial:
+            f.seek(sum(segments), os.SEEK_CUR)
+            continue
+        for segment in segments:
+            if len(packet) < MAX_BLOCK_SIZE:
+                packet += f.read(segment)
+            else:
+                f.seek(segment, os.SEEK_CUR)
+            if segment < 255:
+                packets.append(packet)
+                packet = b""
+                if len(packets) == count:
+                    break
+    return packets, first_serial
+
+
+def _read_ogg(f, size):
+    packets, serial = _read_ogg_packets(f, 2)
+    if len(packets) < 2:
+        return None
+    tags = {}
+    if packets[0][:7] == b"\x01vorbis" and packets[1][:7] == b"\x03vorbis":
+        sample_rate = struct.unpack("<I", packets[0][12:16])[0]
+        pre_skip = 0
+        _read_vorbis_comment(packets[1][7:], tags)
+    elif packets[0][:8] == b"OpusHead" and packets[1][:8] == b"OpusTags":
+        sample_rate = 48000
+        pre_skip = struct.unpack("<H", packets[0][10:12])[0]
+        _read_vorbis_comment(packets[1][8:], tags)
+    else:
+        return None
+
+    # The granule position of the last page gives the number of samples
+    f.seek(max(0, size - OGG_END_SIZE))
+    data = f.read(OGG_END_SIZE)
+    granule = 0
+    pos = data.rfind(b"OggS")
+    while pos >= 0:
+        if len(data) >= pos + 18:
+            page_granule, page_serial = struct.unpack("<qI", data[pos + 6 : pos + 18])
+            if page_serial == serial and page_granule > 0:
+                granule = page_granule
+                break
+        pos = data.rfind(b"OggS", 0, pos)
+    duration = max(granule - pre_skip, 0) / float(sample_rate) if sample_rate else 0.0
+    return tags, int(duration), _bitrate(size, duration)
+
+
+# ---------------------------------------------------------------------------------------------------
+# MP4
+# ---------------------------------------------------------------------------------------------------
+
+
+def _iter_atoms(f, end):
+    """
+    Iterate over the atoms located between the current position and `end`. The position is set
+    after each atom before the next one is read.
+
+    :return: generator of tuples (type, start of the content, end of the atom)
+    """
+    while f.tell() + 8 <= end:
+        start = f.tell()
+        header = f.read(8)
+        atom_size, atom_type = struct.unpack(">I4s", header)
+        if atom_size == 1:
+            atom_size = struct.unpack(">Q", f.read(8))[0]
+        elif atom_size == 0:
+            atom_size = end - start
+        if atom_size < 8:
+            break
+        atom_end = min(start + atom_size, end)
+        yield atom_type, f.tell(), atom_end
+        f.seek(atom_end)
+
+
+def _read_mp4_item(f, item_type, end, tags):
+    for atom_type, start, atom_end in _iter_atoms(f, end):
+        if atom_type != b"data" or atom_end - start > MAX_BLOCK_SIZE:
+            continue
+        data = f.read(atom_end - start)
+        data_type, value = int.from_bytes(data[1:4], "big"), data[8:]
+        if item_type in MP4_ATOMS and data_type == 1:
+            _add_tag(tags, MP4_ATOMS[item_type], [value.decode("utf-8", "replace")])
+        elif item_type in (b"trkn", b"disk") and len(value) >= 6:
+            number, total = struct.unpack(">HH", value[2:6])
+            key = "TRACKNUMBER" if item_type == b"trkn" else "DISCNUMBER"
+            if number:
+                tags.setdefault(key, []).append(
+                    "{}/{}".format(number, total) if total else str(number)
+                )
+        elif item_type == b"gnre" and len(value) >= 2:
+            genre = struct.unpack(">H", value[:2])[0] - 1
+            if 0 <= genre < len(TCON.GENRES):
+                tags.setdefault("GENRE", []).append(TCON.GENRES[genre])
+
+
+def _read_mp4(f, size):
+    tags = {}
+    duration = 0.0
+    for atom_type, start, end in _iter_atoms(f, size):
+        if atom_type != b"moov":
+            continue
+        for moov_type, moov_start, moov_end in _iter_atoms(f, end):
+            if moov_type == b"mvhd":
+                data = f.read(min(moov_end - moov_start, 32))
+                if data[0] == 1:
+                    timescale, length = struct.unpack(">IQ", data[20:32])
+                else:
+                    timescale, length = struct.unpack(">II", data[12:20])
+                if timescale:
+                    duration = length / float(timescale)
+            elif moov_type == b"udta":
+                for udta_type, udta_start, udta_end in _iter_atoms(f, moov_end):
+                    if udta_type != b"meta":
+                        continue
+                    # The meta atom usually has a version and flags, but not in QuickTime files
+                    if f.read(8)[4:8] != b"hdlr":
+                        f.seek(udta_start + 4)
+                    else:
+                        f.seek(udta_start)
+                    for meta_type, meta_start, meta_end in _iter_atoms(f, udta_end):
+                        if meta_type != b"ilst":
+                            continue
+                        for item_type, item_start, item_end in _iter_atoms(f, meta_end):
+                            _read_mp4_item(f, item_type, item_end, tags)
+        break
+    return tags, int(duration), _bitrate(size, duration)
@@ -1,7 +1,13 @@
 # -*- coding: utf-8 -*-
 
 import json
+import logging
 import os
+import re
+import shutil
+import subprocess
+import time
+from concurrent.futures import ProcessPoolExecutor
 from hashlib import sha1
 from shutil import copyfile
 from tempfile import gettempdir
@@ -9,9 +15,49 @@ from time import sleep
 from urllib.parse import urlencode
 from zipfile import ZipFile
 
-from odoo import _, fields, models
+from odoo import _, api, fields, models, tools
 from odoo.exceptions import MissingError, UserError
 
+_logger = logging.getLogger(__name__)
+
+
+def _analyze_loudness(file_path):
+    """
+    Measure the integrated loudness and the true peak of a file with the EBU R128 filter of
+    FFmpeg. This function is executed in a separate process when the analysis is parallelized, so
+    it only relies on its argument.
+
+    :param str file_path: path of the file to analyze
+    :return tuple: loudness (LUFS) and true peak (dBTP), or None in case of error
+    """
+    cmd = [
+        "ffmpeg",
+        "-nostdin",
+        "-nostats",
+        "-hide_banner",
+        "-i",
+        file_path,
+        "-vn",
+        "-af",
+        "ebur128=peak=true:framelog=verbose",
+        "-f",
+        "null",
+        "-",
+    ]
+    try:
+        proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except OSError:
+        _logger.warning('Error while analyzing loudness of "%s"', file_path, exc_info=True)
+        return None
+    output = proc.stderr.decode("utf-8", "replace")
+    summary = output[output.rfind("Summary:") :]
+    loudness = re.search(r"\bI:\s+(-?\d+(?:\.\d+)?) LUFS", summary)
+    peak = re.search(r"\bPeak:\s+(-?\d+(?:\.\d+)?) dBFS", summary)
+    if proc.returncode or not loudness or not peak:
+        _logger.warning('Could not analyze loudness of "%s"', file_path)
+        return None
+    return float(loudness.group(1)), float(peak.group(1))
+
 
 class MusicTrack(models.Model):
     _name = "oomusic.track"
@@ -24,17 +70,17 @@ class MusicTrack(models.Model):
     # ID3 Tags
     name = fields.Char("Title", required=True, index=True)
     artist_id = fields.Many2one("oomusic.artist", string="Artist", index=True)
-    album_artist_id = fields.Many2one("oomusic.artist", string="Album Artist")
+    album_artist_id = fields.Many2one("oomusic.artist", string="Album Artist", index=True)
     album_id = fields.Many2one("oomusic.album", string="Album", index=True)
     disc = fields.Char("Disc", index=True)
     year = fields.Char("Year")
     track_number = fields.Char("Track #", index=True)
     track_number_int = fields.Integer("Track # (int)", index=True)
     track_total = fields.Char("Total Tracks")
-    genre_id = fields.Many2one("oomusic.genre", string="Genre")
+    genre_id = fields.Many2one("oomusic.genre", string="Genre", index=True)
     description = fields.Char("Description")
     composer = fields.Char("Composer")
-    performer_id = fields.Many2one("oomusic.artist", string="Original Artist")
+    performer_id = fields.Many2one("oomusic.artist", string="Original Artist", index=True)
     copyright = fields.Char("Copyright")
     contact = fields.Char("Contact")
     encoded_by = fields.Char("Encoder")
@@ -45,6 +91,18 @@ class MusicTrack(models.Model):
     bitrate = fields.Integer("Bitrate (kbps)", readonly=True)
     path = fields.Char("Path", required=True, index=True, readonly=True)
     size = fields.Float("File Size (MiB)", readonly=True)
+    loudness = fields.Float(
+        "Loudness (LUFS)",
+        readonly=True,
+        help="Integrated loudness of the track, used to normalize the volume when playing.",
+    )
+    loudness_peak = fields.Float("True Peak (dBTP)", readonly=True)
+    loudness_modification = fields.Integer(
+        "Loudness Analysis",
+        readonly=True,
+        help="Last modification of the file when its loudness was analyzed. The analysis is done "
+        "again if the file is modified.",
+    )
     play_count = fields.Integer(
         "Play Count",
         readonly=True,
@@ -88,6 +146,11 @@ class MusicTrack(models.Model):
         search="_search_last_play_skip_ratio",
     )
     last_modification = fields.Integer("Last Modification", readonly=True)
+    fingerprint = fields.Char(
+        "Fingerprint",
+        readonly=True,
+        help="Fingerprint of the file, used to detect a track which has been moved or renamed.",
+    )
     root_folder_id = fields.Many2one(
         "oomusic.folder", string="Root Folder", index=True, required=True
     )
@@ -123,6 +186,17 @@ class MusicTrack(models.Model):
         search="_search_tag_ids",
     )
 
+    # Number of files analyzed per worker before committing the loudness analysis, and maximum
+    # duration (s) of a run of the scheduled action
+    LOUDNESS_BATCH_SIZE = 8
+    LOUDNESS_CRON_TIME = 600
+
+    def init(self):
+        # Used by the scanner to select the tracks of a path with a prefix condition
+        tools.create_index(
+            self._cr, "oomusic_track_path_prefix_index", self._table, ["path varchar_pattern_ops"]
+        )
+
     def _search_play_count(self, operator, value):
         res = super(MusicTrack, self)._search_play_count(operator, value)
         # Special case when we are searching for tracks never played. In this case, these tracks
@@ -258,3 +332,83 @@ class MusicTrack(models.Model):
             + str(count)
         )
         return json.loads(self.env["oomusic.lastfm"].get_query(url))
+
+    def _get_loudness_pending(self, after_id, limit):
+        """
+        Select the tracks whose loudness was never analyzed, or whose file was modified since
+        the analysis.
+
+        :param int after_id: only tracks with a greater ID are selected
+        :param int limit: maximum number of tracks
+        :return list: tuples (id, path, last_modification), ordered by ID
+        """
+        self.env.cr.execute(
+            """
+            SELECT id, path, last_modification
+            FROM oomusic_track
+            WHERE id > %s AND loudness_modification IS DISTINCT FROM last_modification
+            ORDER BY id
+            LIMIT %s;
+            """,
+            (after_id, limit),
+        )
+        return self.env.cr.fetchall()
+
+    def _write_loudness(self, results):
+        """
+        Save the loudness analysis of files. The tracks of all users sharing a file are updated,
+        unless the file was modified in the meantime. A failed analysis is saved without values,
+        so the file is only analyzed again once modified.
+
+        :param list results: tuples (path, last_modification, result of `_analyze_loudness`)
+        """
+        for path, mtime, res in results:
+            loudness, peak = res or (None, None)
+            self.env.cr.execute(
+                """
+                UPDATE oomusic_track
+                SET loudness = %s, loudness_peak = %s, loudness_modification = %s
+                WHERE path = %s AND last_modification = %s;
+                """,
+                (loudness, peak, mtime, path, mtime),
+            )
+        self.invalidate_cache(["loudness", "loudness_peak", "loudness_modification"])
+
+    @api.model
+    def cron_analyze_loudness(self):
+        """
+        Analyze the loudness of the tracks in the background, so the normalization is a simple
+        gain at playing time. The tracks are processed by batches, each batch being committed: a
+        run stopped after `LOUDNESS_CRON_TIME` seconds, or interrupted, is resumed by the next one.
+        """
+        if not shutil.which("ffmpeg"):
+            _logger.warning("Cannot analyze loudness since FFmpeg is not installed.")
+            return
+        workers = max(
+            int(self.env["ir.config_parameter"].sudo().get_param("oomusic.loudness_workers", 1)),
+            1,
+        )
+        time_limit = time.time() + self.LOUDNESS_CRON_TIME
+        executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            after_id = 0
+            while time.time() < time_limit:
+                tracks = self._get_loudness_pending(after_id, workers * self.LOUDNESS_BATCH_SIZE)
+                if not tracks:
+                    break
+                after_id = tracks[-1][0]
+
+                # Tracks of several users can share the same file
+                files = list({(t[1], t[2]) for t in tracks})
+                paths = [f[0] for f in files]
+                results = (
+                    executor.map(_analyze_loudness, paths)
+                    if executor
+                    else map(_analyze_loudness, paths)
+                )
+                self._write_loudness([f + (res,) for f, res in zip(files, results)])
+                if not self.env.context.get("test_mode"):
+                    self.env.cr.commit()
+        finally:
+            if executor:
+                executor.shutdown()
@@ -1,11 +1,452 @@
 # -*- coding: utf-8 -*-
 
 import datetime
+import fcntl
+import logging
 import os
 import subprocess
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha1
+from multiprocessing import cpu_count
 
-from odoo import fields, models
-from odoo.tools import OrderedSet
+from odoo import _, api, fields, models, tools
+from odoo.exceptions import UserError
+from odoo.tools import OrderedSet, config
+
+_logger = logging.getLogger(__name__)
+
+# Pool of threads transcoding the next tracks of the playlists in the background, and paths of the
+# cache files queued or being written by the pool
+_prefetch = {"executor": None, "workers": 0, "pending": set()}
+_prefetch_lock = threading.Lock()
+
+# Maximum number of transcodings queued per thread of the prefetch pool
+PREFETCH_QUEUE_SIZE = 4
+
+# Transcoding slots of the server. A slot is a POSIX lock on a file, so the limit is shared by all
+# the Odoo processes, e.g. the workers in multi-processing mode. Locks are per process: the slots
+# held by the threads of this process are tracked here, with a file descriptor per slot file.
+_slots = {"fds": {}, "held": set(), "waiting": 0}
+_slots_lock = threading.Lock()
+
+# Statistics of the slots acquired by this process: number, total and maximum waiting time (s),
+# and number of requests which timed out
+_slots_stats = {"count": 0, "wait": 0.0, "wait_max": 0.0, "timeouts": 0}
+
+# Delay (s) between two attempts to acquire a slot
+SLOT_POLL = 0.1
+
+# Transcoding processes started by this process and not reaped yet
+_procs = set()
+_procs_lock = threading.Lock()
+
+# Delay (s) given to a transcoding process to exit once terminated, before it is killed
+TERMINATE_TIMEOUT = 2.0
+
+
+class TranscoderBusy(UserError):
+    """
+    Raised when a transcoding waited too long for a slot.
+    """
+
+
+def _reset_slots():
+    # The locks are not inherited by a forked process
+    global _slots_lock, _procs_lock
+    _slots_lock = threading.Lock()
+    _slots.update({"fds": {}, "held": set(), "waiting": 0})
+    # The children of the parent process are not ours
+    _procs_lock = threading.Lock()
+    _procs.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_slots)
+
+
+class TranscodeScheduler(object):
+    """
+    Admission control of the transcoding processes. A process is only started once a slot is
+    acquired, and the slot is released when the process ends.
+
+    Interactive transcodings, i.e. streams, have priority over the background ones, such as the
+    converter jobs and the prefetching: a quarter of the slots is reserved for them, and the
+    background transcodings do not take a free slot while a stream is waiting. A stream which
+    waits longer than the timeout is refused. Background transcodings have their own, usually
+    longer, timeout: they might hold database locks while waiting, e.g. the converter jobs.
+    """
+
+    def __init__(self, slot_dir, max_processes, timeout, background_timeout=0):
+        """
+        :param str slot_dir: directory of the slot files
+        :param int max_processes: number of slots, 0 for no limit
+        :param float timeout: maximum waiting time (s) of the interactive transcodings
+        :param float background_timeout: maximum waiting time (s) of the background transcodings,
+            0 for no limit
+        """
+        self.slot_dir = slot_dir
+        self.max_processes = max_processes
+        self.timeout = timeout
+        self.background_timeout = background_timeout
+
+    def _get_fd(self, name):
+        path = os.path.join(self.slot_dir, name)
+        fd = _slots["fds"].get(path)
+        if fd is None:
+            os.makedirs(self.slot_dir, exist_ok=True)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            _slots["fds"][path] = fd
+        return fd
+
+    def _try_lock(self, fd, shared=False):
+        try:
+            fcntl.lockf(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+    def _is_stream_waiting(self):
+        # Streams waiting in any process hold a shared lock on this file
+        if _slots["waiting"]:
+            return True
+        fd = self._get_fd("waiting.lock")
+        if not self._try_lock(fd):
+            return True
+        fcntl.lockf(fd, fcntl.LOCK_UN)
+        return False
+
+    def _set_waiting(self, waiting):
+        _slots["waiting"] += 1 if waiting else -1
+        if waiting and _slots["waiting"] == 1:
+            fcntl.lockf(self._get_fd("waiting.lock"), fcntl.LOCK_SH)
+        elif not waiting and not _slots["waiting"]:
+            fcntl.lockf(self._get_fd("waiting.lock"), fcntl.LOCK_UN)
+
+    def _try_acquire(self, background):
+        if background and self._is_stream_waiting():
+            return False
+        reserved = max(self.max_processes // 4, 1) if self.max_processes > 1 else 0
+        if background:
+            indexes = range(self.max_processes - reserved)
+        else:
+            indexes = reversed(range(self.max_processes))
+        for i in indexes:
+            name = "slot{}.lock".format(i)
+            if name in _slots["held"]:
+                continue
+            if self._try_lock(self._get_fd(name)):
+                _slots["held"].add(name)
+                return name
+        return False
+
+    def acquire(self, background=False):
+        """
+        Wait for a free slot.
+
+        :param bool background: the transcoding is not interactive
+        :return str: name of the slot, True if there is no limit, False in case of timeout
+        """
+        if not self.max_processes:
+            return True
+        timeout = self.background_timeout if background else self.timeout
+        start = time.time()
+        waiting = False
+        try:
+            while True:
+                with _slots_lock:
+                    slot = self._try_acquire(background)
+                    wait = time.time() - start
+                    if slot:
+                        _slots_stats["count"] += 1
+                        _slots_stats["wait"] += wait
+                        _slots_stats["wait_max"] = max(_slots_stats["wait_max"], wait)
+                    elif timeout and wait >= timeout:
+                        _slots_stats["timeouts"] += 1
+                    elif not background and not waiting:
+                        self._set_waiting(True)
+                        waiting = True
+                if slot:
+                    if wait > 1.0:
+                        _logger.info("Transcoding started after waiting %.1fs", wait)
+                    return slot
+                if timeout and wait >= timeout:
+                    _logger.warning("No transcoding slot available after %.1fs", wait)
+                    return False
+                time.sleep(SLOT_POLL)
+        finally:
+            if waiting:
+                with _slots_lock:
+                    self._set_waiting(False)
+
+    def release(self, slot):
+        """
+        Release a slot acquired by `acquire`.
+        """
+        if slot is True:
+            return
+        with _slots_lock:
+            if slot in _slots["held"]:
+                fcntl.lockf(self._get_fd(slot), fcntl.LOCK_UN)
+                _slots["held"].discard(slot)
+
+    def count_running(self):
+        """
+        Count the transcoding slots in use by all the processes of the server. The slots held by
+        other processes are found by trying to lock them, so this is only meant for monitoring.
+
+        :return int: number of slots in use, None if there is no limit
+        """
+        if not self.max_processes:
+            return None
+        count = 0
+        with _slots_lock:
+            for i in range(self.max_processes):
+                name = "slot{}.lock".format(i)
+                if name in _slots["held"]:
+                    count += 1
+                    continue
+                fd = self._get_fd(name)
+                if self._try_lock(fd):
+                    fcntl.lockf(fd, fcntl.LOCK_UN)
+                else:
+                    count += 1
+        return count
+
+    def spawn(self, cmd, background=False):
+        """
+        Start a transcoding process once a slot is acquired. The slot is attached to the process,
+        and released by `TranscodeOutput` when the process ends.
+
+        :param list cmd: transcoding command
+        :param bool background: the transcoding is not interactive
+        :return: process, None if no slot was available in time
+        :rtype: subprocess.Popen
+        """
+        slot = self.acquire(background=background)
+        if not slot:
+            return None
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        except Exception:
+            self.release(slot)
+            raise
+        proc.oomusic_slot = (self, slot)
+        with _procs_lock:
+            _procs.add(proc)
+        return proc
+
+
+def _terminate(proc):
+    """
+    Stop a transcoding process if it is still running, reap it and release its slot. The process
+    is given some time to exit cleanly before being killed.
+
+    :param proc: transcoding process, as returned by `TranscodeScheduler.spawn`
+    """
+    try:
+        proc.stdout.close()
+        if proc.poll() is None:
+            proc.terminate()
+            try:
+                proc.wait(timeout=TERMINATE_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                _logger.warning("Transcoding process %s killed", proc.pid)
+                proc.kill()
+                proc.wait()
+    finally:
+        with _procs_lock:
+            _procs.discard(proc)
+        if getattr(proc, "oomusic_slot", None):
+            scheduler, slot = proc.oomusic_slot
+            scheduler.release(slot)
+
+
+def _reap():
+    """
+    Reap the transcoding processes of this process which exited on their own, but whose output
+    was never read.
+
+    :return int: number of transcoding processes still running
+    """
+    with _procs_lock:
+        procs = list(_procs)
+    running = 0
+    for proc in procs:
+        if proc.poll() is None:
+            running += 1
+        elif not getattr(proc, "oomusic_output", False):
+            _terminate(proc)
+    return running
+
+
+def _evict_cache(cache_dir, max_size):
+    """
+    Remove the least recently used files of the transcoding cache until its size fits in the
+    budget. A file is marked as used by updating its modification date. Files being written are
+    ignored.
+
+    :param str cache_dir: path of the cache directory
+    :param int max_size: maximum size of the cache, in bytes
+    """
+    entries = []
+    total = 0
+    try:
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".tmp") or not entry.is_file(follow_symlinks=False):
+                continue
+            stat = entry.stat(follow_symlinks=False)
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+    except OSError:
+        _logger.warning('Cannot list the transcoding cache "%s"', cache_dir, exc_info=True)
+        return
+    for mtime, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+class TranscodeOutput(object):
+    """
+    Output of a transcoding process, read by chunks. If a cache path is given, the output is
+    written there at the same time. The file is only added to the cache once the transcoding
+    succeeded, so an interrupted stream leaves nothing behind. Once the output is read entirely,
+    `complete` tells whether the transcoding succeeded.
+
+    The process is terminated and reaped as soon as the output is closed, e.g. by the WSGI server
+    when the client disconnects because the player skipped the track, and its transcoding slot is
+    released. An output which is never closed does the same once garbage collected, and at the
+    latest when the server stops.
+
+    The output is read while the response is sent, after the request cursor is closed. Therefore,
+    it does not use the environment.
+    """
+
+    def __init__(self, proc, buffer_size, cache_path=False, cache_size=0):
+        """
+        :param proc: transcoding process, as returned by `MusicTranscoder.transcode`
+        :param int buffer_size: size of the chunks, in bytes
+        :param str cache_path: path of the cached file
+        :param int cache_size: size of the cache, in bytes
+        """
+        self.proc = proc
+        self.buffer_size = buffer_size
+        self.cache_path = cache_path
+        self.cache_size = cache_size
+        self.complete = False
+        self._gen = None
+        proc.oomusic_output = True
+        # The finalizer must not reference the output, otherwise it is never garbage collected
+        self._finalizer = weakref.finalize(self, _terminate, proc)
+
+    def __iter__(self):
+        if self._gen is None:
+            self._gen = self._read()
+        return self._gen
+
+    def _read(self):
+        f = False
+        if self.cache_path:
+            tmp_path = "{}.{}-{}.tmp".format(self.cache_path, os.getpid(), threading.get_ident())
+            try:
+                f = open(tmp_path, "wb")
+            except OSError:
+                _logger.warning(
+                    'Cannot write "%s" in the transcoding cache', tmp_path, exc_info=True
+                )
+        complete = False
+        try:
+            while True:
+                data = self.proc.stdout.read(self.buffer_size)
+                if not data:
+                    break
+                if f:
+                    f.write(data)
+                yield data
+            complete = self.proc.wait() == 0
+            self.complete = complete
+        finally:
+            self._finalizer()
+            if f:
+                f.close()
+                if complete:
+                    os.replace(tmp_path, self.cache_path)
+                    _evict_cache(os.path.dirname(self.cache_path), self.cache_size)
+                else:
+                    os.remove(tmp_path)
+
+    def close(self):
+        """
+        Stop the transcoding. Called by the WSGI server once the response is sent or aborted.
+        """
+        if self._gen is not None:
+            self._gen.close()
+        self._finalizer()
+
+
+def _prefetch_file(scheduler, cmd, buffer_size, cache_path, cache_size):
+    """
+    Transcode a track into the cache, without streaming it.
+
+    :param scheduler: TranscodeScheduler instance
+    :param list cmd: transcoding command
+    :param int buffer_size: size of the chunks read, in bytes
+    :param str cache_path: path of the cached file
+    :param int cache_size: size of the cache, in bytes
+    """
+    try:
+        if os.path.exists(cache_path):
+            return
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        proc = scheduler.spawn(cmd, background=True)
+        if not proc:
+            return
+        output = TranscodeOutput(proc, buffer_size, cache_path, cache_size)
+        try:
+            for data in output:
+                pass
+        finally:
+            output.close()
+    except Exception:
+        _logger.warning('Error while prefetching "%s"', cache_path, exc_info=True)
+    finally:
+        with _prefetch_lock:
+            _prefetch["pending"].discard(cache_path)
+
+
+def _submit_prefetch(scheduler, jobs, workers, cache_size):
+    """
+    Queue transcodings in the prefetch pool of the process. The pool is created on first use, and
+    again if the number of threads was changed. Jobs are dropped once the queue is full.
+
+    :param scheduler: TranscodeScheduler instance
+    :param list jobs: tuples (cmd, buffer_size, cache_path)
+    :param int workers: number of threads of the pool
+    :param int cache_size: size of the cache, in bytes
+    """
+    with _prefetch_lock:
+        if not _prefetch["executor"] or _prefetch["workers"] != workers:
+            if _prefetch["executor"]:
+                _prefetch["executor"].shutdown(wait=False)
+            _prefetch["executor"] = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="oomusic.prefetch"
+            )
+            _prefetch["workers"] = workers
+        pending = _prefetch["pending"]
+        for cmd, buffer_size, cache_path in jobs:
+            if cache_path in pending or len(pending) >= workers * PREFETCH_QUEUE_SIZE:
+                continue
+            pending.add(cache_path)
+            _prefetch["executor"].submit(
+                _prefetch_file, scheduler, cmd, buffer_size, cache_path, cache_size
+            )
 
 
 class MusicTranscoder(models.Model):
@@ -13,6 +454,10 @@ class MusicTranscoder(models.Model):
     _description = "Music Transcoder"
     _order = "sequence"
 
+    # Loudness targeted by the normalization (LUFS), and maximum true peak (dBTP) once normalized
+    NORM_LOUDNESS = -18.0
+    NORM_MAX_PEAK = -1.0
+
     name = fields.Char("Transcoder Name", required=True)
     sequence = fields.Integer(
         default=10,
@@ -53,18 +498,63 @@ class MusicTranscoder(models.Model):
         before playing.""",
     )
 
-    def transcode(self, track_id, bitrate=0, seek=0, norm=False):
+    def transcode(self, track_id, bitrate=0, seek=0, norm=False, background=False):
         """
         Method used to transcode a track. It takes in charge the replacement of the specific
         keywords of the command, and returns the subprocess executed. The subprocess output is
         redirected to stdout, so it is possible to stream the transcoding result while it is still
         ongoing.
+
+        The process is started through the transcoding scheduler, which limits the number of
+        concurrent processes. Its output must be read with `TranscodeOutput`, which terminates the
+        process when closed and releases the transcoding slot.
         :param track_id: ID of the track to transcode
         :param bitrate: value of the bitrate for the output file. Optional field aimed to override
             the default value
         :param seek: start time for the encoding
+        :param norm: normalize the loudness of the output
+        :param background: the transcoding is not interactive, e.g. a converter job. It has a lower
+            priority, and a longer timeout to wait for a slot.
         :returns: subprocess redirected to stdout.
         :rtype: subprocess.Popen
+        :raises TranscoderBusy: no slot was available in time
+        """
+        self.ensure_one()
+
+        cmd = self._get_command(track_id, bitrate=bitrate, seek=seek, norm=norm)
+        proc = self._get_scheduler().spawn(cmd, background=background)
+        if not proc:
+            raise TranscoderBusy(_("Too many transcodings are running, try again later."))
+        return proc
+
+    def _get_scheduler(self):
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        return TranscodeScheduler(
+            os.path.join(config["data_dir"], "oomusic_trans_slots"),
+            int(ConfigParam.get_param("oomusic.trans_max_processes", cpu_count())),
+            float(ConfigParam.get_param("oomusic.trans_queue_timeout", 30)),
+            float(ConfigParam.get_param("oomusic.trans_background_timeout", 600)),
+        )
+
+    def get_transcode_stats(self):
+        """
+        :return dict: statistics of the transcoding slots acquired by this process: number,
+            average and maximum waiting time (s), number of timeouts. Also gives the number of
+            transcoding processes running, started by this process and by the whole server (None
+            if the number of processes is not limited).
+        """
+        with _slots_lock:
+            stats = dict(_slots_stats)
+        stats["wait_avg"] = stats["wait"] / stats["count"] if stats["count"] else 0.0
+        stats["processes"] = _reap()
+        stats["running"] = self._get_scheduler().count_running()
+        return stats
+
+    def _get_command(self, track_id, bitrate=0, seek=0, norm=False):
+        """
+        Build the command transcoding a track. Same parameters as `transcode`.
+
+        :return list: arguments of the command
         """
         self.ensure_one()
 
@@ -72,18 +562,176 @@ class MusicTranscoder(models.Model):
         cmd = (
             self.command.replace("%s", "%s" % (str(datetime.timedelta(seconds=seek))))
             .replace("%b", "%d" % (bitrate or self.bitrate))
-            .replace("%n", "-af loudnorm=I=-18" if norm else "")
+            .replace("%n", self._get_norm_filter(Track) if norm else "")
             .replace("%f", "%s" % os.path.splitext(Track.path)[1][1:])
         )
         cmd = [c for c in cmd.split(" ") if c]
         cmd[cmd.index("%i")] = Track.path
+        return cmd
 
-        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=open(os.devnull, "w"))
-        return proc
+    @api.model
+    def create(self, vals):
+        res = super(MusicTranscoder, self).create(vals)
+        self.clear_caches()
+        return res
 
-    def _get_browser_output_formats(self):
-        return OrderedSet(
-            self.search([("output_format", "in", ["opus", "ogg", "mp3"])]).mapped(
-                "output_format.name"
+    def write(self, vals):
+        res = super(MusicTranscoder, self).write(vals)
+        self.clear_caches()
+        return res
+
+    def unlink(self):
+        res = super(MusicTranscoder, self).unlink()
+        self.clear_caches()
+        return res
+
+    def _get_transcoder(self, output_format, input_format):
+        """
+        Find the transcoder to use for a conversion. The choice is cached by `_get_transcoder_id`.
+
+        :param str output_format: name of the output format, e.g. "mp3"
+        :param str input_format: name of the input format, i.e. the file extension
+        :return: oomusic.transcoder record, empty if none is available
+        """
+        return self.browse(self._get_transcoder_id(output_format, input_format))
+
+    @tools.ormcache("output_format", "input_format")
+    def _get_transcoder_id(self, output_format, input_format):
+        # Cached until a transcoder or a format is modified, in all the server processes
+        return (
+            self.sudo()
+            .search([("output_format.name", "=", output_format)])
+            .filtered(lambda r: input_format not in r.mapped("black_formats.name"))[:1]
+            .id
+        )
+
+    def prefetch(self, track_ids, output_format, norm=False):
+        """
+        Transcode tracks in the background, so they are in the transcoding cache when they are
+        played. The transcodings run in a pool of threads shared by the whole process, whose size
+        limits the CPU used. Tracks already cached or queued are ignored.
+
+        :param list track_ids: IDs of the tracks, by order of priority
+        :param str output_format: name of the output format
+        :param bool norm: normalize the loudness of the output
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        workers = int(ConfigParam.get_param("oomusic.prefetch_workers", 1))
+        cache_size = self._get_cache_size()
+        if workers <= 0 or not cache_size:
+            return
+        jobs = []
+        for track in self.env["oomusic.track"].browse(track_ids):
+            transcoder = self._get_transcoder(output_format, os.path.splitext(track.path)[1][1:])
+            if not transcoder:
+                continue
+            cache_path = transcoder._get_cache_path(track, norm=norm)
+            if os.path.exists(cache_path):
+                continue
+            cmd = transcoder._get_command(track.id, norm=norm)
+            jobs.append((cmd, transcoder.buffer_size * 1024, cache_path))
+        if jobs:
+            _submit_prefetch(self._get_scheduler(), jobs, workers, cache_size)
+
+    def _get_cache_dir(self):
+        return os.path.join(config["data_dir"], "oomusic_trans_cache", self.env.cr.dbname)
+
+    def _get_cache_size(self):
+        """
+        :return int: size of the transcoding cache in bytes, 0 if the cache is deactivated
+        """
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        return int(ConfigParam.get_param("oomusic.trans_cache_size", 1024)) * 1024 * 1024
+
+    def _get_cache_path(self, track, bitrate=0, norm=False):
+        """
+        Path of the cached transcoding of a track. The name of the file is a hash of everything
+        which changes the output: the track and its modification date, the transcoder command, the
+        bitrate and the normalization filter.
+
+        :param track: oomusic.track record
+        :return str: path of the file, which might not exist
+        """
+        key = "{}:{}:{}:{}:{}:{}".format(
+            track.id,
+            track.last_modification,
+            self.id,
+            self.command,
+            bitrate or self.bitrate,
+            self._get_norm_filter(track) if norm else "",
+        )
+        return os.path.join(
+            self._get_cache_dir(),
+            "{}.{}".format(sha1(key.encode("utf-8")).hexdigest(), self.output_format.name),
+        )
+
+    def get_cached_file(self, track_id, bitrate=0, norm=False):
+        """
+        Look for a transcoding of a track in the cache. On hit, the file is marked as recently
+        used, so it is evicted last.
+
+        :param track_id: ID of the track
+        :return str: path of the cached file, False if there is none
+        """
+        self.ensure_one()
+        if not self._get_cache_size():
+            return False
+        Track = self.env["oomusic.track"].browse([track_id])
+        cache_path = self._get_cache_path(Track, bitrate=bitrate, norm=norm)
+        try:
+            os.utime(cache_path)
+        except OSError:
+            return False
+        return cache_path
+
+    def transcode_stream(self, track_id, bitrate=0, seek=0, norm=False):
+        """
+        Transcode a track and return its output by chunks of the buffer size. Unless the track is
+        seeked, the output is saved in the transcoding cache at the same time, so the next request
+        can be served by `get_cached_file`.
+
+        Same parameters as `transcode`.
+
+        :returns: iterable of bytes, to close once read
+        :rtype: TranscodeOutput
+        """
+        self.ensure_one()
+        cache_size = self._get_cache_size()
+        cache_path = False
+        if cache_size and not seek:
+            Track = self.env["oomusic.track"].browse([track_id])
+            cache_path = self._get_cache_path(Track, bitrate=bitrate, norm=norm)
+            try:
+                os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            except OSError:
+                _logger.warning("Cannot create the transcoding cache", exc_info=True)
+                cache_path = False
+        proc = self.transcode(track_id, bitrate=bitrate, seek=seek, norm=norm)
+        return TranscodeOutput(proc, self.buffer_size * 1024, cache_path, cache_size)
+
+    def _get_norm_filter(self, track):
+        """
+        Build the audio filter normalizing the loudness of a track. If the loudness was analyzed
+        beforehand, a simple gain is applied, limited so that the true peak does not clip.
+        Otherwise, the much slower `loudnorm` filter measures the loudness while transcoding.
+
+        :param track: oomusic.track record
+        :return str: audio filter option of FFmpeg
+        """
+        if track.loudness and track.loudness_modification == track.last_modification:
+            gain = min(
+                self.NORM_LOUDNESS - track.loudness, self.NORM_MAX_PEAK - track.loudness_peak
             )
+            return "-af volume=%.2fdB" % gain
+        return "-af loudnorm=I=%d" % self.NORM_LOUDNESS
+
+    def _get_browser_output_formats(self):
+        return OrderedSet(self._get_browser_output_format_names())
+
+    @tools.ormcache()
+    def _get_browser_output_format_names(self):
+        return tuple(
+            self.sudo()
+            .search([("output_format", "in", ["opus", "ogg", "mp3"])])
+            .mapped("output_format.name")
         )
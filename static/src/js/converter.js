@@ -0,0 +1,46 @@
+odoo.define('oomusic.Converter', function (require) {
+'use strict';
+
+require('bus.BusService');
+var FormController = require('web.FormController');
+var FormView = require('web.FormView');
+var viewRegistry = require('web.view_registry');
+
+
+//-----------------------------------------------------------------------------
+// ConverterFormView: reload the converter when its conversion progresses
+//-----------------------------------------------------------------------------
+
+var ConverterFormController = FormController.extend({
+    start: function () {
+        // A line is converted every few seconds: limit the reloads of a large converter
+        this._throttledReload = _.throttle(this.reload.bind(this), 5000);
+        this.call('bus_service', 'onNotification', this, this._onNotification);
+        this.call('bus_service', 'startPolling');
+        return this._super.apply(this, arguments);
+    },
+
+    _onNotification: function (notifications) {
+        var state = this.model.get(this.handle);
+        if (!state || this.mode !== 'readonly') {
+            return;
+        }
+        var reload = _.some(notifications, function (notification) {
+            return notification[0][1] === 'oomusic.converter' &&
+                notification[1]['converter_id'] === state.res_id;
+        });
+        if (reload) {
+            this._throttledReload();
+        }
+    },
+});
+
+var ConverterFormView = FormView.extend({
+    config: _.extend({}, FormView.prototype.config, {
+        Controller: ConverterFormController,
+    }),
+});
+
+viewRegistry.add('oomusic_converter_form', ConverterFormView);
+
+});
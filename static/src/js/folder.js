@@ -0,0 +1,45 @@
+odoo.define('oomusic.Folder', function (require) {
+'use strict';
+
+require('bus.BusService');
+var FormController = require('web.FormController');
+var FormView = require('web.FormView');
+var viewRegistry = require('web.view_registry');
+
+
+//-----------------------------------------------------------------------------
+// FolderFormView: reload the folder when its scan progresses
+//-----------------------------------------------------------------------------
+
+var FolderFormController = FormController.extend({
+    start: function () {
+        this.call('bus_service', 'onNotification', this, this._onNotification);
+        this.call('bus_service', 'startPolling');
+        return this._super.apply(this, arguments);
+    },
+
+    _onNotification: function (notifications) {
+        var self = this;
+        var state = this.model.get(this.handle);
+        if (!state || this.mode !== 'readonly') {
+            return;
+        }
+        var reload = _.some(notifications, function (notification) {
+            return notification[0][1] === 'oomusic.folder.scan' &&
+                notification[1]['folder_id'] === state.res_id;
+        });
+        if (reload) {
+            self.reload();
+        }
+    },
+});
+
+var FolderFormView = FormView.extend({
+    config: _.extend({}, FormView.prototype.config, {
+        Controller: FolderFormController,
+    }),
+});
+
+viewRegistry.add('oomusic_folder_form', FolderFormView);
+
+});
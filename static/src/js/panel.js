@@ -339,7 +339,7 @@ var Panel = Widget.extend({
             return this._rpc({
                     model: 'oomusic.playlist.line',
                     method: 'oomusic_set_current',
-                    args: [[this.current_playlist_line_id]],
+                    args: [[this.current_playlist_line_id], this.shuffle, this._getOutputFormat()],
                 })
                 .then(function () {
                     core.bus.trigger(
@@ -350,6 +350,19 @@ var Panel = Widget.extend({
         }
     },
 
+    /**
+     * Return the format of the transcoded sound being played, so the next tracks are transcoded
+     * in the same format. Howler selects the first source supported by the browser when the sound
+     * is loaded.
+     */
+    _getOutputFormat: function () {
+        if (!this.sound || !_.isString(this.sound._src) || this.sound._src.match('mode=raw')) {
+            return false;
+        }
+        var match = this.sound._src.match(/\/oomusic\/trans\/\d+\.(\w+)\?/);
+        return match ? match[1] : false;
+    },
+
     _clearCache: function () {
         _.each(this.cache_sound, function (v, k) {
             v.unload()
@@ -4,7 +4,11 @@ from . import test_artist
 from . import test_converter
 from . import test_download
 from . import test_folder_scan
+from . import test_folder_scan_benchmark
+from . import test_folder_watch
 from . import test_folder
 from . import test_playlist
 from . import test_sub_bookmark
 from . import test_sub_browsing
+from . import test_track
+from . import test_transcoder
@@ -41,3 +41,33 @@ class TestOomusicAlbum(test_common.TestOomusicCommon):
         )
 
         self.cleanUp()
+
+    def test_10_merge_duplicates(self):
+        """
+        Test the merge of the albums created twice by concurrent scans
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        album1 = self.AlbumObj.search([("name", "=", "Album1")])
+        tracks = album1.track_ids
+        self.assertEqual(len(tracks), 2)
+
+        # Databases created before the constraint may contain duplicates
+        self.env.cr.execute(
+            "ALTER TABLE oomusic_album DROP CONSTRAINT oomusic_album_oomusic_album_name_uniq"
+        )
+        album1_dup = album1.copy({"name": album1.name})
+        tracks[1].album_id = album1_dup
+        album1_dup.star = "1"
+        self.AlbumObj.flush()
+
+        album_ids = self.AlbumObj._merge_duplicates()
+        self.AlbumObj.invalidate_cache()
+        self.assertEqual(album_ids, [album1.id])
+        self.assertFalse(album1_dup.exists())
+        self.assertEqual(tracks.mapped("album_id"), album1)
+        self.assertEqual(album1.star, "1")
+
+        # Nothing is left to merge
+        self.assertEqual(self.AlbumObj._merge_duplicates(), [])
+
+        self.cleanUp()
@@ -1,12 +1,16 @@
 # -*- coding: utf-8 -*-
 
 import hashlib
+import json
 import os
 import shutil
+import time
 from multiprocessing import cpu_count
 from tempfile import gettempdir
 
 from odoo import fields
+from odoo.addons.bus.models.bus import json_dump
+from odoo.addons.oomusic.models.oomusic_converter import ConversionManifest
 
 from . import test_common
 
@@ -123,7 +127,16 @@ class TestOomusicConverter(test_common.TestOomusicCommon):
         conv.with_context(test_mode=True).action_convert()
 
         self.assertEqual(conv.state, u"done")
-        # self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+
+        # The progress is notified to the user of the converter
+        channel = json_dump((self.env.cr.dbname, "oomusic.converter", conv.user_id.id))
+        notifications = self.env["bus.bus"].search([("channel", "=", channel)])
+        self.assertEqual(
+            [json.loads(n.message)["progress"] for n in notifications.sorted("id")],
+            [50.0, 100.0, 100.0],
+        )
+
         path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
         file1 = os.path.join(path, u"song1.mp3")
         file2 = os.path.join(path, u"song2.mp3")
@@ -162,7 +175,7 @@ class TestOomusicConverter(test_common.TestOomusicCommon):
         conv.with_context(test_mode=True).action_convert()
 
         self.assertEqual(conv.state, u"done")
-        # self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
         path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
         file1 = os.path.join(path, u"song1.mp3")
         file2 = os.path.join(path, u"song2.mp3")
@@ -184,3 +197,197 @@ class TestOomusicConverter(test_common.TestOomusicCommon):
 
         self.cleanUp()
         shutil.rmtree(conv.dest_folder, True)
+
+    def test_30_convert_resume(self):
+        """
+        Test the resumption of an interrupted conversion
+        """
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv = self.ConverterObj.create({})
+
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv.bitrate = 320
+        conv._onchange_album_id()
+        conv.action_run()
+        conv.invalidate_cache()
+
+        # A run which reached its time limit does not start any line
+        conv.with_context(test_mode=True)._convert_worker(time.time())
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"waiting", u"waiting"])
+        self.assertEqual(conv.progress, 0.0)
+
+        # The first line was converted before the interruption, only the second one is left
+        conv.converter_line_ids[0].write({"state": "done"})
+        conv.invalidate_cache()
+        self.assertEqual(conv.progress, 50.0)
+        conv.with_context(test_mode=True).action_convert()
+
+        self.assertEqual(conv.state, u"done")
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+        path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
+        self.assertFalse(os.path.exists(os.path.join(path, u"song1.mp3")))
+        self.assertTrue(os.path.exists(os.path.join(path, u"song2.mp3")))
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_40_convert_incremental(self):
+        """
+        Test the incremental conversion, which skips the tracks already converted
+        """
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv = self.ConverterObj.create({"incremental": True})
+
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv.bitrate = 320
+        conv._onchange_album_id()
+        conv.action_run()
+        conv.invalidate_cache()
+        conv.with_context(test_mode=True).action_convert()
+
+        self.assertEqual(conv.state, u"done")
+        path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
+        file1 = os.path.join(path, u"song1.mp3")
+        file2 = os.path.join(path, u"song2.mp3")
+        self.assertTrue(os.path.exists(file1))
+        self.assertTrue(os.path.exists(file2))
+
+        # The files already converted are not converted again
+        os.utime(file1, (0, 0))
+        conv.action_draft()
+        conv.action_run()
+        conv.invalidate_cache()
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.state, u"done")
+        self.assertEqual(os.stat(file1).st_mtime, 0)
+
+        # The file of a track removed from the converter is deleted
+        conv.action_draft()
+        conv.converter_line_ids[1].unlink()
+        conv.action_run()
+        conv.invalidate_cache()
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.state, u"done")
+        self.assertEqual(os.stat(file1).st_mtime, 0)
+        self.assertFalse(os.path.exists(file2))
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_50_convert_incremental_shared(self):
+        """
+        Test incremental converters sharing the same destination folder
+        """
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv1 = self.ConverterObj.create({"incremental": True})
+        conv2 = self.ConverterObj.create({"incremental": True})
+        self.assertEqual(conv1.dest_folder, conv2.dest_folder)
+
+        for conv, album in [(conv1, "Album1"), (conv2, "Album2")]:
+            conv.album_id = self.AlbumObj.search([("name", "=", album)])
+            conv.bitrate = 320
+            conv._onchange_album_id()
+            conv.action_run()
+            conv.invalidate_cache()
+            conv.with_context(test_mode=True).action_convert()
+            self.assertEqual(conv.state, u"done")
+
+        # Emptying a converter only removes its own files
+        conv1.action_draft()
+        conv1.action_purge()
+        conv1.action_run()
+        conv1.with_context(test_mode=True)._convert_done()
+        conv1.invalidate_cache()
+        self.assertEqual(conv1.state, u"done")
+        path = os.path.join(conv1.dest_folder, u"Artist1")
+        self.assertFalse(os.path.exists(os.path.join(path, u"Album1", u"song1.mp3")))
+        self.assertTrue(os.path.exists(os.path.join(path, u"Album2", u"song3.mp3")))
+
+        self.cleanUp()
+        shutil.rmtree(conv1.dest_folder, True)
+
+    def test_60_convert_busy(self):
+        """
+        Test a conversion without transcoding slot available
+        """
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        conv = self.ConverterObj.create(
+            {"transcoder_id": self.env.ref("oomusic.oomusic_transcoder_1").id}
+        )
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv._onchange_album_id()
+        conv.action_run()
+        conv.invalidate_cache()
+
+        # The lines wait for the next run
+        ConfigParam = self.env["ir.config_parameter"].sudo()
+        ConfigParam.set_param("oomusic.trans_max_processes", 1)
+        ConfigParam.set_param("oomusic.trans_background_timeout", 1)
+        scheduler = self.env["oomusic.transcoder"]._get_scheduler()
+        slot = scheduler.acquire()
+        try:
+            conv.with_context(test_mode=True).action_convert()
+        finally:
+            scheduler.release(slot)
+        self.assertEqual(conv.state, u"running")
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"waiting", u"waiting"])
+
+        conv.with_context(test_mode=True).action_convert()
+        self.assertEqual(conv.state, u"done")
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"done", u"done"])
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_70_convert_failure(self):
+        """
+        Test a conversion whose transcoding fails
+        """
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_1")
+        Transcoder.command = "ffmpeg -v 0 -i %i -f oomusic_unknown_format -"
+        conv = self.ConverterObj.create({"transcoder_id": Transcoder.id})
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv._onchange_album_id()
+        conv.action_run()
+        conv.invalidate_cache()
+        conv.with_context(test_mode=True).action_convert()
+
+        # No file is left behind
+        self.assertEqual(conv.converter_line_ids.mapped("state"), [u"error", u"error"])
+        path = os.path.join(conv.dest_folder, u"Artist1", u"Album1")
+        self.assertFalse(os.path.exists(os.path.join(path, u"song1.opus")))
+        self.assertFalse(os.path.exists(os.path.join(path, u"song1.opus.tmp")))
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
+
+    def test_75_convert_incremental_failure(self):
+        """
+        Test an incremental conversion whose transcoding fails
+        """
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_1")
+        Transcoder.command = "ffmpeg -v 0 -i %i -f oomusic_unknown_format -"
+        conv = self.ConverterObj.create({"transcoder_id": Transcoder.id, "incremental": True})
+        conv.album_id = self.AlbumObj.search([("name", "=", "Album1")])
+        conv._onchange_album_id()
+
+        # The failed conversions are not recorded, so they are not skipped by the next run
+        for i in range(2):
+            conv.action_run()
+            conv.invalidate_cache()
+            conv.with_context(test_mode=True).action_convert()
+            self.assertEqual(conv.converter_line_ids.mapped("state"), [u"error", u"error"])
+        manifest = ConversionManifest(conv.dest_folder)
+        file = os.path.join(u"Artist1", u"Album1", u"song1.opus")
+        self.assertFalse(manifest.get(file, conv.id))
+
+        self.cleanUp()
+        shutil.rmtree(conv.dest_folder, True)
@@ -57,6 +57,73 @@ class TestOomusicFolderScan(test_common.TestOomusicCommon):
 
         self.cleanUp()
 
+    def test_05_initial_scan_parallel(self):
+        """
+        Test a scan of the folder with files read in parallel
+        """
+        self.Folder.write({"scan_mode": "parallel", "scan_workers": 2})
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+
+        # Verify the music.track data
+        ref_data = {
+            "Song1": (u"01", u"Artist1", u"Album1", u"Genre1", u"2001"),
+            "Song2": (u"02", u"Artist1", u"Album1", u"Genre1", u"2001"),
+            "Song3": (u"01", u"Artist1", u"Album2", u"Genre2", u"2002"),
+            "Song4": (u"02", u"Artist1", u"Album2", u"Genre2", u"2002"),
+            "Song5": (u"01", u"Artist2", u"Album3", u"Genre3", u"2003"),
+            "Song6": (u"02", u"Artist2", u"Album3", u"Genre3", u"2003"),
+        }
+        self.assertEqual(set(Tracks.mapped("name")), set(ref_data.keys()))
+        for Track in Tracks:
+            self.assertEqual(
+                ref_data[Track.name],
+                (
+                    Track.track_number,
+                    Track.artist_id.name,
+                    Track.album_id.name,
+                    Track.genre_id.name,
+                    Track.year,
+                ),
+            )
+
+        self.cleanUp()
+
+    def test_06_initial_scan_fast(self):
+        """
+        Test a scan of the folder with the fast tag reader
+        """
+        self.Folder.write({"tag_analysis": "fast"})
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+
+        # Verify the music.track data
+        ref_data = {
+            "Song1": ("01", "Artist1", "Album1", "Genre1", "2001", 1, 128),
+            "Song2": ("02", "Artist1", "Album1", "Genre1", "2001", 1, 128),
+            "Song3": ("01", "Artist1", "Album2", "Genre2", "2002", 1, 128),
+            "Song4": ("02", "Artist1", "Album2", "Genre2", "2002", 1, 128),
+            "Song5": ("01", "Artist2", "Album3", "Genre3", "2003", 1, 128),
+            "Song6": ("02", "Artist2", "Album3", "Genre3", "2003", 1, 128),
+        }
+        self.assertEqual(set(Tracks.mapped("name")), set(ref_data.keys()))
+        for Track in Tracks:
+            self.assertEqual(
+                ref_data[Track.name],
+                (
+                    Track.track_number,
+                    Track.artist_id.name,
+                    Track.album_id.name,
+                    Track.genre_id.name,
+                    Track.year,
+                    Track.duration,
+                    Track.bitrate,
+                ),
+            )
+            self.assertTrue(Track.fingerprint)
+
+        self.cleanUp()
+
     def test_10_modify_tags(self):
         """
         Test a modification of the tags of existing tracks.
@@ -186,6 +253,72 @@ class TestOomusicFolderScan(test_common.TestOomusicCommon):
 
         self.cleanUp()
 
+    def test_25_move_track(self):
+        """
+        Test a move of a track to another directory.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Track = self.TrackObj.search([("name", "=", "Song1")])
+        Track.write({"rating": "5"})
+
+        new_path = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            "folder_scan_test",
+            "Artist2",
+            "Album3",
+            "song1.mp3",
+        )
+        shutil.move(Track.path, new_path)
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("name", "=", "Song1")])
+
+        # The track is kept, with its new location
+        self.assertEqual(Tracks.id, Track.id)
+        self.assertEqual(Tracks.path, new_path)
+        self.assertEqual(Tracks.rating, "5")
+        self.assertEqual(Tracks.folder_id.path, os.path.dirname(new_path))
+        self.assertEqual(Tracks.album_id.folder_id, Tracks.folder_id)
+        self.assertEqual(
+            (Tracks.artist_id.name, Tracks.album_id.name, Tracks.genre_id.name, Tracks.year),
+            (u"Artist1", u"Album1", u"Genre1", u"2001"),
+        )
+
+        self.cleanUp()
+
+    def test_26_move_track_without_fingerprint(self):
+        """
+        Test a move of a track scanned before the fingerprints were introduced.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.env.cr.execute("UPDATE oomusic_track SET fingerprint = NULL;")
+        self.TrackObj.invalidate_cache()
+        Track = self.TrackObj.search([("name", "=", "Song1")])
+        Track.write({"rating": "5"})
+
+        new_path = os.path.join(
+            os.path.dirname(os.path.realpath(__file__)),
+            "folder_scan_test",
+            "Artist2",
+            "Album3",
+            "song1.mp3",
+        )
+        shutil.move(Track.path, new_path)
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("name", "=", "Song1")])
+
+        # The track is matched on its size and tags
+        self.assertEqual(Tracks.id, Track.id)
+        self.assertEqual(Tracks.path, new_path)
+        self.assertEqual(Tracks.rating, "5")
+        self.assertTrue(Tracks.fingerprint)
+
+        # The fingerprints of the other tracks are computed by the scan
+        self.assertFalse(self.TrackObj.search([("fingerprint", "=", False)]))
+
+        self.cleanUp()
+
     def test_30_remove_dir(self):
         """
         Test a removing of directory.
@@ -229,3 +362,306 @@ class TestOomusicFolderScan(test_common.TestOomusicCommon):
         self.assertEqual(0, len(Folder))
 
         self.cleanUp()
+
+    def test_40_resume_scan(self):
+        """
+        Test the resuming of an interrupted scan.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+
+        # Simulate a scan interrupted after the first album: the modification dates of the next
+        # directories were recorded, but their tracks were not created.
+        self.TrackObj.search([("root_folder_id", "=", self.Folder.id)]).filtered(
+            lambda t: t.name != "Song2"
+        ).unlink()
+        self.Folder.write(
+            {
+                "scan_checkpoint": os.path.join(self.Folder.path, "Artist1", "Album1"),
+                "scan_checkpoint_tracks": 2,
+            }
+        )
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+
+        # The directories up to the checkpoint are not scanned again, the next ones are scanned
+        # even if their modification date did not change.
+        self.assertEqual(
+            set(Tracks.mapped("name")), set(["Song2", "Song3", "Song4", "Song5", "Song6"])
+        )
+        self.assertFalse(self.Folder.scan_checkpoint)
+        self.assertEqual(self.Folder.scan_checkpoint_tracks, 0)
+
+        self.cleanUp()
+
+    def test_45_partial_scan(self):
+        """
+        Test the scan of some directories of the folder.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        artist1_path = os.path.join(self.Folder.path, "Artist1")
+        album1_path = os.path.join(artist1_path, "Album1")
+        album3_path = os.path.join(self.Folder.path, "Artist2", "Album3")
+        os.remove(os.path.join(album1_path, "song1.mp3"))
+        os.remove(os.path.join(album3_path, "song5.mp3"))
+
+        # The sub-directories of a shallow path are neither scanned nor cleaned
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(
+            self.Folder.id, shallow_paths=[artist1_path]
+        )
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        self.assertEqual(len(Tracks), 6)
+        self.assertEqual(len(self.FolderObj.search([("path", "like", artist1_path)])), 3)
+        self.assertTrue(self.Folder.scan_log_ids[0].partial)
+
+        # Only the given directories are cleaned
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(
+            self.Folder.id, paths=[artist1_path]
+        )
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        self.assertEqual(
+            set(Tracks.mapped("name")), set(["Song2", "Song3", "Song4", "Song5", "Song6"])
+        )
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(
+            self.Folder.id, shallow_paths=[album3_path]
+        )
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        self.assertEqual(set(Tracks.mapped("name")), set(["Song2", "Song3", "Song4", "Song6"]))
+
+        self.cleanUp()
+
+    def test_50_scan_log(self):
+        """
+        Test the statistics recorded in the scan logs.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Log = self.Folder.scan_log_ids
+        self.assertEqual(len(Log), 1)
+        self.assertEqual(
+            (Log.state, Log.progress, Log.files_total, Log.files_read, Log.files_skipped),
+            ("done", 100.0, 6, 6, 0),
+        )
+        self.assertEqual(Log.files_failed, 0)
+        self.assertTrue(Log.bytes_read > 0.0)
+
+        # Nothing is read during a rescan
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Log = self.Folder.scan_log_ids[0]
+        self.assertEqual((Log.files_total, Log.files_read, Log.files_skipped), (6, 0, 6))
+
+        # Only the most recent logs are kept
+        LogObj = self.env["oomusic.folder.scan.log"]
+        self.patch(type(LogObj), "_logs_per_folder", 1)
+        LogObj._clean_logs()
+        self.assertEqual(self.Folder.scan_log_ids, Log)
+
+        self.cleanUp()
+
+    def test_60_quarantine(self):
+        """
+        Test the quarantine of the files which cannot be read.
+        """
+        album_path = os.path.join(self.Folder.path, "Artist1", "Album1")
+        broken_path = os.path.join(album_path, "broken.mp3")
+        with open(broken_path, "wb") as f:
+            f.write(b"\x00" * 4096)
+
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Quarantine = self.Folder.quarantine_ids
+        self.assertEqual(Quarantine.path, broken_path)
+        self.assertEqual(Quarantine.failure_count, 1)
+        self.assertTrue(Quarantine.error)
+        self.assertEqual(self.Folder.scan_log_ids[0].files_failed, 1)
+
+        # The file is not read again as long as it does not change, even if its directory changes
+        mtime = int(os.stat(album_path).st_mtime) + 10
+        os.utime(album_path, (mtime, mtime))
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(self.Folder.scan_log_ids[0].files_failed, 0)
+        self.assertEqual(Quarantine.failure_count, 1)
+
+        # Retrying reads the file again at the next scan
+        Quarantine.action_retry()
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(self.Folder.scan_log_ids[0].files_failed, 1)
+        self.assertEqual(len(self.Folder.quarantine_ids), 1)
+
+        # Once fixed, the file is imported and removed from the quarantine
+        shutil.copyfile(os.path.join(album_path, "song1.mp3"), broken_path)
+        mtime += 10
+        os.utime(album_path, (mtime, mtime))
+        os.utime(broken_path, (mtime, mtime))
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertFalse(self.Folder.quarantine_ids)
+        self.assertTrue(self.TrackObj.search([("path", "=", broken_path)]))
+
+        self.cleanUp()
+
+    def test_70_walk_known(self):
+        """
+        Test the walk of a folder skipping the directories which did not change.
+        """
+        # The copy of the test folder keeps the original modification dates
+        for rootdir, dirnames, filenames in os.walk(self.Folder.path):
+            os.utime(rootdir, None)
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertTrue(self.Folder.last_scan_walk)
+
+        # The directories were modified right before the walk, so they must be listed
+        user_id = self.Folder.user_id.id
+        known = self.FolderScanObj._get_walk_known(
+            self.Folder.path, user_id, self.Folder.last_scan_walk
+        )
+        self.assertFalse(known)
+
+        # Long after, the walk gives the same result without listing the directories
+        known = self.FolderScanObj._get_walk_known(
+            self.Folder.path, user_id, self.Folder.last_scan_walk + 3600
+        )
+        self.assertEqual(len(known), 6)
+        tree = list(self.FolderScanObj._walk(self.Folder.path))
+        self.assertEqual(list(self.FolderScanObj._walk(self.Folder.path, known=known)), tree)
+
+        # A new file is not seen as long as the modification date of its directory is the same
+        album_path = os.path.join(self.Folder.path, "Artist1", "Album1")
+        mtime = os.stat(album_path).st_mtime
+        shutil.copyfile(
+            os.path.join(album_path, "song1.mp3"), os.path.join(album_path, "song7.mp3")
+        )
+        os.utime(album_path, (mtime, mtime))
+        self.assertEqual(list(self.FolderScanObj._walk(self.Folder.path, known=known)), tree)
+        os.utime(album_path, (mtime + 10, mtime + 10))
+        tree = list(self.FolderScanObj._walk(self.Folder.path, known=known))
+        self.assertIn("song7.mp3", [f[0] for f in dict((d[0], d[2]) for d in tree)[album_path]])
+
+        self.cleanUp()
+
+    def test_75_walk_errors(self):
+        """
+        Test that the content of a directory which cannot be listed is not cleaned
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+
+        # A dangling symbolic link is skipped, the rest of the directory is scanned
+        album_path = os.path.join(self.Folder.path, "Artist1", "Album1")
+        link = os.path.join(album_path, "dangling.mp3")
+        os.symlink(os.path.join(album_path, "missing.mp3"), link)
+        failed = set()
+        tree = dict((d[0], d[2]) for d in self.FolderScanObj._walk(self.Folder.path, failed=failed))
+        self.assertFalse(failed)
+        self.assertEqual(len(tree[album_path]), 2)
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)]), tracks)
+        os.remove(link)
+
+        # Nothing is removed from a directory which could not be listed
+        user_id = self.Folder.user_id.id
+        self.FolderScanObj._clean_directory(
+            self.Folder.path, user_id, tree=[], failed={self.Folder.path}
+        )
+        self.assertEqual(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)]), tracks)
+        artist_path = os.path.join(self.Folder.path, "Artist1")
+        tree = [d for d in self.FolderScanObj._walk(self.Folder.path) if artist_path not in d[0]]
+        self.FolderScanObj._clean_directory(
+            self.Folder.path, user_id, tree=tree, failed={artist_path}
+        )
+        self.assertEqual(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)]), tracks)
+
+        self.cleanUp()
+
+    def test_80_album_stats(self):
+        """
+        Test the aggregates of the albums.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Albums = self.AlbumObj.search([("name", "in", ["Album1", "Album2", "Album3"])])
+        for Album in Albums:
+            self.assertEqual(Album.track_count, 2)
+            self.assertEqual(Album.duration, sum(Album.track_ids.mapped("duration")))
+            self.assertAlmostEqual(Album.size, sum(Album.track_ids.mapped("size")))
+
+        # Moving a track updates both the former and the new album
+        Track = self.TrackObj.search([("name", "=", "Song1")])
+        Album = Track.album_id
+        shutil.move(Track.path, os.path.join(self.Folder.path, "Artist2", "Album3", "song1.mp3"))
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertEqual(Album.track_count, 1)
+        self.assertEqual(Track.album_id.track_count, 1)
+        self.assertNotEqual(Track.album_id, Album)
+
+        # Removing a track through the ORM updates the album as well
+        Album.track_ids.unlink()
+        self.assertEqual((Album.track_count, Album.duration), (0, 0))
+
+        self.cleanUp()
+
+    def test_85_scan_same_user(self):
+        """
+        Test the scans of two root folders of the same user, overlapping each other.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        shutil.rmtree(os.path.join(self.Folder.path, "Artist1", "Album2"))
+
+        # The second folder shares its artist and genre with the first one
+        path2 = os.path.join(os.path.dirname(os.path.realpath(__file__)), "folder_scan_test2")
+        shutil.rmtree(path2, True)
+        shutil.copytree(os.path.join(self.Folder.path, "Artist2"), os.path.join(path2, "Artist2"))
+        Folder2 = self.FolderObj.create({"path": path2, "locked": True})
+
+        # While the second folder is being scanned, the tags are not cleaned
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.assertTrue(self.GenreObj.search([("name", "=", "Genre2")]))
+
+        # The last scan cleans the tags, even if it is the first one of its folder
+        Folder2.write({"locked": False})
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(Folder2.id)
+        self.assertFalse(self.GenreObj.search([("name", "=", "Genre2")]))
+        Tracks = self.TrackObj.search([("root_folder_id", "=", Folder2.id)])
+        self.assertEqual(len(Tracks), 2)
+        self.assertEqual(len(self.ArtistObj.search([("name", "=", "Artist2")])), 1)
+
+        shutil.rmtree(path2, True)
+        self.cleanUp()
+
+    def test_86_unlock_folder(self):
+        """
+        Test the end of the scans of two root folders of the same user, finishing together.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.TrackObj.search([("album_id.name", "=", "Album2")]).unlink()
+        Folder2 = self.FolderObj.create({"path": self.Folder.path + "2", "locked": True})
+        self.Folder.write({"locked": True})
+
+        # The first scan to finish sees the other one running
+        FolderScan = self.FolderScanObj.with_context(test_mode=True)
+        FolderScan._unlock_folder(self.Folder, {"locked": False})
+        self.assertFalse(self.Folder.locked)
+        self.assertTrue(self.GenreObj.search([("name", "=", "Genre2")]))
+
+        # The last one sees the first folder unlocked, and cleans the tags
+        FolderScan._unlock_folder(Folder2, {"locked": False})
+        self.assertFalse(Folder2.locked)
+        self.assertFalse(self.GenreObj.search([("name", "=", "Genre2")]))
+
+        self.cleanUp()
+
+    def test_87_lock_user_keys(self):
+        """
+        Test the advisory locks taken by the scans, outside of the test mode.
+        """
+        query = "SELECT pg_try_advisory_lock(%s, hashtext(%s));"
+        params = (self.env.uid, self.FolderScanObj._name)
+        with self.registry.cursor() as cr1, self.registry.cursor() as cr2:
+            FolderScan = self.FolderScanObj.with_env(self.env(cr=cr1))
+            with FolderScan._lock_user_keys(self.env.uid, [FolderScan._name]):
+                cr2.execute(query, params)
+                self.assertFalse(cr2.fetchone()[0])
+
+            # The lock is released at the end of the section
+            cr2.execute(query, params)
+            self.assertTrue(cr2.fetchone()[0])
+            cr2.execute("SELECT pg_advisory_unlock(%s, hashtext(%s));", params)
+
+        self.cleanUp()
@@ -0,0 +1,641 @@
+# -*- coding: utf-8 -*-
+
+import gc
+import logging
+import os
+import resource
+import shutil
+import struct
+import time
+import tracemalloc
+
+from mutagen.easymp4 import EasyMP4
+from mutagen.ogg import OggPage
+from odoo.addons.oomusic.models.oomusic_folder_scan import _read_file, taglib
+from odoo.tests import tagged
+
+from . import test_common
+
+_logger = logging.getLogger(__name__)
+
+# Number of tracks of the synthetic library, and sizes of the libraries of the memory benchmark
+BENCH_TRACKS = int(os.environ.get("OOMUSIC_BENCH_TRACKS", 100000))
+BENCH_SIZES = [
+    int(n)
+    for n in os.environ.get(
+        "OOMUSIC_BENCH_SIZES",
+        "{},{},{}".format(BENCH_TRACKS // 100, BENCH_TRACKS // 10, BENCH_TRACKS),
+    ).split(",")
+]
+
+# Shape of the synthetic tree written on the disk: number of files, files per leaf directory,
+# sub-directories per directory and depth of the leaf directories
+BENCH_FILES = int(os.environ.get("OOMUSIC_BENCH_FILES", 2000))
+BENCH_FILES_PER_DIR = int(os.environ.get("OOMUSIC_BENCH_FILES_PER_DIR", 10))
+BENCH_DIRS_PER_DIR = int(os.environ.get("OOMUSIC_BENCH_DIRS_PER_DIR", 5))
+BENCH_DEPTH = int(os.environ.get("OOMUSIC_BENCH_DEPTH", 2))
+
+# Silent MPEG-1 Layer III frame, 32 kbps, 44.1 kHz, mono: header, empty side information and
+# padding up to the frame size of 104 bytes. 40 frames make a file of about one second.
+MPEG_FRAME = b"\xff\xfb\x10\xc0" + b"\x00" * 100
+MPEG_FRAMES = 40
+
+
+def _id3_tag(tags):
+    """
+    Build an ID3v2.4 tag with UTF-8 text frames.
+
+    :param dict tags: values by frame ID, e.g. {"TIT2": "Song1"}
+    :return bytes: the tag
+    """
+    frames = b""
+    for frame_id, value in tags.items():
+        data = b"\x03" + value.encode("utf-8")
+        size = len(data)
+        syncsafe = bytes(
+            [(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F]
+        )
+        frames += frame_id.encode("ascii") + syncsafe + b"\x00\x00" + data
+    size = len(frames)
+    syncsafe = bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F, (size >> 7) & 0x7F, size & 0x7F])
+    return b"ID3\x04\x00\x00" + syncsafe + frames
+
+
+def _write_mp3(path, tags, mtime):
+    with open(path, "wb") as f:
+        f.write(_id3_tag(tags) + MPEG_FRAME * MPEG_FRAMES)
+    os.utime(path, (mtime, mtime))
+
+
+def _vorbis_comment(tags):
+    """
+    Build a Vorbis comment block, as found in the FLAC and Ogg files.
+
+    :param dict tags: values by field name, e.g. {"TITLE": "Song1"}
+    :return bytes: the block
+    """
+    data = struct.pack("<I", 7) + b"oomusic" + struct.pack("<I", len(tags))
+    for key, value in tags.items():
+        comment = "{}={}".format(key, value).encode("utf-8")
+        data += struct.pack("<I", len(comment)) + comment
+    return data
+
+
+def _write_flac(path, tags):
+    # STREAMINFO of 10 seconds at 8 kHz, mono, 16 bits
+    streaminfo = struct.pack(">HH", 4096, 4096) + b"\x00" * 6
+    streaminfo += ((8000 << 44) | (15 << 36) | 80000).to_bytes(8, "big") + b"\x00" * 16
+    comment = _vorbis_comment(tags)
+    with open(path, "wb") as f:
+        f.write(b"fLaC\x00" + len(streaminfo).to_bytes(3, "big") + streaminfo)
+        f.write(b"\x84" + len(comment).to_bytes(3, "big") + comment)
+        f.write(b"\x00" * 10000)
+
+
+def _write_ogg(path, packets, granule):
+    """
+    Write an Ogg file made of one page per packet. The last page ends the stream at the given
+    granule position.
+    """
+    with open(path, "wb") as f:
+        for sequence, packet in enumerate(packets):
+            page = OggPage()
+            page.serial = 1
+            page.sequence = sequence
+            page.packets = [packet]
+            page.first = not sequence
+            page.last = sequence == len(packets) - 1
+            page.position = granule if page.last else 0
+            f.write(page.write())
+
+
+def _write_vorbis(path, tags):
+    # 10 seconds at 8 kHz, mono, 8 kbps
+    head = b"\x01vorbis" + struct.pack("<IBI3i", 0, 1, 8000, 0, 8000, 0) + b"\xb8\x01"
+    comment = b"\x03vorbis" + _vorbis_comment(tags) + b"\x01"
+    _write_ogg(path, [head, comment, b"\x00" * 10000], 80000)
+
+
+def _write_opus(path, tags):
+    # 10 seconds at 48 kHz, after a pre-skip of 312 samples
+    head = b"OpusHead" + struct.pack("<BBHIhB", 1, 1, 312, 48000, 0, 0)
+    comment = b"OpusTags" + _vorbis_comment(tags)
+    _write_ogg(path, [head, comment, b"\x00" * 10000], 480312)
+
+
+def _mp4_atom(atom_type, data):
+    return struct.pack(">I4s", len(data) + 8, atom_type) + data
+
+
+def _write_mp4(path, tags):
+    """
+    Write an MP4 file of 10 seconds, without any sample description.
+
+    :param dict tags: values by atom type, e.g. {b"\xa9nam": "Song1", b"trkn": (1, 2)}
+    """
+    items = b""
+    for atom_type, value in tags.items():
+        if atom_type in (b"trkn", b"disk"):
+            data = b"\x00\x00\x00\x00" + struct.pack(">HHHH", 0, value[0], value[1], 0)
+        else:
+            data = b"\x00\x00\x00\x01" + value.encode("utf-8")
+        items += _mp4_atom(atom_type, _mp4_atom(b"data", data[:4] + b"\x00" * 4 + data[4:]))
+    mvhd = b"\x00" * 12 + struct.pack(">II", 1000, 10000) + b"\x00" * 80
+    mdhd = b"\x00" * 12 + struct.pack(">II", 1000, 10000) + b"\x00" * 4
+    hdlr = b"\x00" * 8 + b"soun" + b"\x00" * 13
+    trak = _mp4_atom(
+        b"trak", _mp4_atom(b"mdia", _mp4_atom(b"mdhd", mdhd) + _mp4_atom(b"hdlr", hdlr))
+    )
+    meta_hdlr = _mp4_atom(b"hdlr", b"\x00" * 8 + b"mdirappl" + b"\x00" * 9)
+    meta = _mp4_atom(b"meta", b"\x00" * 4 + meta_hdlr + _mp4_atom(b"ilst", items))
+    moov = _mp4_atom(b"moov", _mp4_atom(b"mvhd", mvhd) + trak + _mp4_atom(b"udta", meta))
+    with open(path, "wb") as f:
+        f.write(_mp4_atom(b"ftyp", b"M4A \x00\x00\x00\x00M4A mp42isom"))
+        f.write(moov + _mp4_atom(b"mdat", b"\x00" * 10000))
+
+
+def _write_samples(path):
+    """
+    Write a FLAC, an Ogg Vorbis, an Opus and an MP4 file, since the test folder only contains MP3
+    files.
+
+    :param str path: directory of the files
+    """
+    os.makedirs(path)
+    tags = {
+        "TITLE": "Song7",
+        "ARTIST": "Artist3",
+        "ALBUM": "Album4",
+        "GENRE": "Genre3",
+        "DATE": "2001",
+        "TRACKNUMBER": "1/2",
+    }
+    _write_flac(os.path.join(path, "song7.flac"), tags)
+    _write_vorbis(os.path.join(path, "song7.ogg"), tags)
+    _write_opus(os.path.join(path, "song7.opus"), tags)
+    _write_mp4(
+        os.path.join(path, "song7.m4a"),
+        {
+            b"\xa9nam": "Song7",
+            b"\xa9ART": "Artist3",
+            b"\xa9alb": "Album4",
+            b"\xa9gen": "Genre3",
+            b"\xa9day": "2001",
+            b"trkn": (1, 2),
+        },
+    )
+
+
+def _create_tree(top, nb_files, files_per_dir, dirs_per_dir, depth, mtime):
+    """
+    Write a synthetic library of tiny MP3 files. The leaf directories are located at the given
+    depth, the first level being the artists and the leaves the albums. The tags vary with the
+    position of the file: one artist per first level directory, one album per leaf, 25 genres and
+    20 years.
+
+    :param str top: path of the library
+    :param int mtime: modification date set on the files and directories, so they look older
+        than the scan
+    :return list: paths of the leaf directories
+    """
+    leaves = []
+    nb_leaves = -(-nb_files // files_per_dir)
+    for leaf in range(nb_leaves):
+        parts = []
+        for level in range(depth):
+            index = leaf // (dirs_per_dir ** (depth - 1 - level))
+            if level:
+                index %= dirs_per_dir
+            parts.append("{}{}".format("Artist" if not level else "Dir", index))
+        parts[-1] = "Album{}".format(leaf)
+        path = os.path.join(top, *parts)
+        os.makedirs(path)
+        leaves.append(path)
+        for i in range(min(files_per_dir, nb_files - leaf * files_per_dir)):
+            tags = {
+                "TIT2": "Song{}-{}".format(leaf, i),
+                "TPE1": parts[0],
+                "TALB": parts[-1],
+                "TCON": "Genre{}".format(leaf % 25),
+                "TDRC": str(1990 + leaf % 20),
+                "TRCK": "{}/{}".format(i + 1, files_per_dir),
+            }
+            _write_mp3(os.path.join(path, "song{}.mp3".format(i)), tags, mtime)
+    for rootdir, dirnames, filenames in os.walk(top, topdown=False):
+        os.utime(rootdir, (mtime, mtime))
+    return leaves
+
+
+def _legacy_find_orphan_tags(cr, user_id):
+    """
+    Reference implementation of the tags cleaning, comparing the IDs in Python sets.
+    """
+    cr.execute(
+        "SELECT artist_id, album_artist_id, performer_id, album_id, genre_id, id "
+        "FROM oomusic_track WHERE user_id = %s;",
+        (user_id,),
+    )
+    res = cr.fetchall()
+    track_data = [
+        ("id", "oomusic_artist", {r[0] for r in res} | {r[1] for r in res} | {r[2] for r in res}),
+        ("id", "oomusic_album", {r[3] for r in res}),
+        ("id", "oomusic_genre", {r[4] for r in res}),
+        ("track_id", "oomusic_playlist_line", {r[5] for r in res}),
+    ]
+    to_clean = []
+    for td in track_data:
+        cr.execute("SELECT id, " + td[0] + " FROM " + td[1] + " WHERE user_id = %s", (user_id,))
+        to_clean.append(
+            (td[1].replace("_", "."), [r[0] for r in cr.fetchall() if r[1] not in td[2]])
+        )
+    return to_clean
+
+
+def _legacy_find_missing_paths(cr, path, user_id, tree):
+    """
+    Reference implementation of the directory cleaning, comparing the paths in Python sets.
+    """
+    folderlist = {rootdir for rootdir, mtime, files in tree}
+    filelist = {os.path.join(rootdir, fn) for rootdir, mtime, files in tree for fn, m, s in files}
+    to_clean = []
+    for table, paths in [
+        ("oomusic_folder", folderlist),
+        ("oomusic_track", filelist),
+        ("oomusic_folder_quarantine", filelist),
+    ]:
+        cr.execute("SELECT id, path FROM " + table + " WHERE user_id = %s", (user_id,))
+        to_clean.append(
+            (
+                table.replace("_", "."),
+                [
+                    r[0]
+                    for r in cr.fetchall()
+                    if (r[1] == path or r[1].startswith(path + os.sep)) and r[1] not in paths
+                ],
+            )
+        )
+    return to_clean
+
+
+def _legacy_build_cache(cr, user_id):
+    """
+    Reference implementation of the scan cache, as it was before being loaded lazily: all the
+    albums, artists, folders and genres of the user are loaded upfront.
+    """
+    cache = {}
+    cr.execute("SELECT name, folder_id, id FROM oomusic_album WHERE user_id = %s;", (user_id,))
+    cache["album"] = {(r[0], r[1]): r[2] for r in cr.fetchall()}
+    cr.execute("SELECT name, id FROM oomusic_artist WHERE user_id = %s;", (user_id,))
+    cache["artist"] = {r[0]: r[1] for r in cr.fetchall()}
+    cr.execute(
+        "SELECT path, id, last_modification FROM oomusic_folder WHERE user_id = %s;", (user_id,)
+    )
+    cache["folder"] = {r[0]: (r[1], r[2] or 0) for r in cr.fetchall()}
+    cr.execute("SELECT name, id FROM oomusic_genre WHERE user_id = %s;", (user_id,))
+    cache["genre"] = {r[0]: r[1] for r in cr.fetchall()}
+    return cache
+
+
+def _read_proc_status(key):
+    # Value of a memory entry of /proc/self/status, in MiB
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(key + ":"):
+                return int(line.split()[1]) / 1024.0
+    return 0.0
+
+
+@tagged("-standard", "oomusic_benchmark")
+class TestOomusicFolderScanBenchmark(test_common.TestOomusicCommon):
+    """
+    Benchmarks of the folder scanner on a synthetic library, created directly in the database.
+    They are not run by default: use `--test-tags oomusic_benchmark`. The size of the library is
+    set by the environment variable `OOMUSIC_BENCH_TRACKS`, the sizes compared by the memory
+    benchmark by `OOMUSIC_BENCH_SIZES`, e.g. "10000,100000,1000000".
+    """
+
+    def setUp(self):
+        super(TestOomusicFolderScanBenchmark, self).setUp()
+        self.user_id = self.env.uid
+        self.bench_path = os.path.join(self.Folder.path, "bench")
+
+    def _create_library(self, nb_tracks):
+        """
+        Create a library of `nb_tracks` tracks, 10 per album folder and 5 albums per artist. 10% of
+        the artists, albums and genres are not used by any track, and the returned tree lacks 1% of
+        the folders and 10% of the tracks, so the cleaning methods have something to find.
+
+        :return list: tree of the library, in the format of `_walk`
+        """
+        cr = self.env.cr
+        nb_albums = max(nb_tracks // 10, 1)
+        nb_artists = max(nb_albums // 5, 1)
+        params = {
+            "user_id": self.user_id,
+            "root_id": self.Folder.id,
+            "path": self.bench_path,
+            "nb_tracks": nb_tracks,
+            "nb_albums": nb_albums,
+            "nb_artists": nb_artists,
+        }
+        cr.execute(
+            """
+            INSERT INTO oomusic_artist (name, user_id)
+                SELECT 'Artist' || i, %(user_id)s FROM generate_series(1, %(nb_artists)s * 11 / 10) i
+                RETURNING id;
+            """,
+            params,
+        )
+        params["artist_ids"] = [r[0] for r in cr.fetchall()]
+        cr.execute(
+            """
+            INSERT INTO oomusic_genre (name, user_id)
+                SELECT 'Genre' || i, %(user_id)s FROM generate_series(1, 22) i
+                RETURNING id;
+            """,
+            params,
+        )
+        params["genre_ids"] = [r[0] for r in cr.fetchall()]
+        cr.execute(
+            """
+            INSERT INTO oomusic_folder (
+                name, path, root, parent_id, user_id, tag_analysis, scan_mode, last_modification
+            )
+                SELECT
+                    'Album' || i, %(path)s || '/Album' || i, false, %(root_id)s, %(user_id)s,
+                    'taglib', 'serial', 0
+                FROM generate_series(1, %(nb_albums)s * 11 / 10) i
+                RETURNING id;
+            """,
+            params,
+        )
+        params["folder_ids"] = [r[0] for r in cr.fetchall()]
+        cr.execute(
+            """
+            INSERT INTO oomusic_album (name, folder_id, user_id)
+                SELECT 'Album' || i, (%(folder_ids)s::int[])[i], %(user_id)s
+                FROM generate_series(1, %(nb_albums)s * 11 / 10) i
+                RETURNING id;
+            """,
+            params,
+        )
+        params["album_ids"] = [r[0] for r in cr.fetchall()]
+        cr.execute(
+            """
+            INSERT INTO oomusic_track (
+                name, path, artist_id, album_artist_id, album_id, genre_id, folder_id,
+                root_folder_id, user_id
+            )
+                SELECT
+                    'Song' || i, %(path)s || '/Album' || (i / 10 + 1) || '/song' || i || '.mp3',
+                    (%(artist_ids)s::int[])[i / 50 + 1], (%(artist_ids)s::int[])[i / 50 + 1],
+                    (%(album_ids)s::int[])[i / 10 + 1], (%(genre_ids)s::int[])[i %% 20 + 1],
+                    (%(folder_ids)s::int[])[i / 10 + 1], %(root_id)s, %(user_id)s
+                FROM generate_series(0, %(nb_tracks)s - 1) i;
+            """,
+            params,
+        )
+
+        tree = []
+        for i in range(nb_albums):
+            if i % 100 == 99:
+                continue
+            files = [
+                ("song{}.mp3".format(j), 0, 0) for j in range(i * 10, i * 10 + 10) if j % 10 != 9
+            ]
+            tree.append((os.path.join(self.bench_path, "Album{}".format(i + 1)), 0, files))
+        return tree
+
+    def _peak_memory(self, func, *args):
+        """
+        Run a function and measure its memory peak, in MiB: the Python allocations traced by
+        tracemalloc, and the increase of the RSS of the process. The peak RSS is reset before the
+        call, which requires Linux; the RSS increase is None otherwise. Memory freed by a previous
+        call and kept by the allocator is reused, which can only lower the increase.
+        """
+        gc.collect()
+        try:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+            rss = _read_proc_status("VmRSS")
+        except OSError:
+            rss = None
+        tracemalloc.start()
+        res = func(*args)
+        peak = tracemalloc.get_traced_memory()[1] / (1024.0 * 1024.0)
+        tracemalloc.stop()
+        if rss is not None:
+            rss = _read_proc_status("VmHWM") - rss
+        return res, peak, rss
+
+    def _timeit(self, func, *args):
+        t = time.time()
+        res = func(*args)
+        return {model: set(ids) for model, ids in res}, time.time() - t
+
+    def test_00_find_orphan_tags(self):
+        """
+        Compare the anti-join tags cleaning with the Python sets implementation
+        """
+        self._create_library(BENCH_TRACKS)
+        legacy, t_legacy = self._timeit(_legacy_find_orphan_tags, self.env.cr, self.user_id)
+        res, t_res = self._timeit(self.FolderScanObj._find_orphan_tags, self.user_id)
+        self.assertEqual(res, legacy)
+        self.assertTrue(res["oomusic.album"])
+        _logger.info(
+            "Orphan tags of %s tracks: %.3fs (Python sets: %.3fs)", BENCH_TRACKS, t_res, t_legacy
+        )
+
+        self.cleanUp()
+
+    def test_10_find_missing_paths(self):
+        """
+        Compare the anti-join directory cleaning with the Python sets implementation
+        """
+        args = (self.bench_path, self.user_id, self._create_library(BENCH_TRACKS))
+        legacy, t_legacy = self._timeit(_legacy_find_missing_paths, self.env.cr, *args)
+        res, t_res = self._timeit(self.FolderScanObj._find_missing_paths, *args)
+        self.assertEqual(res, legacy)
+        self.assertTrue(res["oomusic.track"])
+        _logger.info(
+            "Missing paths of %s tracks: %.3fs (Python sets: %.3fs)", BENCH_TRACKS, t_res, t_legacy
+        )
+
+        self.cleanUp()
+
+    def test_20_cache_memory(self):
+        """
+        Compare the memory used by the scan cache of a no-op rescan with the cache loading all the
+        related records upfront, for several library sizes
+        """
+        FolderScan = self.FolderScanObj
+        cr = self.env.cr
+        for nb_tracks in BENCH_SIZES:
+            cr.execute("SAVEPOINT oomusic_bench")
+            tree = self._create_library(nb_tracks)
+            cache, peak, rss = self._peak_memory(
+                FolderScan._build_cache_global, self.Folder.id, self.user_id
+            )
+            moves, peak_moves, rss_moves = self._peak_memory(
+                FolderScan._detect_moves, [self.Folder.path], tree, cache
+            )
+            legacy, peak_legacy, rss_legacy = self._peak_memory(
+                _legacy_build_cache, cr, self.user_id
+            )
+            self.assertEqual(cache["folder"], legacy["folder"])
+            self.assertFalse(moves)
+            _logger.info(
+                "Scan cache of %s tracks: %.1f MiB traced, %s MiB RSS "
+                "(loading all records: %.1f MiB traced, %s MiB RSS)",
+                nb_tracks,
+                max(peak, peak_moves),
+                "%.1f" % max(rss, rss_moves) if rss is not None else "?",
+                peak_legacy,
+                "%.1f" % rss_legacy if rss_legacy is not None else "?",
+            )
+            del cache, legacy
+            cr.execute("ROLLBACK TO SAVEPOINT oomusic_bench")
+
+        self.cleanUp()
+
+
+@tagged("-standard", "oomusic_benchmark")
+class TestOomusicTagReaderBenchmark(test_common.TestOomusicCommon):
+    """
+    Benchmark of the tag reading backends on the sample files of the test folder, completed by a
+    FLAC, an Ogg Vorbis, an Opus and an MP4 file. Use `--test-tags oomusic_benchmark` to run it.
+    Each file is read `OOMUSIC_BENCH_READS` times.
+    """
+
+    def test_00_tag_readers(self):
+        """
+        Compare the fast tag reader with Taglib and Mutagen
+        """
+        nb_reads = int(os.environ.get("OOMUSIC_BENCH_READS", 100))
+        keys = set(self.FolderScanObj.MAP_ID3_FIELD.keys())
+        _write_samples(os.path.join(self.Folder.path, "Artist3", "Album4"))
+        file_paths = sorted(
+            os.path.join(rootdir, fn)
+            for rootdir, dirnames, filenames in os.walk(self.Folder.path)
+            for fn in filenames
+        )
+        backends = ["fast", "mutagen"] + (["taglib"] if taglib else [])
+        timings = {}
+        res = {}
+        for tag_name in backends:
+            t = time.time()
+            for i in range(nb_reads):
+                res[tag_name] = [_read_file(fp, tag_name, keys) for fp in file_paths]
+            timings[tag_name] = time.time() - t
+
+        # The fast reader must return the same data as Mutagen. Mutagen gives the raw atoms of the
+        # MP4 files and takes their bitrate from the sample description, so only their duration
+        # is compared, and their tags are compared with the ones of EasyMP4.
+        for fp, fast, mutagen in zip(file_paths, res["fast"], res["mutagen"]):
+            if not fp.endswith(".m4a"):
+                self.assertEqual(fast, mutagen)
+                continue
+            self.assertEqual(fast["duration"], mutagen["duration"])
+            easy_tags = {k.upper(): v for k, v in EasyMP4(fp).items()}
+            self.assertEqual(fast["tags"], {k: v for k, v in easy_tags.items() if k in keys})
+        for tag_name in backends:
+            _logger.info(
+                "Tag reading of %s files with %s: %.3fs (%.0f files/s)",
+                len(file_paths) * nb_reads,
+                tag_name,
+                timings[tag_name],
+                len(file_paths) * nb_reads / timings[tag_name],
+            )
+
+        self.cleanUp()
+
+
+@tagged("-standard", "oomusic_benchmark")
+class TestOomusicFolderScanTreeBenchmark(test_common.TestOomusicCommon):
+    """
+    Benchmark of the complete folder scan on a synthetic library written on the disk. Use
+    `--test-tags oomusic_benchmark` to run it. The shape of the library is set by the environment
+    variables `OOMUSIC_BENCH_FILES`, `OOMUSIC_BENCH_FILES_PER_DIR`, `OOMUSIC_BENCH_DIRS_PER_DIR` and
+    `OOMUSIC_BENCH_DEPTH`.
+    """
+
+    def setUp(self):
+        super(TestOomusicFolderScanTreeBenchmark, self).setUp()
+        self.bench_path = os.path.join(self.Folder.path, "bench")
+        self.bench_mtime = int(time.time()) - 86400
+        self.bench_leaves = _create_tree(
+            self.bench_path,
+            BENCH_FILES,
+            BENCH_FILES_PER_DIR,
+            BENCH_DIRS_PER_DIR,
+            BENCH_DEPTH,
+            self.bench_mtime,
+        )
+        os.utime(self.Folder.path, (self.bench_mtime, self.bench_mtime))
+
+    def _scan(self, phase):
+        """
+        Scan the folder and log the statistics of the scan.
+
+        :param str phase: name of the scan in the log
+        :return: oomusic.folder.scan.log record
+        """
+        cr = self.env.cr
+        queries = cr.sql_log_count
+        t = time.time()
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        duration = time.time() - t
+        queries = cr.sql_log_count - queries
+        self.Folder.invalidate_cache()
+        Log = self.Folder.scan_log_ids[0]
+        _logger.info(
+            "Scan of %s files (%s): %.3fs, %s files read (%.0f files/s), %s queries, "
+            "peak RSS: %.1f MiB",
+            BENCH_FILES,
+            phase,
+            duration,
+            Log.files_read,
+            BENCH_FILES / duration,
+            queries,
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        )
+        return Log
+
+    def test_00_scan(self):
+        """
+        Time the first scan, a rescan without changes, a rescan after modifying 1% of the files
+        and a rescan after moving 10% of the artists
+        """
+        Log = self._scan("first scan")
+        self.assertEqual(Log.files_read, BENCH_FILES + 6)
+
+        Log = self._scan("no-op rescan")
+        self.assertEqual(Log.files_read, 0)
+
+        # Modify 1% of the files. The directories are touched as well, as a tag editor writing
+        # through a temporary file would do.
+        mtime = int(time.time())
+        nb_modified = max(BENCH_FILES // 100, 1)
+        step = max(len(self.bench_leaves) // nb_modified, 1)
+        leaves = self.bench_leaves[::step][:nb_modified]
+        for i, leaf in enumerate(leaves):
+            tags = {"TIT2": "Modified{}".format(i), "TPE1": "Artist", "TALB": "Album"}
+            _write_mp3(os.path.join(leaf, "song0.mp3"), tags, mtime)
+            os.utime(leaf, (mtime, mtime))
+        Log = self._scan("1% modified")
+        self.assertEqual(Log.files_read, len(leaves))
+
+        # Move 10% of the artists in a new directory
+        artists = sorted(os.listdir(self.bench_path))
+        moved_path = os.path.join(self.Folder.path, "moved")
+        os.mkdir(moved_path)
+        for artist in artists[: max(len(artists) // 10, 1)]:
+            shutil.move(os.path.join(self.bench_path, artist), moved_path)
+        Log = self._scan("10% moved")
+        self.assertEqual(Log.files_read, 0)
+        self.assertEqual(
+            len(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])),
+            BENCH_FILES + 6,
+        )
+
+        self.cleanUp()
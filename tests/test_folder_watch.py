@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+import os
+import unittest
+
+from odoo.addons.oomusic.models.oomusic_folder_watch import INotify, FolderWatcher, flags
+
+from . import test_common
+
+try:
+    from inotify_simple import Event
+except ImportError:
+    Event = None
+
+
+@unittest.skipIf(not INotify, "inotify_simple is not installed")
+class TestOomusicFolderWatch(test_common.TestOomusicCommon):
+    def setUp(self):
+        super(TestOomusicFolderWatch, self).setUp()
+        self.Watcher = FolderWatcher(self.env.cr.dbname)
+        self.Watcher.inotify = INotify()
+        self.Watcher.roots[self.Folder.id] = self.Folder.path
+        self.Watcher._add_watch(self.Folder.id, self.Folder.path)
+        self.wds = {path: wd for wd, (folder_id, path) in self.Watcher.wds.items()}
+
+    def tearDown(self):
+        self.Watcher.inotify.close()
+        super(TestOomusicFolderWatch, self).tearDown()
+
+    def test_00_handle_event(self):
+        """
+        Test the directories registered by the filesystem events.
+        """
+        album1_path = os.path.join(self.Folder.path, "Artist1", "Album1")
+        artist2_path = os.path.join(self.Folder.path, "Artist2")
+        self.assertEqual(len(self.wds), 6)
+
+        # A modified file only needs its directory to be scanned
+        self.Watcher._handle_event(Event(self.wds[album1_path], flags.CLOSE_WRITE, 0, "song1.mp3"))
+        self.assertEqual(self.Watcher.pending, {self.Folder.id: {album1_path: False}})
+
+        # A new directory is watched and scanned recursively
+        new_path = os.path.join(artist2_path, "Album4")
+        os.mkdir(new_path)
+        self.Watcher._handle_event(
+            Event(self.wds[artist2_path], flags.CREATE | flags.ISDIR, 0, "Album4")
+        )
+        self.assertIn(new_path, [path for folder_id, path in self.Watcher.wds.values()])
+        self.assertEqual(
+            self.Watcher.pending, {self.Folder.id: {album1_path: False, new_path: True}}
+        )
+
+        # A directory containing a directory scanned recursively is scanned recursively
+        self.Watcher._handle_event(Event(self.wds[artist2_path], flags.DELETE, 0, "song.mp3"))
+        paths, shallow_paths = self.Watcher._get_scan_paths(self.Watcher.pending[self.Folder.id])
+        self.assertEqual((paths, shallow_paths), ([artist2_path], [album1_path]))
+
+        self.cleanUp()
+
+    def test_10_watch_failure(self):
+        """
+        Test a folder which cannot be watched entirely anymore.
+        """
+        artist2_path = os.path.join(self.Folder.path, "Artist2")
+        os.mkdir(os.path.join(artist2_path, "Album4"))
+
+        def add_watch(path, mask):
+            raise OSError(28, "No space left on device")
+
+        self.Watcher.inotify.add_watch = add_watch
+        self.Watcher.time_refresh = 1.0
+        self.Watcher._handle_event(
+            Event(self.wds[artist2_path], flags.CREATE | flags.ISDIR, 0, "Album4")
+        )
+
+        # The folder is not watched anymore, and refreshed right away
+        self.assertFalse(self.Watcher.roots)
+        self.assertFalse(self.Watcher.wds)
+        self.assertFalse(self.Watcher.pending)
+        self.assertEqual(self.Watcher.time_refresh, 0.0)
+
+        self.cleanUp()
+
+    def test_20_scan_pending(self):
+        """
+        Test the scan of the pending directories.
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        album1_path = os.path.join(self.Folder.path, "Artist1", "Album1")
+        os.remove(os.path.join(album1_path, "song1.mp3"))
+        self.Watcher._handle_event(Event(self.wds[album1_path], flags.DELETE, 0, "song1.mp3"))
+
+        paths, shallow_paths = self.Watcher._get_scan_paths(self.Watcher.pending[self.Folder.id])
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(
+            self.Folder.id, paths=paths, shallow_paths=shallow_paths
+        )
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        self.assertEqual(len(Tracks), 5)
+        self.assertFalse(Tracks.filtered(lambda t: t.name == "Song1"))
+
+        self.cleanUp()
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+
+from . import test_common
+
+
+class TestOomusicTrack(test_common.TestOomusicCommon):
+    def test_00_loudness(self):
+        """
+        Test the loudness analysis and its use by the transcoder
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Tracks = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)])
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_0")
+        self.assertFalse(any(Tracks.mapped("loudness_modification")))
+        self.assertIn("loudnorm", Transcoder._get_norm_filter(Tracks[0]))
+
+        # All tracks are analyzed
+        self.TrackObj.with_context(test_mode=True).cron_analyze_loudness()
+        for Track in Tracks:
+            self.assertEqual(Track.loudness_modification, Track.last_modification)
+        self.assertFalse(self.TrackObj._get_loudness_pending(0, 100))
+
+        # The gain does not make the peak clip
+        Track = Tracks[0]
+        Track.write({"loudness": -30.0, "loudness_peak": -3.0})
+        self.assertEqual(Transcoder._get_norm_filter(Track), "-af volume=2.00dB")
+        Track.write({"loudness": -20.0})
+        self.assertEqual(Transcoder._get_norm_filter(Track), "-af volume=2.00dB")
+        Track.write({"loudness": -10.0})
+        self.assertEqual(Transcoder._get_norm_filter(Track), "-af volume=-8.00dB")
+
+        # A modified file is analyzed again
+        Track.write({"last_modification": Track.last_modification + 1})
+        self.assertIn("loudnorm", Transcoder._get_norm_filter(Track))
+        Track.flush()
+        self.assertEqual([t[0] for t in self.TrackObj._get_loudness_pending(0, 100)], Track.ids)
+
+        self.cleanUp()
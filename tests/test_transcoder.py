@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import time
+
+from odoo.addons.oomusic.controllers.main import send_file_range
+from odoo.addons.oomusic.models.oomusic_transcoder import (
+    TranscodeOutput,
+    TranscodeScheduler,
+    _evict_cache,
+    _prefetch,
+    _prefetch_lock,
+    _procs,
+)
+
+from . import test_common, test_sub_common
+
+
+class TestOomusicTranscoder(test_common.TestOomusicCommon):
+    def test_00_cache(self):
+        """
+        Test the transcoding cache
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        Track = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)], limit=1)
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_0")
+        self.env["ir.config_parameter"].sudo().set_param("oomusic.trans_cache_size", 10)
+        cache_path = Transcoder._get_cache_path(Track)
+        if os.path.exists(cache_path):
+            os.remove(cache_path)
+        self.assertFalse(Transcoder.get_cached_file(Track.id))
+
+        # A seeked track is not cached
+        b"".join(Transcoder.transcode_stream(Track.id, seek=1))
+        self.assertFalse(Transcoder.get_cached_file(Track.id))
+
+        # The output is cached while it is streamed
+        data = b"".join(Transcoder.transcode_stream(Track.id))
+        self.assertTrue(data)
+        self.assertEqual(Transcoder.get_cached_file(Track.id), cache_path)
+        with open(cache_path, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+        # Another bitrate or the normalization give another file
+        self.assertFalse(Transcoder.get_cached_file(Track.id, bitrate=64))
+        self.assertFalse(Transcoder.get_cached_file(Track.id, norm=True))
+
+        # The cache can be deactivated
+        self.env["ir.config_parameter"].sudo().set_param("oomusic.trans_cache_size", 0)
+        self.assertFalse(Transcoder.get_cached_file(Track.id))
+        os.remove(cache_path)
+
+        self.cleanUp()
+
+    def test_10_cache_eviction(self):
+        """
+        Test the eviction of the least recently used files of the cache
+        """
+        cache_dir = os.path.join(self.Folder.path, "cache")
+        os.mkdir(cache_dir)
+        now = time.time()
+        for i in range(5):
+            path = os.path.join(cache_dir, "{}.mp3".format(i))
+            with open(path, "wb") as f:
+                f.write(b"\x00" * 1000)
+            os.utime(path, (now - 100 + i, now - 100 + i))
+        # File being written, and file 0 recently played
+        with open(os.path.join(cache_dir, "5.mp3.1-1.tmp"), "wb") as f:
+            f.write(b"\x00" * 1000)
+        os.utime(os.path.join(cache_dir, "0.mp3"))
+
+        _evict_cache(cache_dir, 2500)
+        self.assertEqual(sorted(os.listdir(cache_dir)), ["0.mp3", "4.mp3", "5.mp3.1-1.tmp"])
+        shutil.rmtree(cache_dir)
+
+        self.cleanUp()
+
+    def test_20_prefetch(self):
+        """
+        Test the transcoding of the next lines of a playlist in the background
+        """
+        self.FolderScanObj.with_context(test_mode=True)._scan_folder(self.Folder.id)
+        self.env["ir.config_parameter"].sudo().set_param("oomusic.trans_cache_size", 10)
+        self.env["ir.config_parameter"].sudo().set_param("oomusic.prefetch_count", 2)
+        playlist = self.PlaylistObj.create({"name": "crotte", "audio_mode": "standard"})
+        playlist._add_tracks(self.TrackObj.search([("root_folder_id", "=", self.Folder.id)]))
+        lines = playlist.playlist_line_ids
+        output_format = list(self.env["oomusic.transcoder"]._get_browser_output_formats())[0]
+        Transcoder = self.env["oomusic.transcoder"]._get_transcoder(output_format, "mp3")
+        cache_paths = [Transcoder._get_cache_path(line.track_id) for line in lines]
+        for cache_path in cache_paths:
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+
+        # Nothing is prepared when shuffling
+        lines[-2].oomusic_set_current(shuffle=True)
+        self.assertFalse(_prefetch["pending"])
+
+        # The two next lines are prepared, the first line of the playlist following the last one
+        lines[-2].oomusic_set_current()
+        for i in range(100):
+            with _prefetch_lock:
+                if not _prefetch["pending"]:
+                    break
+            time.sleep(0.1)
+        self.assertEqual(
+            [os.path.exists(cache_path) for cache_path in cache_paths],
+            [True] + [False] * (len(lines) - 2) + [True],
+        )
+        for cache_path in cache_paths:
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+
+        # The format played by the client is used
+        output_format = list(self.env["oomusic.transcoder"]._get_browser_output_formats())[-1]
+        Transcoder = self.env["oomusic.transcoder"]._get_transcoder(output_format, "mp3")
+        cache_paths = [Transcoder._get_cache_path(line.track_id) for line in lines]
+        lines[0].oomusic_set_current(output_format=output_format)
+        for i in range(100):
+            with _prefetch_lock:
+                if not _prefetch["pending"]:
+                    break
+            time.sleep(0.1)
+        self.assertEqual(
+            [os.path.exists(cache_path) for cache_path in cache_paths],
+            [False, True, True] + [False] * (len(lines) - 3),
+        )
+        for cache_path in cache_paths:
+            if os.path.exists(cache_path):
+                os.remove(cache_path)
+
+        self.cleanUp()
+
+    def test_30_scheduler(self):
+        """
+        Test the admission control of the transcoding processes
+        """
+        slot_dir = os.path.join(self.Folder.path, "slots")
+        scheduler = TranscodeScheduler(slot_dir, 2, 0.5)
+
+        # A slot is reserved for the streams
+        slot_bg = scheduler.acquire(background=True)
+        self.assertTrue(slot_bg)
+        slot_fg = scheduler.acquire()
+        self.assertTrue(slot_fg)
+        self.assertNotEqual(slot_bg, slot_fg)
+        self.assertFalse(scheduler.acquire())
+        scheduler.release(slot_fg)
+
+        # The slot of a process is released once its output is read
+        proc = scheduler.spawn(["echo", "test"])
+        self.assertFalse(scheduler.acquire())
+        self.assertEqual(b"".join(TranscodeOutput(proc, 1024)), b"test\n")
+        slot_fg = scheduler.acquire()
+        self.assertTrue(slot_fg)
+        scheduler.release(slot_fg)
+        scheduler.release(slot_bg)
+
+        # The background transcodings have their own timeout
+        scheduler = TranscodeScheduler(slot_dir, 2, 0.5, background_timeout=0.5)
+        slot_bg = scheduler.acquire(background=True)
+        self.assertFalse(scheduler.acquire(background=True))
+        scheduler.release(slot_bg)
+
+        # No limit
+        self.assertTrue(TranscodeScheduler(slot_dir, 0, 0.5).acquire())
+        shutil.rmtree(slot_dir)
+
+        self.cleanUp()
+
+    def test_40_terminate(self):
+        """
+        Test the termination of the transcoding processes whose output is not read
+        """
+        slot_dir = os.path.join(self.Folder.path, "slots")
+        scheduler = TranscodeScheduler(slot_dir, 2, 0.5)
+
+        # The process is terminated when the output is closed, e.g. the client disconnects
+        proc = scheduler.spawn(["cat", "/dev/zero"])
+        output = TranscodeOutput(proc, 1024)
+        self.assertEqual(len(next(iter(output))), 1024)
+        self.assertIn(proc, _procs)
+        self.assertEqual(scheduler.count_running(), 1)
+        output.close()
+        self.assertIsNotNone(proc.returncode)
+        self.assertNotIn(proc, _procs)
+        self.assertEqual(scheduler.count_running(), 0)
+
+        # Same if the output is never read
+        proc = scheduler.spawn(["cat", "/dev/zero"])
+        TranscodeOutput(proc, 1024).close()
+        self.assertIsNotNone(proc.returncode)
+
+        # Or if the output is dropped
+        proc = scheduler.spawn(["cat", "/dev/zero"])
+        output = TranscodeOutput(proc, 1024)
+        del output
+        self.assertIsNotNone(proc.returncode)
+        self.assertEqual(scheduler.count_running(), 0)
+        shutil.rmtree(slot_dir)
+
+        stats = self.env["oomusic.transcoder"].get_transcode_stats()
+        self.assertEqual(stats["processes"], 0)
+
+        self.cleanUp()
+
+    def test_50_resolution(self):
+        """
+        Test the cached choice of the transcoder
+        """
+        TranscoderObj = self.env["oomusic.transcoder"]
+        Transcoder = TranscoderObj._get_transcoder("mp3", "flac")
+        self.assertEqual(Transcoder.output_format.name, "mp3")
+        self.assertIn("mp3", TranscoderObj._get_browser_output_formats())
+
+        # The cache is invalidated when a transcoder is modified
+        Transcoder.black_formats |= self.env.ref("oomusic.oomusic_format_flac")
+        self.assertNotEqual(TranscoderObj._get_transcoder("mp3", "flac"), Transcoder)
+        self.assertEqual(TranscoderObj._get_transcoder("mp3", "ogg"), Transcoder)
+        Transcoder.black_formats -= self.env.ref("oomusic.oomusic_format_flac")
+        self.assertEqual(TranscoderObj._get_transcoder("mp3", "flac"), Transcoder)
+
+        TranscoderObj.search([("output_format.name", "=", "mp3")]).unlink()
+        self.assertFalse(TranscoderObj._get_transcoder("mp3", "flac"))
+        self.assertNotIn("mp3", TranscoderObj._get_browser_output_formats())
+
+        self.cleanUp()
+
+
+class TestOomusicTranscoderController(test_sub_common.TestOomusicSubCommon):
+    def test_00_range(self):
+        """
+        Test the range requests on a cached transcoding
+        """
+        Track = self.TrackObj.search([("root_folder_id", "=", self.Folder.id)], limit=1)
+        Transcoder = self.env.ref("oomusic.oomusic_transcoder_2")
+        cache_path = Transcoder._get_cache_path(Track)
+        url = "/rest/stream.view" + self.cred + "&id={}&format=ogg".format(Track.id)
+
+        # The first request is transcoded, the second one is served from the cache
+        res = self.url_open(url)
+        self.assertEqual(res.status_code, 200)
+        data = res.content
+        res = self.url_open(url)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.content, data)
+        self.assertEqual(res.headers["Accept-Ranges"], "bytes")
+
+        res = self.url_open(url, headers={"Range": "bytes=10-19"})
+        self.assertEqual(res.status_code, 206)
+        self.assertEqual(res.content, data[10:20])
+        self.assertEqual(res.headers["Content-Range"], "bytes 10-19/{}".format(len(data)))
+
+        # A file evicted from the cache in the meantime is not sent, so it is transcoded again
+        os.remove(cache_path)
+        self.assertIsNone(send_file_range(cache_path, "audio/ogg"))
+        self.cleanUp()